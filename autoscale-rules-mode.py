@@ -9,8 +9,13 @@
     naming convention: app-name-upscale/app-name-downscale
 
     $ python2 autoscale-rules-mode.py --help
-    usage: autoscale-rules-mode.py [-h] [-m MODE] [-l LIMIT] [-s] [-v] [-n]
-                                   [--version]  access_key_id access_key_secret region_id
+    usage: autoscale-rules-mode.py [-h] [-m MODE] [-l LIMIT] [-s] [--probe-sync]
+                                   [--probe-samples PROBE_SAMPLES]
+                                   [--cache-url CACHE_URL] [--cache-max-age CACHE_MAX_AGE]
+                                   [--shard SHARD] [--deadline DEADLINE]
+                                   [--output {text,ndjson}] [--record-trace RECORD_TRACE]
+                                   [--report REPORT] [-v] [-n] [--version]
+                                   access_key_id access_key_secret region_id
 
     positional arguments:
     access_key_id                       Accesskey ID for aliyun account
@@ -25,72 +30,445 @@
                                         'log/autoscale_rules_mode.log'
     -s, --skip-sync                     Skip synching cached_rules.yaml for faster runtime if
                                         you're sure that no rules has been changed in aliyun
+    --probe-sync                        Use cached_rules.yaml after checking its count and a sample
+                                        of its rules against aliyun, only the scaling groups found
+                                        stale are synced again
+    --probe-samples PROBE_SAMPLES       Number of cached scaling rules --probe-sync compares with
+                                        aliyun, default: 10
+    --cache-url CACHE_URL               Share cache files with other runs through a remote cache
+                                        (file:///path/to/dir, or http://host:port of the
+                                        cache-server command)
+    --cache-max-age CACHE_MAX_AGE       Use cached_rules.yaml without syncing if it was synced from
+                                        aliyun less than this many seconds ago, e.g. by another run
+                                        sharing --cache-url
+    --shard SHARD                       Only process shard i of N (e.g. 1/4), apps are split by a
+                                        hash of their scaling group name
+    --deadline DEADLINE                 Stop making changes in aliyun this many seconds after the
+                                        start, what remains is reported as DEFERRED
+    --output {text,ndjson}              ndjson: stream every result and API call to stdout as JSON
+                                        lines (other output goes to stderr), with a summary at the end
+    --record-trace RECORD_TRACE         Record every request to aliyun and its response into a
+                                        trace file (without the access key), see the replay command
+    --report REPORT                     Write results of this run into a JSON report file
     -v, --verbose                       Verbosity (-v, -vv, etc)
     -n, --noconfirm                     Skip interactive prompts (yes to all)
     --version                           Show program's version number and exit
+
+    Other commands:
+    $ python2 autoscale-rules-mode.py backtest [-m MODE] [-i INTERVAL] [--curves CURVES] [--json] data
+        Replay CPU utilization series (CSV/NPZ) against a mode config and predict scaling events
+    $ python2 autoscale-rules-mode.py benchmark [--sizes SIZES] [--runs RUNS] [--traces TRACES] [--baseline BASELINE]
+                                                [--tolerance TOLERANCE] [--json] [-o OUTPUT] {memory,replay,startup}
+        Measure memory and runtime of the script
+    $ python2 autoscale-rules-mode.py cache-server [--host HOST] [--port PORT] directory
+        Serve cache files to every run using --cache-url, with versions and compare-and-swap updates
+    $ python2 autoscale-rules-mode.py merge-reports [-o OUTPUT] reports [reports ...]
+        Combine the --report files written by every shard of a run
+    $ python2 autoscale-rules-mode.py emergency [--min MIN] [--max MAX] [--upscale-value V] [--downscale-value V] [--cache-url URL]
+                                                access_key_id access_key_secret region_id app
+        Resize one scaling group (and its scaling rules) right away without syncing everything
+    $ python2 autoscale-rules-mode.py query [-w WHERE] [-f FIELDS] [-m MODE] [--json] {alarms,apps,groups,rules}
+        Query cached scaling groups, rules, event-trigger tasks and apps without calling aliyun
+    $ python2 autoscale-rules-mode.py replay [--cache-dir CACHE_DIR] [--report REPORT] trace
+        Re-run a reconciliation recorded with --record-trace offline
+    $ python2 autoscale-rules-mode.py rollback [-j JOBS] [--shard SHARD] [--snapshot SNAPSHOT] [-l] [--cache-url URL] [-n]
+                                               access_key_id access_key_secret region_id
+        Undo the changes of a run (or emergency) from the snapshot it wrote before making them
+    $ python2 autoscale-rules-mode.py sync-feed [-f] [--interval INTERVAL] [--shard SHARD] [--cache-url URL]
+                                                access_key_id access_key_secret region_id feed
+        Keep the cache files fresh from a change feed of ESS configuration events instead of polling aliyun
+    $ python2 autoscale-rules-mode.py exporter [-m MODE] [--interval INTERVAL] [--feed FEED] [--cache-url URL]
+                                               [--cache-max-age AGE] [--shard SHARD] [--host HOST] [--port PORT]
+                                               access_key_id access_key_secret region_id
+        Serve the drift between a mode config and aliyun as Prometheus metrics
 """
 
 __version__ = "0.2.4"
 
 import os
+import copy
 import glob
 import sys
 import time
-import yaml
+import hashlib
+import heapq
+import json
+import re
 import argparse
+import atexit
+import contextlib
+import fcntl
+import importlib
 import logging
-from aliyunsdkcore.client import AcsClient
-from aliyunsdkcore.acs_exception.exceptions import ClientException
-from aliyunsdkcore.acs_exception.exceptions import ServerException
-from aliyunsdkess.request.v20140828 import DescribeScalingRulesRequest
-from aliyunsdkess.request.v20140828 import ModifyScalingRuleRequest
-from aliyunsdkess.request.v20140828 import CreateScalingRuleRequest
-from aliyunsdkess.request.v20140828 import DescribeScalingGroupsRequest
-from aliyunsdkess.request.v20140828 import DescribeAlarmsRequest
-from aliyunsdkess.request.v20140828 import CreateAlarmRequest
-from aliyunsdkess.request.v20140828 import ModifyAlarmRequest
-from aliyunsdkess.request.v20140828 import DeleteAlarmRequest
-from aliyunsdkess.request.v20140828 import DisableAlarmRequest
-from aliyunsdkess.request.v20140828 import ModifyScalingGroupRequest
+import subprocess
+import random
+import tempfile
+import shutil
+import threading
+import Queue
+import multiprocessing.dummy
+
+
+class LazyModule(object):
+    """ Stands in for a module and only imports it when one of its attributes is used """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+class ClientException(Exception):
+    """
+        Replaced by aliyunsdkcore's ClientException once the API client is built,
+        errors of a replayed trace are raised with this one
+    """
+
+    def __init__(self, code, msg):
+        Exception.__init__(self, code, msg)
+        self.error_code = code
+        self.message = msg
+
+    def __str__(self):
+        return "{} {}".format(self.error_code, self.message)
+
+
+class ServerException(Exception):
+    """
+        Replaced by aliyunsdkcore's ServerException (errors aliyun answered with) once the API client is built,
+        like the SDK's it isn't a ClientException, replayed errors recorded as ServerException are raised with this one
+    """
+
+    def __init__(self, code, msg):
+        Exception.__init__(self, code, msg)
+        self.error_code = code
+        self.message = msg
+
+    def __str__(self):
+        return "{} {}".format(self.error_code, self.message)
+
+
+# YAML, the SDK core and the ESS request modules are imported on first use,
+# so commands that don't call aliyun (e.g. --help, query) start fast
+yaml = LazyModule("yaml")
+urllib2 = LazyModule("urllib2")
+urlparse = LazyModule("urlparse")
 
 # Global internal variables
 _mode = ""
 _verbose = False
 _client = None
+_credentials = None
+
+# ESS API actions used by this script
+_ess_actions = [
+    "DescribeScalingRules", "ModifyScalingRule", "CreateScalingRule",
+    "DescribeScalingGroups", "DescribeAlarms", "CreateAlarm", "ModifyAlarm",
+    "DeleteAlarm", "DisableAlarm", "ModifyScalingGroup"
+]
 _noconfirm = False
 _config = {}
 _current_rules = {}
 _skip_sync = False
+_probe_sync = False
+_probe_samples = 10
+_deadline = None
+_ndjson = None
+_remote_cache = None
+_remote_cache_synced = {}  # Cache file name => (local content, remote content) at its version in cached_versions.json
+_remote_cache_retries = 3
+
+# Error codes of aliyun for an ID that doesn't exist (anymore)
+_invalid_id_errors = ["InvalidScalingGroupId.NotFound", "InvalidScalingRuleId.NotFound"]
+_cache_max_age = 0
+_rules_synced_recently = False
 _limit = []
 _scaling_groups = {}
 _event_trigger_tasks = {}
+_shard = None
+_report = {'results': [], 'api_calls': {}}
+_trace = None
+_output_lock = threading.Lock()
+_loader = None
+_snapshot = None  # Snapshot file of this run, opened on its first change in aliyun
+_random = random.Random()
+_cache_dir = None
+_config_dir = None
+
+# Cache files shared through --cache-url, as (kind, extension) of cache_file()
+_remote_cache_files = [('rules', 'yaml'), ('rules', 'meta.json'),
+                       ('scaling_groups', 'yaml'),
+                       ('event_trigger_tasks', 'yaml')]
+
+# Request parameters that are never written into a trace
+_trace_scrubbed_params = [
+    "AccessKeyId", "Signature", "SignatureNonce", "SecurityToken",
+    "BearerToken"
+]
+_modify_alarm_setters = None
+
+# Event-trigger task attributes ModifyAlarm may change in place, mapped to the request
+# setters that do it (aliyun-python-sdk-ess 2.2.5 only has set_AlarmActions), attributes
+# whose setter is missing in the installed SDK fall back to create-then-delete
+_modify_alarm_capabilities = {
+    "AlarmActions": ["set_AlarmActions"],
+    "MetricItem": ["set_MetricName"],
+    "Condition": ["set_Statistics"],
+    "ComparisonOperator": ["set_ComparisonOperator", "set_ComparisionOperator"],
+    "Threshold": ["set_Threshold"],
+    "TriggerAfter": ["set_EvaluationCount"],
+    "RefreshCycleSeconds": ["set_Period"],
+}
+
+# Order work is scheduled in by plan_work(), the changes that protect capacity first
+_schedule_tiers = {
+    'scaling-group-increase': 0,
+    'upscale': 1,
+    'downscale': 2,
+    'scaling-group-decrease': 3,
+    'unrecognized': 4,
+}
+
+# Caches read by the 'query' command, and the fields of each of its tables
+_query_cache_kinds = ['rules', 'scaling_groups', 'event_trigger_tasks']
+_query_fields = {
+    'apps': [
+        'App', 'ScalingGroupId', 'GroupExists', 'MinInstance', 'MaxInstance',
+        'InConfig', 'UpscaleConfig', 'DownscaleConfig', 'UpscaleRule',
+        'DownscaleRule', 'UpscaleEventTriggerTask', 'DownscaleEventTriggerTask'
+    ],
+    'groups': [
+        'ScalingGroupName', 'ScalingGroupId', 'MinInstance', 'MaxInstance',
+        'ConfigMinInstance', 'ConfigMaxInstance', 'SizeInSync'
+    ],
+    'rules': [
+        'ScalingRuleName', 'App', 'ScalingRuleId', 'ScalingGroupId',
+        'AdjustmentType', 'AdjustmentValue', 'Cooldown', 'Config', 'InSync',
+        'HasEventTriggerTask'
+    ],
+    'alarms': [
+        'Name', 'App', 'AlarmTaskId', 'ScalingGroupId', 'Enable', 'State',
+        'MetricItem', 'Condition', 'ComparisonOperator', 'Threshold',
+        'TriggerAfter', 'RefreshCycleSeconds', 'TargetRule', 'RuleMissing',
+        'InSync'
+    ],
+}
+
+# Attributes that decide whether a scaling rule or an event-trigger task has changed
+_scaling_rule_attr = ["AdjustmentType", "AdjustmentValue", "Cooldown"]
+_event_trigger_task_attr = [
+    "MetricItem", "Condition", "ComparisonOperator", "Threshold",
+    "TriggerAfter", "RefreshCycleSeconds"
+]
+_numeric_attr = [
+    "AdjustmentValue", "Cooldown", "Threshold", "TriggerAfter",
+    "RefreshCycleSeconds"
+]
+
+# Other spellings of comparison operators that we treat the same as aliyun's
+_comparison_operator_aliases = {
+    "=>": ">=",
+    "=<": "<=",
+    "ge": ">=",
+    "gt": ">",
+    "le": "<=",
+    "lt": "<",
+    "greaterthanorequaltothreshold": ">=",
+    "greaterthanthreshold": ">",
+    "lessthanorequaltothreshold": "<=",
+    "lessthanthreshold": "<",
+}
+
+
+class Record(object):
+    """
+        Compact inventory record, only keeps the fields listed in __slots__
+        Fields can also be read and written like a dict (e.g. rule['Cooldown'])
+    """
+    __slots__ = ()
+
+    # Fields holding names or IDs that repeat across records, these are interned
+    _interned = ()
+
+    def __init__(self, **fields):
+        for a in self.__slots__:
+            value = fields.get(a)
+            if a in self._interned:
+                value = intern_name(value)
+            setattr(self, a, value)
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Build a record from a dict, fields that aren't in __slots__ are dropped """
+        return cls(**dict((a, data.get(a)) for a in cls.__slots__))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def as_dict(self):
+        # Tuples are dumped as lists, yaml.safe_load can't read python tuples
+        return dict((a, list(b) if isinstance(b, tuple) else b)
+                    for a, b in ((a, getattr(self, a)) for a in self.__slots__))
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class ScalingRuleRecord(Record):
+    """ Scaling rule loaded from aliyun or cached_rules.yaml """
+    __slots__ = ('ScalingRuleName', 'ScalingRuleId', 'ScalingRuleAri',
+                 'ScalingGroupId', 'AdjustmentType', 'AdjustmentValue',
+                 'Cooldown', 'Fingerprint')
+    _interned = ('ScalingRuleName', 'ScalingGroupId', 'AdjustmentType')
+
+    @classmethod
+    def from_dict(cls, data):
+        rule = super(ScalingRuleRecord, cls).from_dict(data)
+        if rule.Fingerprint is None:
+            rule.Fingerprint = scaling_rule_fingerprint(rule)
+        return rule
+
+
+class ScalingGroupRecord(Record):
+    """ Size of a scaling group, _scaling_groups maps its name to its ID and its ID to this """
+    __slots__ = ('MinInstance', 'MaxInstance')
+
+
+class EventTriggerTaskRecord(Record):
+    """
+        Event-trigger task loaded from aliyun, using our config attribute names,
+        valid_name and bypass_skip are set while processing the rules
+    """
+    __slots__ = ('Name', 'AlarmTaskId', 'ScalingGroupId', 'Enable', 'State',
+                 'MetricItem', 'Condition', 'ComparisonOperator', 'Threshold',
+                 'TriggerAfter', 'RefreshCycleSeconds', 'AlarmActions',
+                 'Fingerprint', 'valid_name', 'bypass_skip')
+    _interned = ('Name', 'ScalingGroupId', 'State', 'MetricItem', 'Condition',
+                 'ComparisonOperator')
+
+    @classmethod
+    def from_api(cls, data):
+        """ Build a record from a DescribeAlarms item """
+        try:
+            alarm_actions = data['alarmActions']['alarmAction']
+        except (KeyError, TypeError):
+            # Unknown, rather than pointing at nothing
+            alarm_actions = None
+        return cls.from_dict({
+            'Name': data['Name'],
+            'AlarmTaskId': data['AlarmTaskId'],
+            'ScalingGroupId': data['ScalingGroupId'],
+            'Enable': data.get('Enable'),
+            'State': data.get('State'),
+            'MetricItem': data['MetricName'],
+            'Condition': data['Statistics'],
+            'ComparisonOperator': data['ComparisonOperator'],
+            'Threshold': data['Threshold'],
+            'TriggerAfter': data['EvaluationCount'],
+            'RefreshCycleSeconds': data['Period'],
+            'AlarmActions': alarm_actions,
+        })
+
+    @classmethod
+    def from_dict(cls, data):
+        task = super(EventTriggerTaskRecord, cls).from_dict(data)
+        if task.AlarmActions is not None:
+            task.AlarmActions = tuple(
+                intern_name(a) for a in task.AlarmActions)
+        task.valid_name = bool(task.valid_name)
+        task.bypass_skip = bool(task.bypass_skip)
+        if task.Fingerprint is None:
+            task.Fingerprint = event_trigger_task_fingerprint(task)
+        return task
+
+
+def intern_name(value):
+    """ Intern names and IDs so records sharing them keep a single copy """
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+def add_scaling_group(scaling_groups, data):
+    """ Add a DescribeScalingGroups item into scaling_groups (name => ID and ID => size) """
+    scaling_group_id = intern_name(data['ScalingGroupId'])
+    scaling_groups[intern_name(data['ScalingGroupName'])] = scaling_group_id
+    scaling_groups[scaling_group_id] = ScalingGroupRecord(
+        MinInstance=data['MinSize'], MaxInstance=data['MaxSize'])
 
 
 def init(args):
     """ Initialization """
     # Initialize necessary variables
-    global _mode, _verbose, _client, _skip_sync, _limit, _noconfirm
+    global _mode, _verbose, _skip_sync, _limit, _noconfirm, _shard
+    global _probe_sync, _probe_samples, _deadline, _cache_max_age, _loader
+    global _event_trigger_tasks
     _mode = args.mode
     _verbose = args.verbose
     _skip_sync = args.skip_sync
+    _probe_sync = args.probe_sync
+    _probe_samples = args.probe_samples
+    _cache_max_age = args.cache_max_age
     _noconfirm = args.noconfirm
+    _shard = parse_shard(args.shard)
     _limit = args.limit.split(',')
     if _limit[0] == '':
         _limit = None
+    elif _shard:
+        _limit = [a for a in _limit if rule_in_shard(a)]
+
+    _report['mode'] = _mode
+    _report['region'] = args.region_id
+    _report['shard'] = args.shard
+    _report['started_at'] = time.time()
+    if args.output == "ndjson":
+        init_ndjson_output()
+    if args.deadline:
+        _deadline = _report['started_at'] + args.deadline
+
+    # An empty --limit for this shard isn't the same as no --limit, there's nothing to do
+    if _limit == []:
+        print "None of the --limit rules are in shard {} of {}, nothing to do".format(
+            _shard[0], _shard[1])
+        _report['completed'] = True
+        if args.report:
+            write_report(args.report)
+        sys.exit(0)
+
+    init_logging(args.log_file)
 
-    logging.basicConfig(
-        format='\n[%(asctime)s] %(message)s',
-        datefmt='%d/%m/%Y %I:%M:%S %p',
-        filename=args.log_file,
-        level=logging.DEBUG)
+    # Initialize AcsClient obj to consume the core API
+    init_client(args)
 
-    access_key_id = args.access_key_id
-    access_key_secret = args.access_key_secret
-    region_id = args.region_id
+    # Pull the latest cache files from the remote cache if --cache-url is used
+    if args.cache_url:
+        init_remote_cache(args.cache_url)
 
-    # Initialize AcsClient obj to consume the core API
-    print "Initializing API client object using the configured access key"
-    _client = AcsClient(access_key_id, access_key_secret, region_id)
+    # Record every request and response of this run if --record-trace is used
+    if args.record_trace:
+        init_trace(args)
+
+    if _shard:
+        print "Processing shard {} of {}".format(_shard[0], _shard[1])
 
     # Load selected mode config file
     load_mode_config()
@@ -98,50 +476,282 @@ def init(args):
     # Load current scaling groups that exist in aliyun
     load_scaling_groups()
 
-    # Load current rules that are being used in aliyun
-    load_current_rules()
+    # Load current rules that are being used in aliyun, unless they come from aliyun page by page
+    rules_loaded = load_current_rules(stream=True)
 
-    # Load current event trigger tasks that exist in aliyun
-    load_event_trigger_tasks()
+    # Load current event trigger tasks that exist in aliyun (and the rules) in the background,
+    # main() reconciles every page as soon as it arrives
+    print "Loading event-trigger tasks information from aliyun page by page"
+    _event_trigger_tasks = {}
+    _loader = InventoryLoader(load_rules=not rules_loaded)
+    _loader.start()
 
-    print "There are total of {} scaling rules detected".format(
-        len(_current_rules))
+
+def init_ndjson_output():
+    """
+        Stream results and API calls to stdout as JSON lines (--output ndjson),
+        everything else that is printed goes to stderr, the summary is written when the run exits
+    """
+    global _ndjson
+    _ndjson = sys.stdout
+    sys.stdout = sys.stderr
+    atexit.register(emit_summary)
+    emit({
+        'type': 'start',
+        'mode': _report['mode'],
+        'region': _report['region'],
+        'shard': _report['shard'],
+    })
+
+
+def init_logging(log_file):
+    """ Log debugging information into the log file """
+    logging.basicConfig(
+        format='\n[%(asctime)s] %(message)s',
+        datefmt='%d/%m/%Y %I:%M:%S %p',
+        filename=log_file,
+        level=logging.DEBUG)
 
 
-def load_event_trigger_tasks():
-    """ Load all existing event-trigger tasks in aliyun and store in global _scaling_groups """
-    global _event_trigger_tasks
+def init_client(args):
+    """ Remember the access key, the AcsClient obj is only built when the first request is sent """
+    global _credentials
+    _credentials = (args.access_key_id, args.access_key_secret,
+                    args.region_id)
 
-    print "Loading event-trigger tasks information from aliyun"
 
+def get_client():
+    """ Build the AcsClient obj to consume the core API on first use """
+    global _client, ClientException, ServerException
+    if _client is None:
+        from aliyunsdkcore.client import AcsClient
+        from aliyunsdkcore.acs_exception import exceptions
+
+        print "Initializing API client object using the configured access key"
+        ClientException = exceptions.ClientException
+        ServerException = exceptions.ServerException
+        _client = AcsClient(*_credentials)
+    return _client
+
+
+def ess_request(action):
+    """ Create an ESS request obj (e.g. 'DescribeScalingRules'), importing its module on first use """
+    module = importlib.import_module(
+        "aliyunsdkess.request.v20140828.{}Request".format(action))
+    return getattr(module, action + "Request")()
+
+
+def do_action(req):
+    """ Send a request to aliyun (or the replayed trace) and return the response body """
+    action = req.get_action_name()
+    with _output_lock:
+        _report['api_calls'][action] = _report['api_calls'].get(action,
+                                                                0) + 1
+    started = time.time()
+    try:
+        resp_body = get_client().do_action_with_exception(req)
+    except (ClientException, ServerException):
+        emit({
+            'type': 'api_call',
+            'action': action,
+            'params': request_params(req),
+            'seconds': round(time.time() - started, 3),
+            'error': str(sys.exc_value),
+            'error_code': getattr(sys.exc_value, 'error_code', None),
+        })
+        record_trace({
+            'type': 'call',
+            'action': action,
+            'params': request_params(req),
+            'error': {
+                'class': type(sys.exc_value).__name__,
+                'code': getattr(sys.exc_value, 'error_code', None),
+                'message': getattr(sys.exc_value, 'message',
+                                   str(sys.exc_value)),
+            },
+        })
+        raise
+    emit({
+        'type': 'api_call',
+        'action': action,
+        'params': request_params(req),
+        'seconds': round(time.time() - started, 3),
+    })
+    record_trace({
+        'type': 'call',
+        'action': action,
+        'params': request_params(req),
+        'response': resp_body,
+    })
+    return resp_body
+
+
+def throttle():
+    """ Pause between paginated requests so aliyun doesn't throttle us, a replayed trace doesn't need it """
+    if not isinstance(_client, ReplayClient):
+        time.sleep(1)
+
+
+def request_params(req):
+    """ Parameters of a request, without anything that could hold credentials """
+    params = dict(req.get_query_params() or {})
+    for a in _trace_scrubbed_params:
+        params.pop(a, None)
+    return params
+
+
+def trace_key(action, params):
+    """ Key matching a request with its recorded response """
+    return action + json.dumps(
+        json.loads(json.dumps(params, default=str)), sort_keys=True)
+
+
+def init_trace(args):
+    """
+        Start recording every request, response and prompt answer of this run into --record-trace,
+        the trace starts with the arguments (without the access key), the mode config files and
+        the cache files as they were, so the run can be replayed offline
+    """
+    global _trace
+
+    # Seed of the random choices (e.g. --probe-sync samples) so the replay makes the same ones
+    seed = random.randint(0, 2**31)
+    _random.seed(seed)
+
+    header = {
+        'type': 'header',
+        'version': __version__,
+        'recorded_at': time.time(),
+        'seed': seed,
+        'args': {
+            'mode': args.mode,
+            'region_id': args.region_id,
+            'limit': args.limit,
+            'skip_sync': args.skip_sync,
+            'probe_sync': args.probe_sync,
+            'probe_samples': args.probe_samples,
+            'shard': args.shard,
+            'verbose': args.verbose,
+            'noconfirm': args.noconfirm,
+            'deadline': args.deadline,
+        },
+        'config': {},
+        'caches': {},
+    }
+    for a in mode_config_files():
+        with open(a) as file:
+            header['config'][os.path.basename(a)] = file.read()
+    for a in [cache_file(b) for b in _query_cache_kinds
+              ] + [cache_file('rules', 'meta.json')]:
+        if os.path.exists(a):
+            with open(a) as file:
+                header['caches'][os.path.basename(a)] = file.read()
+
+    try:
+        _trace = open(args.record_trace, "w")
+    except IOError:
+        print "ERROR: Can't write trace {}".format(
+            args.record_trace), sys.exc_value
+        sys.exit(1)
+    print "Recording requests to aliyun into {}".format(args.record_trace)
+    record_trace(header)
+
+
+def record_trace(entry):
+    """ Append an entry to the trace when --record-trace is used """
+    if _trace is not None:
+        with _output_lock:
+            _trace.write(json.dumps(entry, sort_keys=True) + "\n")
+            _trace.flush()
+
+
+def read_trace(trace_file):
+    """ Read the entries of a trace written by --record-trace """
+    try:
+        with open(trace_file) as file:
+            entries = [json.loads(a) for a in file if a.strip()]
+    except (IOError, ValueError):
+        print "ERROR: Can't read trace {}".format(trace_file), sys.exc_value
+        sys.exit(1)
+    if not entries or entries[0].get('type') != 'header':
+        print "ERROR: {} is not a trace written by --record-trace".format(
+            trace_file)
+        sys.exit(1)
+    return entries
+
+
+class ReplayClient(object):
+    """
+        Serves the responses of a recorded trace in place of AcsClient,
+        requests are matched by action and parameters, in the order they were recorded
+    """
+
+    def __init__(self, entries):
+        self.responses = {}
+        self.answers = []
+        self.misses = 0
+        for a in entries:
+            if a['type'] == 'call':
+                self.responses.setdefault(
+                    trace_key(a['action'], a['params']), []).append(a)
+            elif a['type'] == 'prompt':
+                self.answers.append(a)
+
+    def do_action_with_exception(self, req):
+        key = trace_key(req.get_action_name(), request_params(req))
+        try:
+            entry = self.responses[key].pop(0)
+        except (KeyError, IndexError):
+            self.misses += 1
+            raise ClientException("ReplayMiss",
+                                  "Request is not in the trace: " + key)
+        if 'error' in entry:
+            # Traces recorded before the class was kept only have ClientException errors
+            if entry['error'].get('class') == 'ServerException':
+                raise ServerException(entry['error']['code'],
+                                      entry['error']['message'])
+            raise ClientException(entry['error']['code'],
+                                  entry['error']['message'])
+        return entry['response']
+
+    def answer(self, msg):
+        """ Recorded answer of an interactive prompt, no when there's none """
+        if not self.answers or self.answers[0]['message'] != msg:
+            self.misses += 1
+            return False
+        return self.answers.pop(0)['answer']
+
+    def unused(self):
+        """ Number of recorded responses that weren't requested """
+        return sum(len(a) for a in self.responses.values())
+
+
+def describe_pages(req, what):
+    """
+        Send a paginated Describe request page by page and yield every parsed response,
+        what the pages are (e.g. 'scaling groups') is only used in the error message
+    """
     page_size = 50
     page_number = 1
     total_count = -1
 
-    req = DescribeAlarmsRequest.DescribeAlarmsRequest()
-
-    _event_trigger_tasks = {}
     while True:
         req.set_PageSize(page_size)
         req.set_PageNumber(page_number)
         try:
-            time.sleep(1)
-            resp_body = _client.do_action_with_exception(req)
+            throttle()
+            resp_body = do_action(req)
         except ClientException:
-            print "ERROR loading event-trigger tasks from aliyun: API connection issue, please try again"
+            print "ERROR loading {} from aliyun: API connection issue, please try again".format(
+                what)
             print sys.exc_value
             sys.exit()
 
-        resp_yaml = yaml.safe_load(resp_body)
+        resp_yaml = parse_response(resp_body)
         if total_count == -1:
             total_count = int(resp_yaml['TotalCount'])
 
-        for a in resp_yaml['AlarmList']['Alarm']:
-            a['TriggerAfter'] = a['EvaluationCount']
-            a['Condition'] = a['Statistics']
-            a['MetricItem'] = a['MetricName']
-            a['RefreshCycleSeconds'] = a['Period']
-            _event_trigger_tasks[a['Name']] = a
+        yield resp_yaml
 
         total_count -= page_size
         page_number += 1
@@ -149,6 +759,43 @@ def load_event_trigger_tasks():
         if total_count <= 0:
             break
 
+
+def parse_response(resp_body):
+    """ Parse a response body, with the libyaml parser if PyYAML was built with it (pages are parsed while main() reconciles) """
+    return yaml.load(
+        resp_body, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def iter_scaling_rules():
+    """ Yield the scaling rules in aliyun (DescribeScalingRules items of every shard) page by page, with the TotalCount """
+    for resp_yaml in describe_pages(
+            ess_request("DescribeScalingRules"), "current rules"):
+        yield int(resp_yaml['TotalCount']), resp_yaml['ScalingRules'][
+            'ScalingRule']
+
+
+def iter_event_trigger_tasks():
+    """ Yield the event-trigger tasks in aliyun (DescribeAlarms items of every shard) page by page, with the TotalCount """
+    for resp_yaml in describe_pages(
+            ess_request("DescribeAlarms"), "event-trigger tasks"):
+        yield int(resp_yaml['TotalCount']), resp_yaml['AlarmList']['Alarm']
+
+
+def load_event_trigger_tasks():
+    """ Load all existing event-trigger tasks in aliyun and store in global _scaling_groups """
+    global _event_trigger_tasks
+
+    print "Loading event-trigger tasks information from aliyun"
+
+    _event_trigger_tasks = {}
+    for total_count, page in iter_event_trigger_tasks():
+        for a in page:
+            if rule_in_shard(a['Name']):
+                _event_trigger_tasks[a['Name']] = EventTriggerTaskRecord.from_api(
+                    a)
+
+    dump_cache(_event_trigger_tasks, 'event_trigger_tasks')
+
     logging.debug(
         "Loaded Event-trigger Tasks: {}".format(_event_trigger_tasks))
 
@@ -159,63 +806,116 @@ def load_scaling_groups():
 
     print "Loading scaling groups information from aliyun"
 
-    page_size = 50
-    page_number = 1
-    total_count = -1
-
-    req = DescribeScalingGroupsRequest.DescribeScalingGroupsRequest()
-
     _scaling_groups = {}
-    while True:
-        req.set_PageSize(page_size)
-        req.set_PageNumber(page_number)
-        try:
-            time.sleep(1)
-            resp_body = _client.do_action_with_exception(req)
-        except ClientException:
-            print "ERROR loading scaling groups from aliyun: API connection issue, please try again"
-            print sys.exc_value
-            sys.exit()
+    for resp_yaml in describe_pages(
+            ess_request("DescribeScalingGroups"), "scaling groups"):
+        for a in resp_yaml['ScalingGroups']['ScalingGroup']:
+            if not in_shard(a['ScalingGroupName']):
+                continue
+            add_scaling_group(_scaling_groups, a)
 
-        resp_yaml = yaml.safe_load(resp_body)
-        if total_count == -1:
-            total_count = int(resp_yaml['TotalCount'])
+    dump_cache(_scaling_groups, 'scaling_groups')
 
-        for a in resp_yaml['ScalingGroups']['ScalingGroup']:
-            _scaling_groups[a['ScalingGroupName']] = a['ScalingGroupId']
-            _scaling_groups[a['ScalingGroupId']] = {
-                'MinInstance': a['MinSize'],
-                'MaxInstance': a['MaxSize']
-            }
+    logging.debug("Loaded Scaling Groups: {}".format(_scaling_groups))
 
-        total_count -= page_size
-        page_number += 1
 
-        if total_count <= 0:
-            break
+class InventoryLoader(threading.Thread):
+    """
+        Load event-trigger tasks (and scaling rules, if they aren't loaded yet) from aliyun in the background,
+        every page is put into the pages queue as soon as it arrives so main() can reconcile it right away:
+            ('rules', TotalCount, [ScalingRuleRecord, ...])
+            ('event_trigger_tasks', TotalCount, [EventTriggerTaskRecord, ...])
+            ('rules', TotalCount, None) once every page of a kind arrived
+            ('error', sys.exc_info(), None) if loading failed (or exited)
+    """
 
-    logging.debug("Loaded Scaling Groups: {}".format(_scaling_groups))
+    # Generator, ID attribute, name attribute and record builder of each kind
+    kinds = {
+        'rules': (iter_scaling_rules, 'ScalingRuleId', 'ScalingRuleName',
+                  ScalingRuleRecord.from_dict),
+        'event_trigger_tasks': (iter_event_trigger_tasks, 'AlarmTaskId',
+                                'Name', EventTriggerTaskRecord.from_api),
+    }
+
+    # How many times the pages are loaded again when items were missed
+    retries = 2
+
+    def __init__(self, load_rules):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.loading = ['event_trigger_tasks']
+        if load_rules:
+            self.loading.insert(0, 'rules')
+        self.pages = Queue.Queue()
+
+    def run(self):
+        streams = [(a, self.kinds[a][0]()) for a in self.loading]
+        seen = dict((a, set()) for a in self.loading)
+        total_counts = {}
+        retries = dict((a, self.retries) for a in self.loading)
+        try:
+            # Alternate between the kinds, so every scaling rule finds its event-trigger task early
+            while streams:
+                for kind, pages in list(streams):
+                    load, id_attr, name_attr, build = self.kinds[kind]
+                    try:
+                        total_counts[kind], page = next(pages)
+                    except StopIteration:
+                        # Pages shift if something is created or deleted while they load, load them again for the missed ones
+                        if len(seen[kind]) < total_counts[kind] and retries[kind]:
+                            retries[kind] -= 1
+                            logging.debug(
+                                "Loaded {} of {} {}, loading them again".
+                                format(len(seen[kind]), total_counts[kind],
+                                       kind))
+                            streams[streams.index((kind, pages))] = (kind,
+                                                                      load())
+                            continue
+                        streams.remove((kind, pages))
+                        self.pages.put((kind, total_counts[kind], None))
+                        continue
+                    records = []
+                    for a in page:
+                        if a[id_attr] in seen[kind]:
+                            continue
+                        seen[kind].add(a[id_attr])
+                        if rule_in_shard(a[name_attr]):
+                            records.append(build(a))
+                    self.pages.put((kind, total_counts[kind], records))
+        except BaseException:
+            self.pages.put(('error', sys.exc_info(), None))
+
+
+def mode_config_files():
+    """ Config files of the selected mode """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+    config_path = os.path.join(_config_dir or os.path.join(
+        __location__, 'config'), _mode, '*.yaml')
+    return glob.glob(config_path)
 
 
-def load_mode_config():
+def load_mode_config(quiet=False):
     """ Load mode config from the selected mode yaml file into global _config variable """
     global _config
 
-    print "Loading selected mode config from config/" + _mode + "/*.yaml"
-    __location__ = os.path.realpath(
-        os.path.join(os.getcwd(), os.path.dirname(__file__)))
-    config_path = os.path.join(__location__, 'config/' + _mode + '/*.yaml')
+    if not quiet:
+        print "Loading selected mode config from config/" + _mode + "/*.yaml"
     try:
-        for a in glob.glob(config_path):
+        for a in mode_config_files():
             with open(a) as file:
                 _partial_config = yaml.safe_load(file)
                 for b in _partial_config:
+                    # Default rules are needed by every shard
+                    if b.find("default-") == -1 and not rule_in_shard(b):
+                        continue
                     _config[b] = _partial_config[b]
 
         # Check config for possible typo
         # Current checks:
         #   1. Downscale rule must have negative value (this is how aliyun differentiate 'Increase by' with 'Decrease by')
         #   2. MinInstance value must be at least 2
+        #   3. Priority must be a number
 
         for a in _config:
             # Check 1: Downscale rule must have negative 'AdjustmentValue'
@@ -231,6 +931,12 @@ def load_mode_config():
                         a)
                     sys.exit(1)
 
+            # Check 3: Priority must be a number
+            if 'Priority' in _config[a]:
+                if not isinstance(_config[a]['Priority'], (int, float)):
+                    print "ERROR {}: Priority must be a number".format(a)
+                    sys.exit(1)
+
     except IOError:
         print _mode, "Config file not found"
         print sys.exc_value
@@ -239,25 +945,39 @@ def load_mode_config():
     logging.debug("Loaded Config {}/*.yaml: {}".format(_mode, _config))
 
 
-def load_current_rules():
-    """ Load current rules from aliyun or cached_rules.yaml file into global _current_rules variable """
-    global _current_rules
-
-    __location__ = os.path.realpath(
-        os.path.join(os.getcwd(), os.path.dirname(__file__)))
-    if _skip_sync is True:
+def load_current_rules(stream=False):
+    """
+        Load current rules from aliyun or cached_rules.yaml file into global _current_rules variable,
+        with stream=True the rules from aliyun are left to the InventoryLoader and False is returned
+    """
+    global _current_rules, _rules_synced_recently
+
+    synced_ago = rules_cache_age()
+    if _cache_max_age and synced_ago is not None and synced_ago < _cache_max_age:
+        print "Loading current rules from cached_rules.yaml, synced from aliyun {:.0f}s ago".format(
+            synced_ago)
+        _current_rules = load_cache('rules')
+        _rules_synced_recently = True
+    elif _probe_sync is True:
+        print "Loading current rules from cached_rules.yaml, probing aliyun for changes"
+        _current_rules = probe_current_rules()
+    elif _skip_sync is True:
         print "Loading current rules from cached_rules.yaml (not using real-time data from aliyun)"
         try:
-            with open(os.path.join(__location__, 'cached_rules.yaml')) as file:
-                _current_rules = yaml.safe_load(file)
+            _current_rules = load_cache('rules')
         except:
             print "The file cached_rules.yaml not found, syncing from aliyun anyway"
             _current_rules = reconstruct_current_rules_cache()
+    elif stream:
+        print "Loading current rules from aliyun page by page, reconciling them as they arrive (cached_rules.yaml is ignored)"
+        _current_rules = {}
+        return False
     else:
         print "Loading current rules from aliyun (cached_rules.yaml is ignored)"
         _current_rules = reconstruct_current_rules_cache()
 
     logging.debug("Loaded current rules: {}".format(_current_rules))
+    return True
 
 
 def reconstruct_current_rules_cache():
@@ -272,111 +992,289 @@ def reconstruct_current_rules_cache():
                 ScalingRuleAri: ari:acs:ess:ap-southeast-1:12345:scalingrule/asr-blabla
                 ScalingRuleId: asr-blabla
                 ScalingRuleName: galadriel-banner-upscale
+                Fingerprint: 5f0c6b1e...
             ...
     """
-    page_size = 50
-    page_number = 1
-    total_count = -1
+    rules = {}
+    for remote_total_count, page in iter_scaling_rules():
+        for a in page:
+            if rule_in_shard(a['ScalingRuleName']):
+                rule = ScalingRuleRecord.from_dict(a)
+                rules[rule.ScalingRuleName] = rule
 
-    req = DescribeScalingRulesRequest.DescribeScalingRulesRequest()
+    # Saving current rules from aliyun into cached_rules.yaml
+    dump_cache(rules, 'rules')
+    dump_rules_total_count(remote_total_count)
 
-    rules = {}
-    while True:
-        req.set_PageSize(page_size)
-        req.set_PageNumber(page_number)
+    return rules
+
+
+def dump_rules_total_count(total_count):
+    """ Remember how many scaling rules aliyun had when cached_rules.yaml was synced, --probe-sync compares it """
+    try:
+        with open(cache_file('rules', 'meta.json'), "w") as file:
+            json.dump({
+                'TotalCount': total_count,
+                'SyncedAt': time.time()
+            }, file)
+    except IOError:
+        print "Error dumping the scaling rules count into {}".format(
+            os.path.basename(cache_file('rules', 'meta.json'))), sys.exc_value
+        return
+    push_remote_cache(cache_file('rules', 'meta.json'))
+
+
+def rules_cache_age():
+    """ Seconds since cached_rules.yaml was synced from aliyun, None if unknown """
+    try:
+        with open(cache_file('rules', 'meta.json')) as file:
+            return time.time() - float(json.load(file)['SyncedAt'])
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def probe_current_rules():
+    """
+        Check cached_rules.yaml against aliyun with a few cheap requests instead of
+        downloading every scaling rule again:
+            1. TotalCount of a page-size-1 DescribeScalingRules against the cached count
+            2. A random sample of cached rules, fetched by ID, against their cached fingerprint
+        Rules of scaling groups that no longer exist are dropped, and only the scaling groups
+        found stale (sampled rule changed, or new group while the count differs) are synced again.
+        Everything is synced again if the count still doesn't add up after that
+    """
+    try:
+        rules = load_cache('rules')
+        with open(cache_file('rules', 'meta.json')) as file:
+            cached_total_count = int(json.load(file)['TotalCount'])
+    except (IOError, ValueError, KeyError, TypeError):
+        print "No scaling rules count cached to probe against, syncing from aliyun anyway"
+        return reconstruct_current_rules_cache()
+
+    try:
+        req = ess_request("DescribeScalingRules")
+        req.set_PageSize(1)
+        total_count = int(yaml.safe_load(do_action(req))['TotalCount'])
+
+        sample = _random.sample(
+            sorted(rules.values(), key=lambda a: a.ScalingRuleName),
+            min(_probe_samples, len(rules)))
+        stale_groups = set(probe_sampled_rules(sample))
+    except ClientException:
+        print "ERROR probing current rules in aliyun: API connection issue, please try again"
+        print sys.exc_value
+        sys.exit()
+
+    # Scaling groups were just loaded from aliyun, compare them with the cached rules' groups
+    cached_groups = set(a.ScalingGroupId for a in rules.values())
+    current_groups = set(a for a in _scaling_groups
+                         if isinstance(_scaling_groups[a], ScalingGroupRecord))
+    expected_total_count = cached_total_count
+    for a in rules.keys():
+        if rules[a].ScalingGroupId not in current_groups:
+            del rules[a]
+            expected_total_count -= 1
+    if total_count != expected_total_count or stale_groups:
+        stale_groups |= current_groups - cached_groups
+    stale_groups &= current_groups
+
+    for a in sorted(stale_groups):
         try:
-            time.sleep(1)
-            resp_body = _client.do_action_with_exception(req)
+            throttle()
+            synced = load_scaling_group_rules(a)
         except ClientException:
-            print "ERROR getting current rules from aliyun: API connection issue, please try again"
+            print "ERROR syncing scaling rules of {} from aliyun: API connection issue, please try again".format(
+                a)
             print sys.exc_value
             sys.exit()
+        for b in [b for b in rules if rules[b].ScalingGroupId == a]:
+            del rules[b]
+            expected_total_count -= 1
+        for b in synced:
+            expected_total_count += 1
+            if rule_in_shard(b.ScalingRuleName):
+                rules[b.ScalingRuleName] = b
+
+    _report['probe'] = {
+        'total_count': total_count,
+        'cached_total_count': cached_total_count,
+        'sampled': len(sample),
+        'stale_scaling_groups': sorted(stale_groups),
+    }
+    print "Probed {} sampled rules and the total count ({} in aliyun, {} cached), {} stale scaling groups synced again".format(
+        len(sample), total_count, cached_total_count, len(stale_groups))
+
+    if total_count != expected_total_count:
+        print "Scaling rules count still doesn't add up ({} expected), syncing everything from aliyun".format(
+            expected_total_count)
+        return reconstruct_current_rules_cache()
+
+    dump_cache(rules, 'rules')
+    dump_rules_total_count(total_count)
 
-        resp_yaml = yaml.safe_load(resp_body)
-        if total_count == -1:
-            total_count = int(resp_yaml['TotalCount'])
+    return rules
 
-        for a in resp_yaml['ScalingRules']['ScalingRule']:
-            rules[a['ScalingRuleName']] = a
 
-        total_count -= page_size
-        page_number += 1
+def probe_sampled_rules(sample):
+    """ Fetch sampled cached rules by ID (10 per request) and return the scaling groups of those that changed """
+    stale_groups = []
+    for a in range(0, len(sample), 10):
+        batch = sample[a:a + 10]
+        req = ess_request("DescribeScalingRules")
+        req.set_PageSize(10)
+        for b, rule in enumerate(batch):
+            getattr(req, "set_ScalingRuleId{}".format(b + 1))(
+                str(rule.ScalingRuleId))
+
+        found = {}
+        for b in yaml.safe_load(
+                do_action(req))['ScalingRules']['ScalingRule']:
+            found[b['ScalingRuleId']] = ScalingRuleRecord.from_dict(b)
+
+        for rule in batch:
+            current_rule = found.get(rule.ScalingRuleId)
+            if current_rule is None:
+                stale_groups.append(rule.ScalingGroupId)
+            elif (current_rule.ScalingRuleName, current_rule.ScalingGroupId
+                  ) != (rule.ScalingRuleName, rule.ScalingGroupId
+                        ) or not same_fingerprint(current_rule.Fingerprint,
+                                                  rule.Fingerprint):
+                stale_groups.extend(
+                    [rule.ScalingGroupId, current_rule.ScalingGroupId])
+    return stale_groups
+
+
+def load_scaling_group_rules(scaling_group_id):
+    """ Load every scaling rule of one scaling group from aliyun """
+    page_size = 50
+    page_number = 1
+    rules = []
 
-        if total_count <= 0:
+    req = ess_request("DescribeScalingRules")
+    req.set_ScalingGroupId(scaling_group_id)
+    while True:
+        req.set_PageSize(page_size)
+        req.set_PageNumber(page_number)
+        resp_yaml = yaml.safe_load(do_action(req))
+        for a in resp_yaml['ScalingRules']['ScalingRule']:
+            rules.append(ScalingRuleRecord.from_dict(a))
+        if page_number * page_size >= int(resp_yaml['TotalCount']):
             break
+        page_number += 1
+    return rules
 
-    # Saving current rules from aliyun into cached_rules.yaml
-    dump_current_rules(rules, 'cached_rules.yaml')
 
-    return rules
+def modify_alarm_setters():
+    """
+        Attributes that ModifyAlarm can change in place with the installed SDK,
+        mapped to their request setter (see _modify_alarm_capabilities)
+    """
+    global _modify_alarm_setters
+    if _modify_alarm_setters is None:
+        req = ess_request("ModifyAlarm")
+        _modify_alarm_setters = {}
+        for a in _modify_alarm_capabilities:
+            for b in _modify_alarm_capabilities[a]:
+                if hasattr(req, b):
+                    _modify_alarm_setters[a] = b
+                    break
+    return _modify_alarm_setters
+
+
+def event_trigger_task_diff(scaling_rule_name, new_rule):
+    """
+        Attributes of an existing event-trigger task that differ from the new rule,
+        'AlarmActions' is included when the task doesn't point at the scaling rule
+        (unknown AlarmActions, missing from DescribeAlarms, aren't treated as a change)
+    """
+    current_rule = _event_trigger_tasks[scaling_rule_name]
+    changed = []
 
+    if not same_fingerprint(
+            event_trigger_task_fingerprint(new_rule),
+            current_rule["Fingerprint"]):
+        for a in _event_trigger_task_attr:
+            new_value = canonical_value(a, new_rule.get(a))
+            if new_value is None or new_value != canonical_value(
+                    a, current_rule.get(a)):
+                changed.append(a)
 
-def modify_event_trigger_task(scaling_rule_name):
-    # WEIRD ModifyAlarmRequest can't modify most attributes,
-    # wait till aliyun dev update their API
+    alarm_actions = current_rule["AlarmActions"]
+    scaling_rule_ari = _current_rules.get(scaling_rule_name,
+                                          {}).get("ScalingRuleAri")
+    if current_rule.get("bypass_skip") or (
+            alarm_actions is not None and scaling_rule_ari not in alarm_actions):
+        changed.append("AlarmActions")
 
+    return changed
+
+
+def modify_event_trigger_task(scaling_rule_name, changed):
+    """
+        Modify the changed attributes of an existing event-trigger task in place,
+        only call this when modify_alarm_setters() covers every changed attribute
+    """
     new_rule = get_rule(scaling_rule_name)
     if not new_rule:
         return False
 
-    # Compare old and new rule, skip is nothing was changed
-    skip = True
     current_rule = _event_trigger_tasks[scaling_rule_name]
-    event_trigger_task_attr = [
-        "MetricItem", "Condition", "ComparisonOperator", "Threshold",
-        "TriggerAfter", "RefreshCycleSeconds"
-    ]
-    for a in event_trigger_task_attr:
-        try:
-            if new_rule[a] != current_rule[a]:
-                skip = False
-                break
-        except KeyError:
-            skip = False
-            break
-
-    if skip is True:
-        print "SKIPPED '{}': No difference between the current and the new event trigger task rule".format(
-            scaling_rule_name)
-        return True
-
+    setters = modify_alarm_setters()
     try:
         # Create request obj
-        req = ModifyAlarmRequest.ModifyAlarmRequest()
+        req = ess_request("ModifyAlarm")
 
         # Setting request parameters
         # Necessary: Yes, to specify the Event-trigger Task to modify
-        req.set_AlarmTaskId(
-            _event_trigger_tasks[scaling_rule_name]["AlarmTaskId"])
-        req.set_Name(scaling_rule_name)
-        # req.set_MetricName(str(new_rule["MetricItem"]))
-        # req.set_Statistics(str(new_rule["Condition"]))
-        # req.set_ComparisionOperator(str(new_rule["ComparisonOperator"]))
-        # req.set_Threshold(new_rule["Threshold"])
-        alarm_actions = []
-        alarm_actions.append(
-            str(_current_rules[scaling_rule_name]["ScalingRuleAri"]))
-        req.set_AlarmActions(alarm_actions)
-
-        # Necessary: No, to set other values we want
-        # req.set_EvaluationCount(new_rule["TriggerAfter"])
+        req.set_AlarmTaskId(str(current_rule["AlarmTaskId"]))
+
+        # Necessary: No, only the attributes that changed
+        for a in changed:
+            if a == "AlarmActions":
+                value = [
+                    str(_current_rules[scaling_rule_name]["ScalingRuleAri"])
+                ]
+            elif a in _numeric_attr:
+                value = new_rule[a]
+            else:
+                value = str(new_rule[a])
+            getattr(req, setters[a])(value)
 
         # Send the modify request
-        _client.do_action_with_exception(req)
-
-        print "CHANGED '{}': Successfully modified event trigger task".format(
-            scaling_rule_name)
+        snapshot_change(
+            'event_trigger_task', scaling_rule_name,
+            dict((a, current_rule[a]) for a in changed),
+            AlarmTaskId=current_rule["AlarmTaskId"])
+        do_action(req)
+
+        # Apply changes into _event_trigger_tasks too so we can cache it
+        for a in changed:
+            if a == "AlarmActions":
+                current_rule["AlarmActions"] = tuple(value)
+            else:
+                current_rule[a] = new_rule[a]
+        current_rule["Fingerprint"] = event_trigger_task_fingerprint(
+            current_rule)
+        current_rule["bypass_skip"] = False
+
+        report(
+            "CHANGED", scaling_rule_name,
+            "Successfully modified event trigger task in place ({})".format(
+                ", ".join(changed)))
+        logging.debug("Modified Event-trigger Task {} ({}): {}".format(
+            scaling_rule_name, ", ".join(changed), new_rule))
 
         return True
     except ClientException:
-        print "ERROR '{}': API connection issue, please try again".format(
-            scaling_rule_name)
+        report("ERROR", scaling_rule_name,
+               "API connection issue, please try again")
         print sys.exc_value
         print ""
         return False
     except:
-        print "ERROR in modifying event trigger task {}: {}".format(
-            scaling_rule_name, sys.exc_info())
+        report(
+            "ERROR", scaling_rule_name,
+            "Failed modifying event trigger task: {}".format(sys.exc_info()))
         return False
 
 
@@ -397,68 +1295,74 @@ def delete_event_trigger_task(scaling_rule_name):
 
     if not existed:
         if _verbose:
-            print "ERROR '{}': Event trigger task don't exists, can't delete it".format(
-                scaling_rule_name)
+            report("ERROR", scaling_rule_name,
+                   "Event trigger task don't exists, can't delete it")
         return True
 
     try:
-        req = DeleteAlarmRequest.DeleteAlarmRequest()
+        req = ess_request("DeleteAlarm")
 
         req.set_AlarmTaskId(str(current_rule['AlarmTaskId']))
 
-        _client.do_action_with_exception(req)
+        snapshot_change('deleted_event_trigger_task', scaling_rule_name,
+                        current_rule, *_snapshot_alarm_fields)
+        do_action(req)
+        del _event_trigger_tasks[scaling_rule_name]
 
-        print "CHANGED '{}': Deleted event trigger task".format(
-            scaling_rule_name)
+        report("CHANGED", scaling_rule_name, "Deleted event trigger task")
         logging.debug("Deleted Event-trigger task: {}".format(current_rule))
 
         return True
     except ClientException:
-        print "ERROR '{}': API connection issue, please try again".format(
-            scaling_rule_name)
+        report("ERROR", scaling_rule_name,
+               "API connection issue, please try again")
         print sys.exc_value
         print ""
         return False
     except:
-        print "ERROR in deleting event trigger task {}: {}".format(
-            scaling_rule_name, sys.exc_info())
+        report(
+            "ERROR", scaling_rule_name,
+            "Failed deleting event trigger task: {}".format(sys.exc_info()))
         return False
 
 
 def disable_event_trigger_task(event_trigger_task_id):
     """ Disable specific Event-trigger task by ID """
     try:
-        req = DisableAlarmRequest.DisableAlarmRequest()
+        req = ess_request("DisableAlarm")
 
         req.set_AlarmTaskId(str(event_trigger_task_id))
 
-        _client.do_action_with_exception(req)
+        do_action(req)
 
-        print "CHANGED: Disabled the event trigger task according to the old one"
+        report("CHANGED", event_trigger_task_id,
+               "Disabled the event trigger task according to the old one")
         logging.debug(
             "Disabled Event-trigger Task: {}".format(event_trigger_task_id))
 
         return True
     except ClientException:
-        print "ERROR '{}': API connection issue, please try again".format(
-            event_trigger_task_id)
+        report("ERROR", event_trigger_task_id,
+               "API connection issue, please try again")
         print sys.exc_value
         print ""
         return False
     except:
-        print "ERROR in disabling event trigger task {}: {}".format(
-            event_trigger_task_id, sys.exc_info())
+        report(
+            "ERROR", event_trigger_task_id,
+            "Failed disabling event trigger task: {}".format(sys.exc_info()))
         return False
 
 
 def create_event_trigger_task(scaling_rule_name):
     """
-        Because aliyun API doesn't support modifying an event trigger task,
+        Because aliyun API can only modify some attributes of an event trigger task,
         we will do it this way, there are 2 scenarios:
             1. Creating an existing task in aliyun,
                 we check if the attributes is different,
                 if they're the same, we skip it,
-                if they differ, we use the delete API to delete it after the new one has been created
+                if ModifyAlarm can change all of the different attributes, we modify it in place,
+                otherwise we use the delete API to delete it after the new one has been created
                 creating the new event trigger task
             2. Creating a new one, proceed as usual
     """
@@ -478,26 +1382,16 @@ def create_event_trigger_task(scaling_rule_name):
     skip = True
     delete_after = False
     enable = True
-    event_trigger_task_attr = [
-        "MetricItem", "Condition", "ComparisonOperator", "Threshold",
-        "TriggerAfter", "RefreshCycleSeconds"
-    ]
     if existed:
-        try:
-            if len(current_rule["alarmActions"]
-                   ["alarmAction"]) == 0 or current_rule["bypass_skip"]:
-                skip = False
-        except KeyError:
-            pass
+        changed = event_trigger_task_diff(scaling_rule_name, new_rule)
+        if changed:
+            skip = False
+
+            # One in-place call instead of create, (disable) and delete
+            setters = modify_alarm_setters()
+            if all(a in setters for a in changed):
+                return modify_event_trigger_task(scaling_rule_name, changed)
 
-        for a in event_trigger_task_attr:
-            try:
-                if new_rule[a] != current_rule[a]:
-                    skip = False
-                    break
-            except KeyError:
-                skip = False
-                break
         # The rules differ, we have to remember to delete the existing rule after creating a new one
         if not skip:
             if not current_rule["Enable"]:
@@ -507,73 +1401,99 @@ def create_event_trigger_task(scaling_rule_name):
         skip = False
 
     if skip is True:
-        print "SKIPPED '{}': No difference between the current and the new event trigger task rule".format(
-            scaling_rule_name)
+        report("SKIPPED", scaling_rule_name,
+               "No difference between the current and the new event trigger task rule")
         return True
 
     # Finally, if skip is False, then we f'ing do it
     try:
-        # Create request obj
-        req = CreateAlarmRequest.CreateAlarmRequest()
-
-        # Setting request parameters
-        # Necessary: Yes, to specify the rule and which scaling group to attach the rule to
-        req.set_Name(scaling_rule_name)
-        req.set_ScalingGroupId(
-            _current_rules[scaling_rule_name]["ScalingGroupId"])
-        req.set_MetricName(str(new_rule["MetricItem"]))
-        req.set_Statistics(str(new_rule["Condition"]))
-        req.set_ComparisonOperator(str(new_rule["ComparisonOperator"]))
-        req.set_Threshold(new_rule["Threshold"])
-        alarm_actions = []
-        alarm_actions.append(
-            str(_current_rules[scaling_rule_name]["ScalingRuleAri"]))
-        req.set_AlarmActions(alarm_actions)
-
-        # Necessary: No, to set other values we want
-        req.set_EvaluationCount(new_rule["TriggerAfter"])
-        req.set_Period(new_rule["RefreshCycleSeconds"])
+        req = create_alarm_request(
+            scaling_rule_name,
+            _current_rules[scaling_rule_name]["ScalingGroupId"], new_rule,
+            [str(_current_rules[scaling_rule_name]["ScalingRuleAri"])])
 
         # Send the modify request
-        resp_body = _client.do_action_with_exception(req)
+        resp_body = do_action(req)
         resp_yaml = yaml.safe_load(resp_body)
+        snapshot_change('created_event_trigger_task', scaling_rule_name,
+                        resp_yaml, 'AlarmTaskId')
 
-        print "CHANGED '{}': Successfully created event trigger task".format(
-            scaling_rule_name)
+        report("CHANGED", scaling_rule_name,
+               "Successfully created event trigger task")
         logging.debug("Created Event-trigger Task {}: {}".format(
             scaling_rule_name, new_rule))
 
         # Existing task was disabled, so we also disable the newly created one
         if not enable:
             if not disable_event_trigger_task(resp_yaml["AlarmTaskId"]):
-                print "ERROR '{}': Failed to disable newly created task (old task was disabled), send help, disable them manually".format(
-                    scaling_rule_name)
+                report("ERROR", scaling_rule_name,
+                       "Failed to disable newly created task (old task was disabled), send help, disable them manually")
+                enable = True
 
         # We delete the old one to prevent duplicate task in aliyun
+        deleted = True
         if delete_after:
             print "Deleting old '{}' event trigger task".format(
                 scaling_rule_name)
-            if not delete_event_trigger_task(scaling_rule_name):
-                print "ERROR '{}': Failed to delete old task, there will be duplicate task, send help, delete them manually".format(
-                    scaling_rule_name)
-                return False
+            deleted = delete_event_trigger_task(scaling_rule_name)
+
+        # Add the new one into _event_trigger_tasks too so we can cache it
+        fields = dict((a, new_rule.get(a)) for a in _event_trigger_task_attr)
+        fields.update({
+            'Name': scaling_rule_name,
+            'AlarmTaskId': resp_yaml["AlarmTaskId"],
+            'ScalingGroupId': _current_rules[scaling_rule_name]["ScalingGroupId"],
+            'Enable': enable,
+            'AlarmActions': [_current_rules[scaling_rule_name]["ScalingRuleAri"]],
+            'valid_name': True,
+        })
+        task = EventTriggerTaskRecord.from_dict(fields)
+        task.Fingerprint = event_trigger_task_fingerprint(task)
+        _event_trigger_tasks[scaling_rule_name] = task
+
+        if not deleted:
+            report("ERROR", scaling_rule_name,
+                   "Failed to delete old task, there will be duplicate task, send help, delete them manually")
+            return False
 
         return True
     except ClientException:
-        print "ERROR '{}': API connection issue, please try again".format(
-            scaling_rule_name)
+        report("ERROR", scaling_rule_name,
+               "API connection issue, please try again")
         print sys.exc_value
         print ""
         return False
     except:
-        print "ERROR in creating event trigger task {}: {}".format(
-            scaling_rule_name, sys.exc_info())
+        report(
+            "ERROR", scaling_rule_name,
+            "Failed creating event trigger task: {}".format(sys.exc_info()))
         return False
 
 
-def rule_type(rule_name):
-    """ Returns 1 for upscale rule, 0 for downscale rule, -1 for unrecognized rule """
-    # TODO: Use enumeration type to support more type in the future (in case we want more than just an upscale or downscale rule)
+def create_alarm_request(name, scaling_group_id, rule, alarm_actions):
+    """ CreateAlarm request of an event-trigger task with the attributes of a rule (config or cached task) """
+    # Create request obj
+    req = ess_request("CreateAlarm")
+
+    # Setting request parameters
+    # Necessary: Yes, to specify the rule and which scaling group to attach the rule to
+    req.set_Name(name)
+    req.set_ScalingGroupId(scaling_group_id)
+    req.set_MetricName(str(rule["MetricItem"]))
+    req.set_Statistics(str(rule["Condition"]))
+    req.set_ComparisonOperator(str(rule["ComparisonOperator"]))
+    req.set_Threshold(rule["Threshold"])
+    req.set_AlarmActions(alarm_actions)
+
+    # Necessary: No, to set other values we want
+    req.set_EvaluationCount(rule["TriggerAfter"])
+    req.set_Period(rule["RefreshCycleSeconds"])
+    return req
+
+
+def rule_type(rule_name):
+    """ Returns 1 for upscale rule, 0 for downscale rule, -1 for unrecognized rule """
+    # TODO: Use enumeration type to support more type in the future (in case we want more than just an upscale or downscale rule)
     if rule_name.find("-upscale") != -1:
         return 1
     elif rule_name.find("-downscale") != -1:
@@ -590,7 +1510,7 @@ def create_and_attach_scaling_rule(scaling_rule_name, scaling_group_name):
 
     try:
         # Create request obj
-        req = CreateScalingRuleRequest.CreateScalingRuleRequest()
+        req = ess_request("CreateScalingRule")
 
         # Setting request parameters
         # Necessary: Yes, to specify the rule and which scaling group to attach the rule to
@@ -603,24 +1523,28 @@ def create_and_attach_scaling_rule(scaling_rule_name, scaling_group_name):
         req.set_ScalingRuleName(scaling_rule_name)
 
         # Send the modify request
-        _client.do_action_with_exception(req)
-
-        print "CHANGED '{}': Created scaling rule and attached it to scaling group '{}'".format(
-            scaling_rule_name, scaling_group_name)
+        resp_yaml = yaml.safe_load(do_action(req))
+        snapshot_change('created_scaling_rule', scaling_rule_name, resp_yaml,
+                        'ScalingRuleId')
+
+        report(
+            "CHANGED", scaling_rule_name,
+            "Created scaling rule and attached it to scaling group '{}'".
+            format(scaling_group_name))
         logging.debug(
             "Created Scaling Rule and attached it to Scaling Group {}: {}".
             format(scaling_group_name, new_rule))
 
         return True
     except ClientException:
-        print "ERROR '{}': API connection issue, please try again".format(
-            scaling_rule_name)
+        report("ERROR", scaling_rule_name,
+               "API connection issue, please try again")
         print sys.exc_value
         print ""
         return False
     except:
-        print "ERROR '{}'@'{}': {}".format(scaling_rule_name,
-                                           scaling_group_name, sys.exc_info)
+        report("ERROR", scaling_rule_name, "@'{}': {}".format(
+            scaling_group_name, sys.exc_info()))
         return False
 
 
@@ -638,12 +1562,57 @@ def get_rule(scaling_rule_name):
         elif rule_type(scaling_rule_name) == 0:
             new_rule = _config['default-downscale']
         else:
-            print "SKIPPED '{}': Can't determine whether that's an upscale or downscale rule".format(
-                scaling_rule_name)
+            report("SKIPPED", scaling_rule_name,
+                   "Can't determine whether that's an upscale or downscale rule")
             return None
     return new_rule
 
 
+def canonical_value(attr, value):
+    """
+        Normalize an attribute value so config and aliyun values can be compared,
+        e.g. 60, 60.0 and "60" are the same Threshold, "=>", "GE" and ">=" are the same operator.
+        Other values keep their case, aliyun's metric names and enums (e.g. AdjustmentType) are case-sensitive
+    """
+    if value is None:
+        return None
+
+    if attr == "ComparisonOperator":
+        operator = str(value).strip()
+        return _comparison_operator_aliases.get(operator.lower(), operator)
+
+    if attr in _numeric_attr:
+        try:
+            return repr(float(value))
+        except (TypeError, ValueError):
+            pass
+
+    return str(value).strip()
+
+
+def fingerprint(rule, attrs):
+    """ Hash the canonical values of the given attributes, None if one is missing """
+    canonical = [(a, canonical_value(a, rule.get(a))) for a in attrs]
+    if any(b is None for a, b in canonical):
+        return None
+    return hashlib.sha1(repr(canonical)).hexdigest()
+
+
+def same_fingerprint(a, b):
+    """ Whether two fingerprints match, a missing attribute (no fingerprint) is always a change """
+    return a is not None and a == b
+
+
+def scaling_rule_fingerprint(rule):
+    """ Fingerprint of a scaling rule, either from config or from aliyun """
+    return fingerprint(rule, _scaling_rule_attr)
+
+
+def event_trigger_task_fingerprint(rule):
+    """ Fingerprint of an event-trigger task, either from config or from aliyun """
+    return fingerprint(rule, _event_trigger_task_attr)
+
+
 def modify_scaling_rule(scaling_rule_name):
     """ Modify a scaling rule in aliyun. Will skip if no value has been changed """
     new_rule = get_rule(scaling_rule_name)
@@ -651,30 +1620,20 @@ def modify_scaling_rule(scaling_rule_name):
         return False
 
     # Compare old and new rule, skip is nothing was changed
-    skip = True
     try:
         current_rule = _current_rules[scaling_rule_name]
     except KeyError:
         print scaling_rule_name, "config does not exists in aliyun"
         return False
-    scaling_rule_attr = ["AdjustmentType", "AdjustmentValue", "Cooldown"]
-    for a in scaling_rule_attr:
-        try:
-            if new_rule[a] != current_rule[a]:
-                skip = False
-                break
-        except KeyError:
-            skip = False
-            break
-
-    if skip is True:
-        print "SKIPPED '{}': No difference between the current and the new rule".format(
-            scaling_rule_name)
+    new_fingerprint = scaling_rule_fingerprint(new_rule)
+    if same_fingerprint(new_fingerprint, current_rule['Fingerprint']):
+        report("SKIPPED", scaling_rule_name,
+               "No difference between the current and the new rule")
         return True
 
     try:
         # Create request obj
-        req = ModifyScalingRuleRequest.ModifyScalingRuleRequest()
+        req = ess_request("ModifyScalingRule")
 
         # Setting request parameters
         # Necessary: Yes, to specify which scaling rules in aliyun that we're changing
@@ -687,7 +1646,9 @@ def modify_scaling_rule(scaling_rule_name):
         req.set_Cooldown(new_rule['Cooldown'])
 
         # Send the modify request
-        _client.do_action_with_exception(req)
+        snapshot_change('scaling_rule', scaling_rule_name, current_rule,
+                        'ScalingRuleId', *_scaling_rule_attr)
+        do_action(req)
 
         # Apply changes into _current_rules too so we can cache it
         _current_rules[scaling_rule_name]['AdjustmentType'] = new_rule[
@@ -695,9 +1656,10 @@ def modify_scaling_rule(scaling_rule_name):
         _current_rules[scaling_rule_name]['AdjustmentValue'] = new_rule[
             'AdjustmentValue']
         _current_rules[scaling_rule_name]['Cooldown'] = new_rule['Cooldown']
+        _current_rules[scaling_rule_name]['Fingerprint'] = new_fingerprint
 
-        print "CHANGED '{}': Successfully modified the scaling rule".format(
-            scaling_rule_name)
+        report("CHANGED", scaling_rule_name,
+               "Successfully modified the scaling rule")
         logging.debug(
             "Modified Scaling Rule {}:\nOLD => {}\n\nNEW => {}".format(
                 scaling_rule_name, current_rule, new_rule))
@@ -706,32 +1668,398 @@ def modify_scaling_rule(scaling_rule_name):
     except KeyError:
         global _skip_sync
         if _skip_sync is True:
-            print "WARNING '{}': Scaling rule does not exist, try running the script without --skip-sync flag".format(
-                scaling_rule_name)
+            report("WARNING", scaling_rule_name,
+                   "Scaling rule does not exist, try running the script without --skip-sync flag")
         else:
-            print "WARNING '{}': Scaling rule does not exist in aliyun, have you created the scaling rule in aliyun?".format(
-                scaling_rule_name)
+            report("WARNING", scaling_rule_name,
+                   "Scaling rule does not exist in aliyun, have you created the scaling rule in aliyun?")
         return False
     except ClientException:
-        print "ERROR '{}': API connection issue, please try again".format(
-            scaling_rule_name)
+        report("ERROR", scaling_rule_name,
+               "API connection issue, please try again")
         print sys.exc_value
         print ""
         return False
     except:
-        print "ERROR '{}': {}".format(scaling_rule_name, sys.exc_info)
+        report("ERROR", scaling_rule_name, str(sys.exc_info()))
         return False
 
 
-def dump_current_rules(rules, cache_path):
-    """ Save _current_rules into cache file """
+def dump_cache(data, kind):
+    """ Save loaded rules, scaling groups or event-trigger tasks into their cache file """
+    data = dict((a, b.as_dict() if isinstance(b, Record) else b)
+                for a, b in data.items())
     try:
-        __location__ = os.path.realpath(
-            os.path.join(os.getcwd(), os.path.dirname(__file__)))
-        with open(os.path.join(__location__, cache_path), "w") as file:
-            yaml.dump(rules, file, default_flow_style=False)
+        with open(cache_file(kind), "w") as file:
+            yaml.dump(data, file, default_flow_style=False)
     except:
-        print "Error dumping current rules into cached_rules.yaml", sys.exc_value
+        print "Error dumping current {} into {}".format(
+            kind, os.path.basename(cache_file(kind))), sys.exc_value
+        return
+    push_remote_cache(cache_file(kind))
+
+
+def load_cache(kind):
+    """ Load rules, scaling groups or event-trigger tasks from their cache file into records """
+    with open(cache_file(kind)) as file:
+        data = yaml.safe_load(file) or {}
+
+    records = {}
+    for a in data:
+        if kind == 'rules':
+            records[intern_name(a)] = ScalingRuleRecord.from_dict(data[a])
+        elif kind == 'event_trigger_tasks':
+            records[intern_name(a)] = EventTriggerTaskRecord.from_dict(
+                data[a])
+        elif isinstance(data[a], dict):
+            records[intern_name(a)] = ScalingGroupRecord.from_dict(data[a])
+        else:
+            records[intern_name(a)] = intern_name(data[a])
+    return records
+
+
+def cache_file(kind, extension='yaml'):
+    """
+        Path of the cache file of 'rules', 'scaling_groups' or 'event_trigger_tasks',
+        every shard keeps its own cache so they don't overwrite each other
+    """
+    __location__ = _cache_dir or os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+    if _shard:
+        name = 'cached_{}.shard-{}-of-{}.{}'.format(kind, _shard[0],
+                                                    _shard[1], extension)
+    else:
+        name = 'cached_{}.{}'.format(kind, extension)
+    return os.path.join(__location__, name)
+
+
+class FileCacheBackend(object):
+    """
+        Remote cache kept in a directory (file:///path/to/dir, e.g. on a shared volume),
+        every cache file has a version number that grows with every change
+    """
+
+    def __init__(self, url):
+        self.path = urlparse.urlparse(url).path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def fetch(self, name, version=None):
+        """ Returns (version, content), content is None if it's still 'version' or it doesn't exist """
+        with self.lock(fcntl.LOCK_SH):
+            current_version = self.version(name)
+            if current_version is None or current_version == version:
+                return current_version, None
+            with open(os.path.join(self.path, name)) as file:
+                return current_version, file.read()
+
+    def store(self, name, content, version=None):
+        """ Store content only if the file is still at 'version' (compare-and-swap), returns the new version or None """
+        with self.lock(fcntl.LOCK_EX):
+            if self.version(name) != version:
+                return None
+            if version is not None:
+                with open(os.path.join(self.path, name)) as file:
+                    if file.read() == content:
+                        return version
+            new_version = (version or 0) + 1
+            for a, b in [(name, content), (name + ".version", str(new_version))]:
+                with open(os.path.join(self.path, a + ".tmp"), "w") as file:
+                    file.write(b)
+                os.rename(
+                    os.path.join(self.path, a + ".tmp"),
+                    os.path.join(self.path, a))
+            return new_version
+
+    def version(self, name):
+        try:
+            with open(os.path.join(self.path, name + ".version")) as file:
+                return int(file.read())
+        except (IOError, ValueError):
+            return None
+
+    @contextlib.contextmanager
+    def lock(self, operation):
+        with open(os.path.join(self.path, ".lock"), "a") as file:
+            fcntl.flock(file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class HttpCacheBackend(object):
+    """
+        Remote cache served over HTTP (http://host:port, see the cache-server command),
+        versions are sent as ETags, with If-None-Match to fetch and If-Match to store
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def fetch(self, name, version=None):
+        """ Returns (version, content), content is None if it's still 'version' or it doesn't exist """
+        req = urllib2.Request(self.url + '/' + name)
+        if version is not None:
+            req.add_header('If-None-Match', '"{}"'.format(version))
+        try:
+            resp = urllib2.urlopen(req, timeout=10)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return version, None
+            if e.code == 404:
+                return None, None
+            raise
+        return parse_etag(resp.info().getheader('ETag')), resp.read()
+
+    def store(self, name, content, version=None):
+        """ Store content only if the file is still at 'version' (compare-and-swap), returns the new version or None """
+        req = urllib2.Request(self.url + '/' + name, data=content)
+        req.get_method = lambda: 'PUT'
+        if version is None:
+            req.add_header('If-None-Match', '*')
+        else:
+            req.add_header('If-Match', '"{}"'.format(version))
+        try:
+            resp = urllib2.urlopen(req, timeout=10)
+        except urllib2.HTTPError as e:
+            if e.code == 412:
+                return None
+            raise
+        return parse_etag(resp.info().getheader('ETag'))
+
+
+# Remote cache backends of --cache-url, by URL scheme
+_cache_backends = {
+    'file': FileCacheBackend,
+    'http': HttpCacheBackend,
+}
+
+
+def parse_etag(etag):
+    """ Version number of an ETag header ('"3"'), None if there's none """
+    try:
+        return int(etag.strip().strip('"'))
+    except (AttributeError, ValueError):
+        return None
+
+
+def init_remote_cache(cache_url):
+    """ Share cache files with other runs through a remote cache (--cache-url), pulling the latest ones first """
+    global _remote_cache
+    scheme = urlparse.urlparse(cache_url).scheme
+    if scheme not in _cache_backends:
+        print "ERROR: Unsupported --cache-url '{}', use one of: {}".format(
+            cache_url, ", ".join(a + "://" for a in sorted(_cache_backends)))
+        sys.exit(1)
+    _remote_cache = _cache_backends[scheme](cache_url)
+    pull_remote_caches(cache_url)
+
+
+def pull_remote_caches(cache_url):
+    """ Fetch the cache files that changed in the remote cache since we last pulled or pushed them """
+    versions = load_cache_versions()
+    pulled = []
+    for kind, extension in _remote_cache_files:
+        path = cache_file(kind, extension)
+        name = os.path.basename(path)
+        try:
+            version, content = _remote_cache.fetch(
+                name, versions.get(name) if os.path.exists(path) else None)
+        except IOError:
+            print "WARNING: Remote cache {} is unavailable, using local cache files".format(
+                cache_url), sys.exc_value
+            return
+        if content is not None:
+            with open(path, "w") as file:
+                file.write(content)
+            pulled.append(name)
+        if version is None:
+            versions.pop(name, None)
+            _remote_cache_synced[name] = ('', None)
+        else:
+            versions[name] = version
+            content = read_file(path)
+            _remote_cache_synced[name] = (content, content)
+    dump_cache_versions(versions)
+    print "Pulled {} changed cache files from {}".format(len(pulled), cache_url)
+
+
+def push_remote_cache(path):
+    """
+        Write a cache file through to the remote cache. If another run changed it since we pulled it,
+        this run's changes are merged into its latest content and stored again, a few times at most
+    """
+    if _remote_cache is None:
+        return
+    name = os.path.basename(path)
+    versions = load_cache_versions()
+    content = read_file(path)
+    # Without a pull to compare against, everything in the local file is this run's
+    base, remote_content = _remote_cache_synced.get(name, ('', None))
+    version = versions.get(name)
+    try:
+        for _ in range(_remote_cache_retries + 1):
+            if remote_content is None or remote_content == base:
+                merged = content
+            else:
+                merged = merge_cache_content(name, base, content,
+                                             remote_content)
+            new_version = _remote_cache.store(name, merged, version)
+            if new_version is not None:
+                break
+            version, remote_content = _remote_cache.fetch(name)
+        else:
+            print "WARNING: {} kept being changed in the remote cache by other runs, not pushing it".format(
+                name)
+            return
+    except IOError:
+        print "WARNING: Can't push {} into the remote cache".format(
+            name), sys.exc_value
+        return
+    if merged != content:
+        # Records of the other runs are kept locally too, the next pull wouldn't fetch them again
+        with open(path, "w") as file:
+            file.write(merged)
+    _remote_cache_synced[name] = (content, merged)
+    versions[name] = new_version
+    dump_cache_versions(versions)
+
+
+def merge_cache_content(name, base, local, remote):
+    """
+        Re-apply the records changed locally since 'base' (added, modified or removed) on top of the
+        remote content of a cache file. The rules meta file isn't merged, the latest sync wins
+    """
+    if name.endswith('.json'):
+        try:
+            if float(json.loads(remote)['SyncedAt']) > float(
+                    json.loads(local)['SyncedAt']):
+                return remote
+        except (ValueError, KeyError, TypeError):
+            pass
+        return local
+
+    base, local, remote = [yaml.safe_load(a) or {} for a in (base, local, remote)]
+    for a in set(base) | set(local):
+        if a not in local:
+            remote.pop(a, None)
+        elif base.get(a) != local[a]:
+            remote[a] = local[a]
+    return yaml.dump(remote, default_flow_style=False)
+
+
+def read_file(path):
+    with open(path) as file:
+        return file.read()
+
+
+def load_cache_versions():
+    """ Remote cache versions of the local cache files """
+    try:
+        with open(cache_file('versions', 'json')) as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+
+def dump_cache_versions(versions):
+    with open(cache_file('versions', 'json'), "w") as file:
+        json.dump(versions, file, indent=2, sort_keys=True)
+
+
+def parse_shard(shard):
+    """ Parse '--shard i/N' into (i, N), returns None if sharding is not used """
+    if not shard:
+        return None
+    try:
+        index, count = [int(a) for a in shard.split('/')]
+    except ValueError:
+        print "ERROR: Invalid shard '{}', expected i/N (e.g. 1/4)".format(
+            shard)
+        sys.exit(1)
+    if count < 1 or index < 1 or index > count:
+        print "ERROR: Invalid shard '{}', i must be between 1 and N".format(
+            shard)
+        sys.exit(1)
+    return index, count
+
+
+def shard_of(app_name, count):
+    """ Deterministically map an app (scaling group name) into a shard number from 1 to count """
+    return int(hashlib.md5(app_name).hexdigest(), 16) % count + 1
+
+
+def in_shard(app_name):
+    """ Whether an app (scaling group name) belongs to the shard processed by this run """
+    if not _shard:
+        return True
+    return shard_of(app_name, _shard[1]) == _shard[0]
+
+
+def rule_in_shard(rule_name):
+    """
+        Whether a scaling rule or event-trigger task belongs to this run's shard,
+        both rules of an app (upscale/downscale) always land in the same shard
+    """
+    if not _shard:
+        return True
+    return in_shard(determine_scaling_group(rule_name) or rule_name)
+
+
+def report(status, name, message):
+    """ Print a result line (e.g. "CHANGED 'go-testapp-upscale': ...") and keep it for --report """
+    print "{} '{}': {}".format(status, name, message)
+    _report['results'].append({
+        'status': status,
+        'name': name,
+        'message': message
+    })
+    emit({
+        'type': 'result',
+        'status': status,
+        'name': name,
+        'message': message
+    })
+
+
+def emit(record):
+    """ Write a JSON line to stdout right away when --output ndjson is used """
+    if _ndjson is not None:
+        record['time'] = round(time.time(), 3)
+        with _output_lock:
+            _ndjson.write(json.dumps(record, sort_keys=True) + "\n")
+            _ndjson.flush()
+
+
+def emit_summary():
+    """ Last JSON line of a --output ndjson run, 'completed' is false if the run stopped early """
+    emit({
+        'type': 'summary',
+        'completed': _report.get('completed', False),
+        'summary': summarize_results(_report['results']),
+        'api_calls': _report['api_calls'],
+        'seconds': round(time.time() - _report['started_at'], 3),
+    })
+
+
+def write_report(report_file):
+    """ Write results of this run into a JSON report file """
+    _report['finished_at'] = time.time()
+    _report['summary'] = summarize_results(_report['results'])
+    try:
+        with open(report_file, "w") as file:
+            json.dump(_report, file, indent=2, sort_keys=True)
+    except IOError:
+        print "Error writing report into {}".format(report_file), sys.exc_value
+
+
+def summarize_results(results):
+    """ Count results by status """
+    summary = {}
+    for a in results:
+        summary[a['status']] = summary.get(a['status'], 0) + 1
+    return summary
 
 
 def determine_scaling_group(rule_name):
@@ -770,7 +2098,7 @@ def modify_scaling_group_size(scaling_rule_name, min_instance, max_instance):
 
     try:
         # Create request obj
-        req = ModifyScalingGroupRequest.ModifyScalingGroupRequest()
+        req = ess_request("ModifyScalingGroup")
 
         # Setting request parameters
         # Necessary: Yes, to specify which scaling group in aliyun that we're changing
@@ -781,11 +2109,20 @@ def modify_scaling_group_size(scaling_rule_name, min_instance, max_instance):
         req.set_MaxSize(max_instance)
 
         # Send the modify request
-        _client.do_action_with_exception(req)
-
-        print "CHANGED '{}': Successfully modified the scaling group min ({} to {}) and max ({} to {}) instance".format(
-            rule_scaling_group, old_min_instance, min_instance,
-            old_max_instance, max_instance)
+        snapshot_change('scaling_group', rule_scaling_group,
+                        _scaling_groups[scaling_group_id], 'MinInstance',
+                        'MaxInstance', ScalingGroupId=scaling_group_id)
+        do_action(req)
+
+        # Apply changes into _scaling_groups too so we can cache it
+        _scaling_groups[scaling_group_id]['MinInstance'] = min_instance
+        _scaling_groups[scaling_group_id]['MaxInstance'] = max_instance
+
+        report(
+            "CHANGED", rule_scaling_group,
+            "Successfully modified the scaling group min ({} to {}) and max ({} to {}) instance"
+            .format(old_min_instance, min_instance, old_max_instance,
+                    max_instance))
         logging.debug(
             "Modified Scaling Group Size {}:\nOLD => MinInstance: {}, MaxInstance: {}\n\nNEW => MinInstance: {}, MaxInstance: {}"
             .format(rule_scaling_group, old_min_instance, old_max_instance,
@@ -793,13 +2130,13 @@ def modify_scaling_group_size(scaling_rule_name, min_instance, max_instance):
 
         return True
     except ClientException:
-        print "ERROR '{}': API connection issue, please try again".format(
-            scaling_rule_name)
+        report("ERROR", scaling_rule_name,
+               "API connection issue, please try again")
         print sys.exc_value
         print ""
         return False
     except:
-        print "ERROR '{}': {}".format(scaling_rule_name, sys.exc_info())
+        report("ERROR", scaling_rule_name, str(sys.exc_info()))
         return False
     return True
 
@@ -808,6 +2145,8 @@ def query_yes_no(msg):
     """ Ask a yes/no question """
     if _noconfirm:
         return True
+    if isinstance(_client, ReplayClient):
+        return _client.answer(msg)
 
     # raw_input returns the empty string for "enter"
     yes = {'yes', 'y', 'ye', ''}
@@ -817,63 +2156,306 @@ def query_yes_no(msg):
         print msg, "[Y/n]",
         choice = raw_input().lower()
         if choice in yes:
-            return True
+            answer = True
+            break
         elif choice in no:
-            return False
+            answer = False
+            break
         else:
             sys.stdout.write("Please respond with 'yes' or 'no'")
 
+    record_trace({'type': 'prompt', 'message': msg, 'answer': answer})
+    return answer
+
 
 def clear_prev_line_if_not(printed):
     """ Just to make the stdout cleaner """
-    if not printed:
+    if not printed and _ndjson is None:
         print "\033[A                                                                                                                                               \033[A"
 
 
+def app_priority(app_name):
+    """ Priority of an app, the highest 'Priority' of its upscale and downscale rule in the mode config (default: 0) """
+    priority = 0
+    for a in [app_name + "-upscale", app_name + "-downscale"]:
+        if a in _config:
+            priority = max(priority, _config[a].get('Priority', 0))
+    return priority
+
+
+def schedule_priority(scaling_rule_name, tier=None):
+    """ Sort key of work on a scaling rule (or its scaling group): its tier, then its app's priority, then its name """
+    if tier is None:
+        tier = {
+            1: 'upscale',
+            0: 'downscale'
+        }.get(rule_type(scaling_rule_name), 'unrecognized')
+    app_name = determine_scaling_group(scaling_rule_name)
+    return (_schedule_tiers[tier], -app_priority(app_name)
+            if app_name else 0, scaling_rule_name)
+
+
+def plan_work(scaling_rule_names):
+    """
+        Work of a run, sorted in the order it should be done:
+            1. Scaling groups whose MinInstance or MaxInstance grows
+            2. Upscale rules, each followed by its event-trigger task
+            3. Downscale rules, each followed by its event-trigger task
+            4. Scaling groups that only shrink
+        Apps with a higher 'Priority' in the mode config go first within each step
+    """
+    work = [rule_work_item(a) for a in scaling_rule_names]
+
+    # Scaling Groups that have MinInstance and MaxInstance in selected config
+    for a in _config:
+        if 'MinInstance' not in _config[a] or 'MaxInstance' not in _config[a]:
+            continue
+        tier = 'scaling-group-decrease'
+        current_size = scaling_group_size(determine_scaling_group(a))
+        if current_size and (
+                _config[a]['MinInstance'] > current_size['MinInstance']
+                or _config[a]['MaxInstance'] > current_size['MaxInstance']):
+            tier = 'scaling-group-increase'
+        work.append({
+            'kind': 'scaling_group',
+            'name': a,
+            'priority': schedule_priority(a, tier)
+        })
+
+    return sorted(work, key=lambda a: a['priority'])
+
+
+def rule_work_item(scaling_rule_name):
+    """ Work item of a scaling rule and its event-trigger task """
+    return {
+        'kind': 'scaling_rule',
+        'name': scaling_rule_name,
+        'priority': schedule_priority(scaling_rule_name)
+    }
+
+
+def work_item_ready(item, loading):
+    """
+        Whether everything a work item compares with is loaded, loading is the kinds InventoryLoader is still loading
+        Until everything is loaded, only the work that protects capacity is ready, so upscale rules
+        from later pages still go before downscale rules (and scaling groups that only shrink)
+    """
+    if loading and item['priority'][0] > _schedule_tiers['upscale']:
+        return False
+    if item['kind'] == 'scaling_group':
+        return True
+    return all(item['name'] in data or kind not in loading
+               for kind, data in (('rules', _current_rules),
+                                  ('event_trigger_tasks',
+                                   _event_trigger_tasks)))
+
+
+def finish_loading(kind, total_count):
+    """ Cache a kind of inventory once InventoryLoader loaded all of it, like the non-streaming loaders do """
+    if kind == 'rules':
+        dump_cache(_current_rules, 'rules')
+        dump_rules_total_count(total_count)
+        logging.debug("Loaded current rules: {}".format(_current_rules))
+    else:
+        dump_cache(_event_trigger_tasks, 'event_trigger_tasks')
+        logging.debug(
+            "Loaded Event-trigger Tasks: {}".format(_event_trigger_tasks))
+
+
+def reconcile_stream(processed_mode_rules, not_found_event_trigger_tasks):
+    """
+        Run the work of plan_work() while InventoryLoader pages are still arriving,
+        the work that's ready goes in priority order:
+            - a scaling rule is ready once it arrived and its event-trigger task arrived (or all of them did)
+            - downscale rules and scaling groups that only shrink are ready once everything arrived
+        Returns whether any work was run
+    """
+    loading = set(_loader.loading)
+    waiting = {}  # Work items not ready yet, by name
+    ready = []  # Heap of (priority, work item)
+    arrived = set()  # Names that may have become ready
+    for a in plan_work(_current_rules if _limit is None else _limit):
+        waiting.setdefault(a['name'], []).append(a)
+        arrived.add(a['name'])
+
+    ran = False
+    while True:
+        for a in arrived:
+            for item in waiting.pop(a, []):
+                if work_item_ready(item, loading):
+                    heapq.heappush(ready, (item['priority'], item))
+                else:
+                    waiting.setdefault(a, []).append(item)
+        arrived = set()
+
+        if ready:
+            ran = True
+            run_work_item(
+                heapq.heappop(ready)[1], processed_mode_rules,
+                not_found_event_trigger_tasks)
+        elif not loading:
+            break
+        if not loading:
+            continue
+
+        # Take in the next page, only wait for it if there's no work ready
+        try:
+            kind, total_count, records = _loader.pages.get(not ready, 0.1)
+        except Queue.Empty:
+            continue
+        if kind == 'error':
+            raise total_count[0], total_count[1], total_count[2]
+        if records is None:
+            loading.discard(kind)
+            finish_loading(kind, total_count)
+            arrived.update(waiting)
+        elif kind == 'rules':
+            # What's known already may have been changed by this run, it's kept
+            for a in records:
+                if a.ScalingRuleName in _current_rules:
+                    continue
+                if _limit is None:
+                    waiting.setdefault(a.ScalingRuleName, []).append(
+                        rule_work_item(a.ScalingRuleName))
+                _current_rules[a.ScalingRuleName] = a
+                arrived.add(a.ScalingRuleName)
+        else:
+            for a in records:
+                if a.Name in _event_trigger_tasks:
+                    continue
+                _event_trigger_tasks[a.Name] = a
+                arrived.add(a.Name)
+
+    return ran
+
+
+def scaling_group_size(scaling_group_name):
+    """ Current size record of a scaling group, None if it doesn't exist in aliyun """
+    if scaling_group_name is None or scaling_group_name not in _scaling_groups:
+        return None
+    return _scaling_groups[_scaling_groups[scaling_group_name]]
+
+
+def work_item_pending(item):
+    """ Whether a work item would change something in aliyun, the others still run after the deadline """
+    if item['kind'] == 'scaling_group':
+        return scaling_group_drift(item['name'])
+
+    scaling_rule_name = item['name']
+    if scaling_rule_name not in _current_rules or rule_type(
+            scaling_rule_name) == -1:
+        return False
+    return len(scaling_rule_drift(scaling_rule_name)) > 0
+
+
+def scaling_group_drift(scaling_rule_name):
+    """ Whether the scaling group of a mode config entry with MinInstance and MaxInstance has another size in aliyun """
+    current_size = scaling_group_size(
+        determine_scaling_group(scaling_rule_name))
+    new_size = _config[scaling_rule_name]
+    return current_size is not None and (
+        new_size['MinInstance'], new_size['MaxInstance']) != (
+            current_size['MinInstance'], current_size['MaxInstance'])
+
+
+def scaling_rule_drift(scaling_rule_name):
+    """
+        What modify_scaling_rule() and create_event_trigger_task() would change for a scaling rule in aliyun:
+        'scaling_rule' if it differs from the mode config, 'event_trigger_task' if its event-trigger task does
+    """
+    new_rule = get_rule(scaling_rule_name)
+    drift = []
+    if not same_fingerprint(
+            scaling_rule_fingerprint(new_rule),
+            _current_rules[scaling_rule_name]['Fingerprint']):
+        drift.append('scaling_rule')
+    if scaling_rule_name in _event_trigger_tasks and event_trigger_task_diff(
+            scaling_rule_name, new_rule):
+        drift.append('event_trigger_task')
+    return drift
+
+
+def run_work_item(item, processed_mode_rules, not_found_event_trigger_tasks):
+    """ Run a work item of plan_work(), unless the deadline was reached and it would change something in aliyun """
+    if deadline_passed() and work_item_pending(item):
+        if item['kind'] == 'scaling_group':
+            report("DEFERRED", determine_scaling_group(item['name']),
+                   "Deadline reached before the scaling group size was modified")
+        else:
+            report("DEFERRED", item['name'],
+                   "Deadline reached before the scaling rule and its event-trigger task were modified")
+            # The scaling rule exists, so its event-trigger task isn't useless
+            processed_mode_rules[item['name']] = True
+            if item['name'] in _event_trigger_tasks:
+                _event_trigger_tasks[item['name']]["valid_name"] = True
+        return
+
+    if item['kind'] == 'scaling_group':
+        modify_scaling_group_size(item['name'],
+                                  _config[item['name']]['MinInstance'],
+                                  _config[item['name']]['MaxInstance'])
+        return
+
+    processed_mode_rules[item['name']] = modify_scaling_rule(item['name'])
+    if processed_mode_rules[item['name']]:
+        process_event_trigger_task(item['name'], not_found_event_trigger_tasks)
+
+
+def process_event_trigger_task(scaling_rule_name,
+                               not_found_event_trigger_tasks):
+    """ Modify the event-trigger task of a processed scaling rule, or remember that it's not found in aliyun """
+    if scaling_rule_name in _event_trigger_tasks:  # If the task exists in aliyun
+        _event_trigger_tasks[scaling_rule_name]["valid_name"] = True
+        create_event_trigger_task(scaling_rule_name)
+    else:
+        not_found_event_trigger_tasks[scaling_rule_name] = scaling_rule_name
+
+
+def deadline_passed():
+    """ Whether the --deadline of this run was reached, no new changes are made in aliyun after that """
+    return _deadline is not None and time.time() >= _deadline
+
+
 def main(args):
     """ Main entry point """
     global _current_rules
 
     init(args)
 
-    # Start modifying rules
-    print "\nModifying scaling rules:"
-    processed_mode_rules = {
-    }  # Keep track of rules we want to processed (False means not yet processed)
+    # Keep track of rules we want to processed (False means not yet processed)
+    processed_mode_rules = {}
     for a in _config:
         if a.find("default-") == -1:
-            if _limit and a in _limit:  # If --limit is used, only process the ones in limit
+            if _limit is not None and a in _limit:  # If --limit is used, only process the ones in limit
                 processed_mode_rules[a] = False
-            elif not _limit:  # Process all loaded rules otherwise
+            elif _limit is None:  # Process all loaded rules otherwise
                 processed_mode_rules[a] = False
 
-    # If --limit was used, only include those in --limit arguments into
-    # processed_mode_rules, include all found rules otherwise
-    if _limit:
-        for a in _limit:
-            processed_mode_rules[a] = modify_scaling_rule(a)
-    else:
-        for a in _current_rules:
-            processed_mode_rules[a] = modify_scaling_rule(a)
+    # Loaded Event-trigger Tasks are flagged as not having valid name, every scaling rule that
+    # finds its pair of event-trigger task flags that task as valid, other event-trigger tasks
+    # will remain flagged as invalid and user will be asked if they want to delete them at the end
 
-    print "\nModifying scaling group min and max instance size:"
-    printed = False
-    # Process Scaling Groups that have MinInstance and MaxInstance in selected config and the scaling group exists in aliyun
-    for a in _config:
-        if 'MinInstance' not in _config[a] or 'MaxInstance' not in _config[a]:
-            continue
-        if modify_scaling_group_size(a, _config[a]['MinInstance'],
-                                     _config[a]['MaxInstance']):
-            printed = True
+    not_found_event_trigger_tasks = {
+    }  # Event-trigger Tasks that aren't found in aliyun
+
+    # Start modifying scaling rules, their event-trigger tasks and scaling group sizes,
+    # the changes that protect capacity first, while the rest is still loading.
+    # If --limit was used, only include those in --limit arguments, include all found rules otherwise
+    print "\nModifying scaling rules, event-trigger tasks and scaling group sizes (in priority order):"
+    printed = reconcile_stream(processed_mode_rules,
+                               not_found_event_trigger_tasks)
 
     # Clear previous line if no entry was printed, to avoid confusion in stdout
     clear_prev_line_if_not(printed)
 
+    print "\nThere are total of {} scaling rules detected".format(
+        len(_current_rules))
+
     # Process rules that wasn't found in aliyun, but are listed in our mode config file
-    added_one_or_more_rules = False
+    added_rules = []
     print "\nThese rules are not found in aliyun:"
     printed = False
-    for a in processed_mode_rules:
+    for a in sorted(processed_mode_rules, key=schedule_priority):
         if not processed_mode_rules[a]:
             rule_scaling_group = determine_scaling_group(a)
             printed = True
@@ -881,8 +2463,11 @@ def main(args):
                 print "{}: Should belong to ScalingGroup={}".format(
                     a, rule_scaling_group)
                 if rule_scaling_group not in _scaling_groups:
-                    print "WARNING '{}': Scaling group doesn't exists".format(
-                        rule_scaling_group)
+                    report("WARNING", rule_scaling_group,
+                           "Scaling group doesn't exists")
+                elif deadline_passed():
+                    report("DEFERRED", a,
+                           "Deadline reached before the scaling rule was created")
                 else:
                     add_new_rule = query_yes_no(
                         "Do you want to create {} rule and attach to {} scaling group in aliyun?"
@@ -893,7 +2478,7 @@ def main(args):
                             processed_mode_rules[a] = True
                             if a in _event_trigger_tasks:
                                 _event_trigger_tasks[a]["bypass_skip"] = True
-                            added_one_or_more_rules = True
+                            added_rules.append(a)
             else:
                 print "{}: Please check the naming convention (appname-upscale/appname-downscale)".format(
                     a)
@@ -901,55 +2486,34 @@ def main(args):
     clear_prev_line_if_not(printed)
 
     # If the script added new rules into aliyun, reflect the changes into our local version before proceeding any further
-    if added_one_or_more_rules:
+    if added_rules:
         print "Reloading current rules from aliyun"
         _current_rules = reconstruct_current_rules_cache()
 
-    found_event_trigger_tasks = {}  # Event-trigger Tasks that exist in aliyun
-    not_found_event_trigger_tasks = {
-    }  # Event-trigger Tasks that aren't found in aliyun
-
-    # Flag all loaded Event-trigger Tasks as not having valid name
-    for a in _event_trigger_tasks:
-        _event_trigger_tasks[a]["valid_name"] = False
-
-    # For every scaling rule that found its pair of event-trigger task, flag that task as valid,
-    # other event-trigger tasks will remain flagged as invalid otherwise and user will be asked if
-    # they want to delete them at the end
-    for a in processed_mode_rules:
-        if processed_mode_rules[a]:
-            if a in _event_trigger_tasks:  # If the rule exists in aliyun
-                found_event_trigger_tasks[a] = _event_trigger_tasks[
-                    a]  # Means we will process them
-                _event_trigger_tasks[a]["valid_name"] = True
-            else:
-                not_found_event_trigger_tasks[
-                    a] = a  # Means we will ask user if they want to add it or not
-
-    print "\nProcessing found event triggered task in aliyun:"
-    printed = False
-    for a in found_event_trigger_tasks:
-        create_event_trigger_task(a)
-        printed = True
-
-    clear_prev_line_if_not(printed)
+        print "\nProcessing found event triggered task of the new rules in aliyun:"
+        for a in added_rules:
+            process_event_trigger_task(a, not_found_event_trigger_tasks)
 
     print "\nList of event-trigger tasks in aliyun that are useless (no scaling rule attached to it) or not following our naming convention:"
     printed = False
     for a in _event_trigger_tasks:
         if not _event_trigger_tasks[a]["valid_name"]:
-            if _limit and a not in _limit:
+            if _limit is not None and a not in _limit:
                 continue
             printed = True
-            print "INVALID '{}': Event trigger task in aliyun, you can choose to delete it at the end of this script".format(
-                a)
+            report("INVALID", a,
+                   "Event trigger task in aliyun, you can choose to delete it at the end of this script")
 
     clear_prev_line_if_not(printed)
 
     print "\nThese event-trigger task are not found in aliyun:"
     printed = False
-    for a in not_found_event_trigger_tasks:
+    for a in sorted(not_found_event_trigger_tasks, key=schedule_priority):
         printed = True
+        if deadline_passed():
+            report("DEFERRED", a,
+                   "Deadline reached before the event-trigger task was created")
+            continue
         print a
         cont = query_yes_no(
             "Create new one? (consult with above list, maybe it exists under INVALID)"
@@ -962,9 +2526,14 @@ def main(args):
 
     print "\nYou can delete those event-trigger tasks that are useless (no scaling rule attached to it) or not following our naming convention here:"
     printed = False
-    for a in _event_trigger_tasks:
+    for a in list(_event_trigger_tasks):
         if not _event_trigger_tasks[a]["valid_name"]:
-            if _limit and a not in _limit:
+            if _limit is not None and a not in _limit:
+                continue
+            if deadline_passed():
+                report("DEFERRED", a,
+                       "Deadline reached before the event-trigger task was deleted")
+                printed = True
                 continue
             cont = query_yes_no("INVALID '{}': Delete it?".format(a))
             if not cont:
@@ -974,45 +2543,2917 @@ def main(args):
 
     clear_prev_line_if_not(printed)
 
-    # Dump modified _current_rules into cached_rules.yaml
-    print "\nCaching all changed rules into cached_rules.yaml"
-    reconstruct_current_rules_cache()
+    deferred = [a for a in _report['results'] if a['status'] == 'DEFERRED']
+    if deferred:
+        print "\nThe --deadline was reached, {} changes were not made (DEFERRED above), run the script again to apply them".format(
+            len(deferred))
 
+    # Dump modified _current_rules into cached_rules.yaml, and the other caches too
+    print "\nCaching all changed rules into {}".format(
+        os.path.basename(cache_file('rules')))
+    if _rules_synced_recently and not added_rules:
+        dump_cache(_current_rules, 'rules')
+    else:
+        reconstruct_current_rules_cache()
+    dump_cache(_scaling_groups, 'scaling_groups')
+    # The changes were applied into _event_trigger_tasks as they were made, valid_name and bypass_skip only hold for this run
+    for a in _event_trigger_tasks.values():
+        a.valid_name = a.bypass_skip = False
+    dump_cache(_event_trigger_tasks, 'event_trigger_tasks')
 
-if __name__ == "__main__":
-    """ This is executed when run from the command line """
-    parser = argparse.ArgumentParser()
+    _report['completed'] = True
+    if args.report:
+        write_report(args.report)
 
-    # Access Key
+
+def emergency_resolve_group(app_name, refresh=False):
+    """
+        Resolve a scaling group ID from the cached name => ID index,
+        only that one scaling group is fetched from aliyun if it's not in the index (or refresh is used)
+    """
+    global _scaling_groups
+
+    if not refresh:
+        try:
+            _scaling_groups = load_cache('scaling_groups')
+        except IOError:
+            _scaling_groups = {}
+
+        if app_name in _scaling_groups:
+            return _scaling_groups[app_name]
+
+        print "Scaling group '{}' is not in {}, fetching it from aliyun".format(
+            app_name, os.path.basename(cache_file('scaling_groups')))
+    else:
+        _scaling_groups.pop(_scaling_groups.pop(app_name, None), None)
+    req = ess_request("DescribeScalingGroups")
+    req.set_ScalingGroupName1(app_name)
+    resp_yaml = yaml.safe_load(do_action(req))
+    for a in resp_yaml['ScalingGroups']['ScalingGroup']:
+        add_scaling_group(_scaling_groups, a)
+    dump_cache(_scaling_groups, 'scaling_groups')
+
+    return _scaling_groups.get(app_name)
+
+
+def emergency_resolve_rules(app_name, scaling_group_id, refresh=False):
+    """
+        Resolve the app's scaling rules from cached_rules.yaml,
+        only that scaling group's rules are fetched from aliyun if they're not cached (or refresh is used)
+    """
+    global _current_rules
+
+    if not refresh or not _current_rules:
+        try:
+            _current_rules = load_cache('rules')
+        except IOError:
+            _current_rules = {}
+
+    names = [app_name + "-upscale", app_name + "-downscale"]
+    if not refresh and all(a in _current_rules for a in names):
+        return
+    for a in names:
+        _current_rules.pop(a, None)
+
+    print "Scaling rules of '{}' are not in {}, fetching them from aliyun".format(
+        app_name, os.path.basename(cache_file('rules')))
+    req = ess_request("DescribeScalingRules")
+    req.set_ScalingGroupId(scaling_group_id)
+    req.set_PageSize(50)
+    resp_yaml = yaml.safe_load(do_action(req))
+    for a in resp_yaml['ScalingRules']['ScalingRule']:
+        rule = ScalingRuleRecord.from_dict(a)
+        _current_rules[rule.ScalingRuleName] = rule
+    dump_cache(_current_rules, 'rules')
+
+
+def emergency_describe_group(scaling_group_id):
+    """ Fetch one scaling group from aliyun into _scaling_groups, returns its DescribeScalingGroups item (None if it doesn't exist) """
+    req = ess_request("DescribeScalingGroups")
+    req.set_ScalingGroupId1(scaling_group_id)
+    resp_yaml = yaml.safe_load(do_action(req))
+    for a in resp_yaml['ScalingGroups']['ScalingGroup']:
+        add_scaling_group(_scaling_groups, a)
+        return a
+    return None
+
+
+def emergency_describe_rules(scaling_rule_ids):
+    """ Fetch scaling rules from aliyun by ID into _current_rules, returns their DescribeScalingRules items """
+    req = ess_request("DescribeScalingRules")
+    for i, a in enumerate(sorted(scaling_rule_ids)):
+        getattr(req, "set_ScalingRuleId{}".format(i + 1))(a)
+    resp_yaml = yaml.safe_load(do_action(req))
+    for a in resp_yaml['ScalingRules']['ScalingRule']:
+        _current_rules[a['ScalingRuleName']] = ScalingRuleRecord.from_dict(a)
+    return resp_yaml['ScalingRules']['ScalingRule']
+
+
+def emergency(args):
+    """ Resize one scaling group (and its scaling rules) right away without syncing everything """
+    started = time.time()
+    init_logging(args.log_file)
+
+    changes = [
+        args.min_instance, args.max_instance, args.upscale_value,
+        args.downscale_value
+    ]
+    if all(a is None for a in changes):
+        print "ERROR: Nothing to change, use --min, --max, --upscale-value or --downscale-value"
+        sys.exit(1)
+    if args.min_instance is not None and args.max_instance is not None \
+            and args.min_instance > args.max_instance:
+        print "ERROR: --min can't be bigger than --max"
+        sys.exit(1)
+    # Same checks as the mode config, a positive value would turn the downscale rule into an upscale one
+    if args.downscale_value is not None and args.downscale_value >= 0:
+        print "ERROR: --downscale-value must be negative"
+        sys.exit(1)
+    if args.min_instance is not None and args.min_instance < 2:
+        print "ERROR {}: MinInstance value must be at least 2".format(
+            args.app)
+        sys.exit(1)
+
+    init_client(args)
+    if args.cache_url:
+        init_remote_cache(args.cache_url)
+
+    try:
+        scaling_group_id = emergency_resolve_group(args.app)
+        if not scaling_group_id:
+            print "ERROR '{}': Scaling group doesn't exists".format(args.app)
+            sys.exit(1)
+        try:
+            emergency_apply(args, scaling_group_id)
+        except ServerException:
+            if getattr(sys.exc_value, 'error_code', None) not in _invalid_id_errors:
+                raise
+            # The cached IDs are stale (e.g. the scaling group was recreated), only this group is resolved again
+            print "{}, fetching '{}' from aliyun again".format(
+                sys.exc_value, args.app)
+            scaling_group_id = emergency_resolve_group(args.app, refresh=True)
+            if not scaling_group_id:
+                print "ERROR '{}': Scaling group doesn't exists".format(
+                    args.app)
+                sys.exit(1)
+            emergency_apply(args, scaling_group_id, refresh=True)
+    except (ClientException, ServerException):
+        report("ERROR", args.app, "API connection issue, please try again")
+        print sys.exc_value
+        sys.exit(1)
+
+    print "\nDone in {:.2f}s".format(time.time() - started)
+
+
+def emergency_apply(args, scaling_group_id, refresh=False):
+    """ Make the changes of the 'emergency' command and verify them, refresh fetches the app's scaling rules again """
+    # Resize the scaling group first, that's what protects the capacity
+    expected_size = {}
+    if args.min_instance is not None or args.max_instance is not None:
+        req = ess_request("ModifyScalingGroup")
+        req.set_ScalingGroupId(str(scaling_group_id))
+        if args.min_instance is not None:
+            req.set_MinSize(args.min_instance)
+            expected_size['MinSize'] = args.min_instance
+        if args.max_instance is not None:
+            req.set_MaxSize(args.max_instance)
+            expected_size['MaxSize'] = args.max_instance
+        # The snapshot gets the size aliyun has, the cached one may be older
+        if emergency_describe_group(scaling_group_id) is None:
+            raise ServerException(
+                "InvalidScalingGroupId.NotFound",
+                "Scaling group {} doesn't exist in aliyun".format(
+                    scaling_group_id))
+        snapshot_change('scaling_group', args.app,
+                        _scaling_groups[scaling_group_id], 'MinInstance',
+                        'MaxInstance', ScalingGroupId=scaling_group_id)
+        do_action(req)
+        report(
+            "CHANGED", args.app,
+            "Modified the scaling group size ({})".format(", ".join(
+                "{}={}".format(a, b)
+                for a, b in sorted(expected_size.items()))))
+        logging.debug("Emergency resize of Scaling Group {}: {}".format(
+            args.app, expected_size))
+
+    # Then the scaling rules, if asked to
+    expected_rules = {}
+    adjustments = [(args.app + "-upscale", args.upscale_value),
+                   (args.app + "-downscale", args.downscale_value)]
+    if any(b is not None for a, b in adjustments):
+        emergency_resolve_rules(args.app, scaling_group_id, refresh)
+
+        # The snapshot gets the values aliyun has, the cached ones may be older
+        targets = [
+            _current_rules[a]['ScalingRuleId'] for a, b in adjustments
+            if b is not None and a in _current_rules
+        ]
+        if targets and len(
+                emergency_describe_rules(targets)) < len(targets):
+            # A cached scaling rule ID doesn't exist anymore
+            emergency_resolve_rules(
+                args.app, scaling_group_id, refresh=True)
+    for a, b in adjustments:
+        if b is None:
+            continue
+        if a not in _current_rules:
+            report("WARNING", a, "Scaling rule does not exist in aliyun")
+            continue
+        req = ess_request("ModifyScalingRule")
+        req.set_ScalingRuleId(str(_current_rules[a]['ScalingRuleId']))
+        req.set_AdjustmentValue(b)
+        if args.cooldown is not None:
+            req.set_Cooldown(args.cooldown)
+        snapshot_change('scaling_rule', a, _current_rules[a],
+                        'ScalingRuleId', *_scaling_rule_attr)
+        do_action(req)
+        expected_rules[_current_rules[a]['ScalingRuleId']] = (a, b)
+        report("CHANGED", a,
+               "Modified the scaling rule (AdjustmentValue={})".format(b))
+        logging.debug(
+            "Emergency change of Scaling Rule {}: AdjustmentValue={}, Cooldown={}"
+            .format(a, b, args.cooldown))
+
+    # Verify what aliyun has now, and keep the caches up to date
+    if expected_size:
+        group = emergency_describe_group(scaling_group_id)
+        dump_cache(_scaling_groups, 'scaling_groups')
+        if all(group[a] == expected_size[a] for a in expected_size):
+            report(
+                "VERIFIED", args.app,
+                "MinInstance={}, MaxInstance={}".format(
+                    group['MinSize'], group['MaxSize']))
+        else:
+            report(
+                "ERROR", args.app,
+                "Verification failed, MinInstance={}, MaxInstance={}".
+                format(group['MinSize'], group['MaxSize']))
+
+    if expected_rules:
+        for a in emergency_describe_rules(expected_rules):
+            name, value = expected_rules[a['ScalingRuleId']]
+            if canonical_value('AdjustmentValue', a['AdjustmentValue']
+                               ) == canonical_value('AdjustmentValue', value):
+                report("VERIFIED", name, "AdjustmentValue={}".format(
+                    a['AdjustmentValue']))
+            else:
+                report(
+                    "ERROR", name,
+                    "Verification failed, AdjustmentValue={}".format(
+                        a['AdjustmentValue']))
+        dump_cache(_current_rules, 'rules')
+
+
+def add_emergency_arguments(parser):
+    """ Arguments of the 'emergency' command """
+    parser.description = "Resize one scaling group and its scaling rules right away, " \
+        "using the cached scaling group IDs instead of syncing everything"
     parser.add_argument(
         "access_key_id", help="Accesskey ID for aliyun account")
     parser.add_argument(
         "access_key_secret", help="AccessKey secret for aliyun account")
     parser.add_argument(
         "region_id", help="ID of the region where the service is called")
-
-    # Optional argument which requires a parameter (eg. -m grammy)
+    parser.add_argument("app", help="Scaling group name (e.g. go-testapp)")
     parser.add_argument(
-        "-m",
-        "--mode",
+        "--min",
         action="store",
-        dest="mode",
-        default="normal",
-        help="Autoscale event-trigger task mode config")
-
-    # Optional argument which requires a parameter (eg. -l go-testapp-upscale,go-testapp-downscale)
+        dest="min_instance",
+        type=int,
+        default=None,
+        help="New MinInstance of the scaling group")
     parser.add_argument(
-        "-l",
-        "--limit",
+        "--max",
         action="store",
-        dest="limit",
-        default="",
-        help="Limit target rules")
-
-    # Optional argument which requires a parameter (eg. -o /var/log/file.log)
+        dest="max_instance",
+        type=int,
+        default=None,
+        help="New MaxInstance of the scaling group")
     parser.add_argument(
-        "-o",
-        "--log-file",
+        "--upscale-value",
+        action="store",
+        dest="upscale_value",
+        type=int,
+        default=None,
+        help="New AdjustmentValue of the app-name-upscale rule")
+    parser.add_argument(
+        "--downscale-value",
+        action="store",
+        dest="downscale_value",
+        type=int,
+        default=None,
+        help=
+        "New AdjustmentValue of the app-name-downscale rule (negative, e.g. -20)"
+    )
+    parser.add_argument(
+        "--cooldown",
+        action="store",
+        dest="cooldown",
+        type=int,
+        default=None,
+        help="New Cooldown of the modified scaling rules")
+    parser.add_argument(
+        "--cache-url",
+        action="store",
+        dest="cache_url",
+        default="",
+        help=
+        "Share cache files with other runs through a remote cache (file:///path/to/dir, or http://host:port of the cache-server command)"
+    )
+    parser.add_argument(
+        "-o",
+        "--log-file",
+        action="store",
+        dest="log_file",
+        default="log/autoscale_rules_mode.log",
+        help=
+        "Absolute path for log file, default: 'log/autoscale_rules_mode.log'")
+
+
+# ID field of every type of snapshot entry
+_snapshot_ids = {
+    'scaling_group': 'ScalingGroupId',
+    'scaling_rule': 'ScalingRuleId',
+    'created_scaling_rule': 'ScalingRuleId',
+    'event_trigger_task': 'AlarmTaskId',
+    'created_event_trigger_task': 'AlarmTaskId',
+    'deleted_event_trigger_task': 'AlarmTaskId',
+}
+
+# Fields of a deleted event-trigger task that are needed to create it again
+_snapshot_alarm_fields = ['AlarmTaskId', 'ScalingGroupId', 'Enable', 'AlarmActions'
+                          ] + _event_trigger_task_attr
+
+# Number of snapshots (runs that changed something) kept for rollback, the oldest ones are removed
+_snapshot_history = 20
+
+# Snapshot entry types in the order rollback undoes them for one scaling rule (or scaling group),
+# deleted tasks are recreated first so the app keeps its triggers, what the run created goes last
+_rollback_steps = [
+    ('deleted_event_trigger_task', "Recreate", "Recreated",
+     "the deleted event-trigger task"),
+    ('scaling_group', "Restore", "Restored", "the scaling group size"),
+    ('scaling_rule', "Restore", "Restored", "the scaling rule"),
+    ('event_trigger_task', "Restore", "Restored", "the event-trigger task"),
+    ('created_event_trigger_task', "Delete", "Deleted",
+     "the event-trigger task created by the run"),
+    ('created_scaling_rule', "Delete", "Deleted",
+     "the scaling rule created by the run"),
+]
+
+
+def snapshot_change(kind, name, source, *fields, **state):
+    """
+        Write an object's state into the snapshot of this run before it's changed in aliyun
+        (or its ID once it's created), the given fields of source, all of it if none are given
+        The first change of a run starts its own snapshot file, 'rollback' undoes the changes of one
+    """
+    global _snapshot
+    state.update((a, source[a]) for a in fields or source.keys())
+    entry = dict(state, type=kind, name=name)
+    with _output_lock:
+        if _snapshot is False:
+            return
+        try:
+            if _snapshot is None:
+                started = time.time()
+                _snapshot = open(snapshot_file(started), "w")
+                _snapshot.write(
+                    json.dumps({
+                        'type': 'run',
+                        'mode': _mode or None,
+                        'started_at': started
+                    },
+                               sort_keys=True) + "\n")
+                for a in snapshot_files()[:-_snapshot_history]:
+                    os.remove(a)
+            _snapshot.write(json.dumps(entry, sort_keys=True) + "\n")
+            # The change is only made once its snapshot is on disk
+            _snapshot.flush()
+            os.fsync(_snapshot.fileno())
+        except IOError:
+            print "WARNING: Can't write the snapshot of this run, its changes can't be rolled back", sys.exc_value
+            _snapshot = False
+
+
+def snapshot_file(started):
+    """ Snapshot of the run that started at that time, e.g. cached_snapshot.20261019-010604.618.jsonl """
+    return cache_file(
+        'snapshot', "{}.{:03d}.jsonl".format(
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(started)),
+            int(started * 1000) % 1000))
+
+
+def snapshot_files():
+    """ Snapshots of this shard, oldest first """
+    prefix = cache_file('snapshot', '')
+    return sorted(
+        a for a in glob.glob(prefix + '*.jsonl')
+        if re.match(r'^\d{8}-\d{6}\.\d{3}\.jsonl$', a[len(prefix):]))
+
+
+def snapshot_key(entry):
+    """ Key of the object a snapshot entry is about, e.g. 'scaling_rule:asr-blabla' """
+    return "{}:{}".format(entry['type'], entry[_snapshot_ids[entry['type']]])
+
+
+def snapshot_value(value):
+    """ JSON strings of the snapshot as plain strings, like the records loaded from aliyun """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [snapshot_value(a) for a in value]
+    if isinstance(value, dict):
+        return dict((snapshot_value(a), snapshot_value(b))
+                    for a, b in value.items())
+    return value
+
+
+def load_snapshot(path):
+    """
+        Header of a snapshot, its changes that weren't rolled back yet (one per object,
+        the first value written of every field wins, that's the state before the run) and its number of changes
+    """
+    lines = []
+    with open(path) as file:
+        for a in file:
+            try:
+                lines.append(snapshot_value(json.loads(a)))
+            except ValueError:
+                # Only the last line can be cut short, by a run that was killed
+                pass
+
+    header = lines[0] if lines and lines[0].get('type') == 'run' else {}
+    rolled_back = set(
+        a['key'] for a in lines if a.get('type') == 'rolled_back')
+    changes = {}
+    for a in lines:
+        if a.get('type') in _snapshot_ids:
+            for b in a:
+                changes.setdefault(snapshot_key(a), {}).setdefault(b, a[b])
+        elif a.get('type') == 'recreated' and a['key'] in changes:
+            # Deleted event-trigger task that a rollback created again, but didn't disable again yet
+            changes[a['key']]['RecreatedAlarmTaskId'] = a['AlarmTaskId']
+    return header, sorted(
+        (b for a, b in changes.items() if a not in rolled_back),
+        key=snapshot_key), len(changes)
+
+
+def snapshot_started(header):
+    """ When the run of a snapshot started, e.g. "run of mode 'grammy' started at 2026-10-19 01:06:04" """
+    return "run{} started at {}".format(
+        " of mode '{}'".format(header['mode']) if header.get('mode') else "",
+        time.strftime("%Y-%m-%d %H:%M:%S",
+                      time.localtime(header.get('started_at', 0))))
+
+
+def snapshot_mark(entry, kind='rolled_back', **fields):
+    """ Mark a change of the snapshot that's being rolled back (_snapshot), e.g. as rolled back """
+    with _output_lock:
+        _snapshot.write(
+            json.dumps(
+                dict(fields, type=kind, key=snapshot_key(entry)),
+                sort_keys=True) + "\n")
+        _snapshot.flush()
+        os.fsync(_snapshot.fileno())
+
+
+def rollback_plan(changes):
+    """
+        Changes grouped by scaling rule (or scaling group) name, in the order they're undone,
+        scaling group sizes go first since that's what protects the capacity
+    """
+    order = [a[0] for a in _rollback_steps]
+    plan = {}
+    for a in changes:
+        plan.setdefault(a['name'], []).append(a)
+    for a in plan.values():
+        a.sort(key=lambda b: order.index(b['type']))
+    return sorted(
+        plan.items(),
+        key=
+        lambda a: (all(b['type'] != 'scaling_group' for b in a[1]), a[0]))
+
+
+def rollback_description(entry, done=False):
+    """ What rolling back a snapshot entry does, e.g. "Restore the scaling group size (MaxInstance=10, MinInstance=2)" """
+    for kind, verb, past, what in _rollback_steps:
+        if kind == entry['type']:
+            break
+    if kind.startswith('created_') or kind.startswith('deleted_'):
+        details = entry[_snapshot_ids[kind]]
+    else:
+        details = ", ".join("{}={}".format(a, entry[a]) for a in sorted(entry)
+                            if a not in ('type', 'name', _snapshot_ids[kind]))
+    return "{} {} ({})".format(past if done else verb, what, details)
+
+
+def rollback_step(entry):
+    """ Undo one change of the snapshot in aliyun, returns the new ID of a recreated event-trigger task """
+    kind = entry['type']
+    if kind == 'scaling_group':
+        req = ess_request("ModifyScalingGroup")
+        req.set_ScalingGroupId(str(entry['ScalingGroupId']))
+        req.set_MinSize(entry['MinInstance'])
+        req.set_MaxSize(entry['MaxInstance'])
+    elif kind == 'scaling_rule':
+        req = ess_request("ModifyScalingRule")
+        req.set_ScalingRuleId(str(entry['ScalingRuleId']))
+        req.set_AdjustmentType(entry['AdjustmentType'])
+        req.set_AdjustmentValue(entry['AdjustmentValue'])
+        req.set_Cooldown(entry['Cooldown'])
+    elif kind == 'event_trigger_task':
+        # The run modified these attributes in place, so ModifyAlarm can set them back
+        setters = modify_alarm_setters()
+        req = ess_request("ModifyAlarm")
+        req.set_AlarmTaskId(str(entry['AlarmTaskId']))
+        for a in _event_trigger_task_attr + ["AlarmActions"]:
+            if entry.get(a) is None:
+                continue
+            if a == "AlarmActions":
+                value = [str(b) for b in entry[a]]
+            elif a in _numeric_attr:
+                value = entry[a]
+            else:
+                value = str(entry[a])
+            getattr(req, setters[a])(value)
+    elif kind == 'deleted_event_trigger_task':
+        alarm_task_id = entry.get('RecreatedAlarmTaskId')
+        if alarm_task_id is None:
+            req = create_alarm_request(
+                entry['name'], str(entry['ScalingGroupId']), entry,
+                [str(a) for a in entry['AlarmActions'] or ()])
+            alarm_task_id = yaml.safe_load(do_action(req))['AlarmTaskId']
+            # If disabling it fails, the next rollback only disables it instead of creating another one
+            snapshot_mark(entry, 'recreated', AlarmTaskId=alarm_task_id)
+        if not entry['Enable']:
+            req = ess_request("DisableAlarm")
+            req.set_AlarmTaskId(str(alarm_task_id))
+            do_action(req)
+        return alarm_task_id
+    elif kind == 'created_event_trigger_task':
+        req = ess_request("DeleteAlarm")
+        req.set_AlarmTaskId(str(entry['AlarmTaskId']))
+    else:
+        req = ess_request("DeleteScalingRule")
+        req.set_ScalingRuleId(str(entry['ScalingRuleId']))
+    do_action(req)
+    return None
+
+
+def rollback_changes(item):
+    """
+        Undo the changes of one scaling rule (or scaling group) in order, runs in a worker thread,
+        stops at the first error so the rest stays in the snapshot for the next rollback
+    """
+    name, entries = item
+    done = []
+    for a in entries:
+        try:
+            done.append((a, rollback_step(a)))
+        except ClientException:
+            return name, done, "API connection issue, please try again ({})".format(
+                sys.exc_value)
+        except:
+            return name, done, "Failed rolling back: {}".format(
+                sys.exc_info())
+    return name, done, None
+
+
+def rollback_cache_record(records, entry, alarm_task_id):
+    """ Apply a rolled back change into the records of a cache file, if the record there is the changed one """
+    kind = entry['type']
+    id_field = _snapshot_ids[kind]
+    if kind == 'scaling_group':
+        if entry['ScalingGroupId'] in records:
+            records[entry['ScalingGroupId']].MinInstance = entry['MinInstance']
+            records[entry['ScalingGroupId']].MaxInstance = entry['MaxInstance']
+        return
+    if kind == 'deleted_event_trigger_task':
+        records[entry['name']] = EventTriggerTaskRecord.from_dict(
+            dict(entry, Name=entry['name'], AlarmTaskId=alarm_task_id))
+        return
+
+    record = records.get(entry['name'])
+    if record is None or record[id_field] != entry[id_field]:
+        return
+    if kind.startswith('created_'):
+        del records[entry['name']]
+    elif kind == 'scaling_rule':
+        for a in _scaling_rule_attr:
+            record[a] = entry[a]
+        record.Fingerprint = scaling_rule_fingerprint(record)
+    else:
+        for a in _event_trigger_task_attr + ["AlarmActions"]:
+            if a in entry:
+                record[a] = entry[a]
+        if record.AlarmActions is not None:
+            record.AlarmActions = tuple(record.AlarmActions)
+        record.Fingerprint = event_trigger_task_fingerprint(record)
+
+
+def rollback_caches(rolled_back):
+    """ Apply the rolled back changes into the cache files that exist, instead of syncing them again """
+    caches = {}
+    for a, b in rolled_back:
+        if a['type'] == 'scaling_group':
+            kind = 'scaling_groups'
+        elif a['type'].endswith('scaling_rule'):
+            kind = 'rules'
+        else:
+            kind = 'event_trigger_tasks'
+        if kind not in caches:
+            try:
+                caches[kind] = load_cache(kind)
+            except IOError:
+                caches[kind] = None
+        if caches[kind] is not None:
+            rollback_cache_record(caches[kind], a, b)
+
+    for a in sorted(caches):
+        if caches[a] is not None:
+            dump_cache(caches[a], a)
+
+
+def rollback(args):
+    """ Undo the changes of a run that changed something in aliyun, from its snapshot, without syncing anything """
+    global _shard, _noconfirm, _snapshot
+    started = time.time()
+    _shard = parse_shard(args.shard)
+    _noconfirm = args.noconfirm
+    init_logging(args.log_file)
+
+    snapshots = snapshot_files()
+    if args.list:
+        for a in reversed(snapshots):
+            header, changes, total = load_snapshot(a)
+            print "{}: {}, {} of {} changes to roll back".format(
+                os.path.basename(a), snapshot_started(header), len(changes),
+                total)
+        return
+
+    # The given snapshot, otherwise the last one that still has changes to roll back
+    if args.snapshot:
+        snapshot_path = args.snapshot
+        if not os.path.exists(snapshot_path):
+            snapshot_path = os.path.join(
+                os.path.dirname(cache_file('snapshot')), args.snapshot)
+        try:
+            header, changes, total = load_snapshot(snapshot_path)
+        except IOError:
+            print "ERROR: Can't read snapshot {}".format(
+                args.snapshot), sys.exc_value
+            sys.exit(1)
+    else:
+        changes = None
+        for snapshot_path in reversed(snapshots):
+            header, changes, total = load_snapshot(snapshot_path)
+            if changes:
+                break
+        if changes is None:
+            print "ERROR: There's no snapshot to roll back, no run changed anything in aliyun yet"
+            sys.exit(1)
+    if not changes:
+        print "Nothing to roll back, every change in {} was rolled back already".format(
+            os.path.basename(snapshot_path))
+        return
+
+    plan = rollback_plan(changes)
+    print "Changes of the {} ({}):".format(
+        snapshot_started(header), os.path.basename(snapshot_path))
+    for name, entries in plan:
+        for a in entries:
+            print "{}: {}".format(name, rollback_description(a))
+    if not query_yes_no("Roll back these {} changes in aliyun?".format(
+            len(changes))):
+        return
+
+    init_client(args)
+    if args.cache_url:
+        init_remote_cache(args.cache_url)
+
+    # Every scaling rule (or scaling group) is rolled back on its own, they don't depend on each other
+    print ""
+    errors = 0
+    rolled_back = []
+    pool = multiprocessing.dummy.Pool(max(1, args.jobs))
+    _snapshot = open(snapshot_path, "a")
+    try:
+        for name, done, error in pool.imap_unordered(rollback_changes, plan):
+            for a, b in done:
+                report("CHANGED", name, rollback_description(a, True))
+                logging.debug("Rolled back {}: {}".format(name, a))
+                snapshot_mark(a)
+            rolled_back.extend(done)
+            if error:
+                errors += 1
+                report("ERROR", name, error)
+    finally:
+        pool.close()
+        _snapshot.close()
+
+    rollback_caches(rolled_back)
+
+    print "\nRolled back {} of {} changes in {:.2f}s".format(
+        len(rolled_back), len(changes), time.time() - started)
+    if errors:
+        print "Run rollback again to retry the changes that failed"
+        sys.exit(1)
+
+
+def add_rollback_arguments(parser):
+    """ Arguments of the 'rollback' command """
+    parser.description = "Undo the changes of a run (or emergency) that changed something in aliyun, " \
+        "from the snapshot it wrote before changing them, without syncing everything"
+    parser.add_argument(
+        "access_key_id", help="Accesskey ID for aliyun account")
+    parser.add_argument(
+        "access_key_secret", help="AccessKey secret for aliyun account")
+    parser.add_argument(
+        "region_id", help="ID of the region where the service is called")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        dest="jobs",
+        type=int,
+        default=8,
+        help="Number of scaling rules and scaling groups rolled back at once, default: 8")
+    parser.add_argument(
+        "--shard",
+        action="store",
+        dest="shard",
+        default="",
+        help="Roll back the runs of shard i of N (e.g. 1/4)")
+    parser.add_argument(
+        "--snapshot",
+        action="store",
+        dest="snapshot",
+        default="",
+        help=
+        "Snapshot to roll back (see --list), default: the last one with changes that weren't rolled back")
+    parser.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        dest="list",
+        help="List the snapshots, newest first, without rolling anything back")
+    parser.add_argument(
+        "--cache-url",
+        action="store",
+        dest="cache_url",
+        default="",
+        help=
+        "Share cache files with other runs through a remote cache (file:///path/to/dir, or http://host:port of the cache-server command)"
+    )
+    parser.add_argument(
+        "-n",
+        "--noconfirm",
+        dest="noconfirm",
+        action="store_true",
+        help="Skip interactive prompts (yes to all)")
+    parser.add_argument(
+        "-o",
+        "--log-file",
+        action="store",
+        dest="log_file",
+        default="log/autoscale_rules_mode.log",
+        help=
+        "Absolute path for log file, default: 'log/autoscale_rules_mode.log'")
+
+
+def feed_params(data):
+    """
+        Request parameters or response elements of a change feed event as plain strings,
+        AlarmAction.1, AlarmAction.2, ... are collected into AlarmActions
+    """
+    params = {}
+    indexed = []
+    for a, b in (data or {}).items():
+        if isinstance(b, unicode):
+            b = b.encode('utf-8')
+        match = re.match(r'^AlarmAction\.(\d+)$', a)
+        if match:
+            indexed.append((int(match.group(1)), b))
+        else:
+            params[str(a)] = b
+    if indexed:
+        params['AlarmActions'] = [b for a, b in sorted(indexed)]
+    return params
+
+
+def feed_number(value):
+    """ Numbers are strings in the request parameters of change feed events ("60") """
+    for a in (int, float):
+        try:
+            return a(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
+def find_record(records, attr, record_id):
+    """ Name of the cached record with the given ID (e.g. ScalingRuleId), None if it's not cached """
+    for a, b in records.items():
+        if b[attr] == record_id:
+            return a
+    return None
+
+
+def fetch_feed_scaling_rule(scaling_rule_id):
+    """ Fetch one scaling rule by ID into the cached rules, when an event doesn't tell everything about it """
+    req = ess_request("DescribeScalingRules")
+    req.set_ScalingRuleId1(str(scaling_rule_id))
+    name = find_record(_current_rules, 'ScalingRuleId', scaling_rule_id)
+    if name is not None:
+        del _current_rules[name]
+    for a in yaml.safe_load(do_action(req))['ScalingRules']['ScalingRule']:
+        if rule_in_shard(a['ScalingRuleName']):
+            rule = ScalingRuleRecord.from_dict(a)
+            _current_rules[rule.ScalingRuleName] = rule
+
+
+def fetch_feed_scaling_group(scaling_group_id):
+    """ Fetch one scaling group by ID into the cached scaling groups """
+    req = ess_request("DescribeScalingGroups")
+    req.set_ScalingGroupId1(str(scaling_group_id))
+    forget_feed_scaling_group(scaling_group_id)
+    for a in yaml.safe_load(
+            do_action(req))['ScalingGroups']['ScalingGroup']:
+        if in_shard(a['ScalingGroupName']):
+            add_scaling_group(_scaling_groups, a)
+
+
+def fetch_feed_event_trigger_task(alarm_task_id):
+    """ Fetch one event-trigger task by ID into the cached event-trigger tasks """
+    req = ess_request("DescribeAlarms")
+    req.set_AlarmTaskId(str(alarm_task_id))
+    name = find_record(_event_trigger_tasks, 'AlarmTaskId', alarm_task_id)
+    if name is not None:
+        del _event_trigger_tasks[name]
+    for a in yaml.safe_load(do_action(req))['AlarmList']['Alarm']:
+        if rule_in_shard(a['Name']):
+            task = EventTriggerTaskRecord.from_api(a)
+            _event_trigger_tasks[task.Name] = task
+
+
+def forget_feed_scaling_group(scaling_group_id):
+    """ Drop a scaling group from the cached scaling groups (both its name => ID and ID => size entries) """
+    _scaling_groups.pop(scaling_group_id, None)
+    for a in [a for a, b in _scaling_groups.items() if b == scaling_group_id]:
+        del _scaling_groups[a]
+
+
+def apply_feed_scaling_rule(event, params, response):
+    """ CreateScalingRule, ModifyScalingRule and DeleteScalingRule events """
+    scaling_rule_id = params.get('ScalingRuleId') or response.get(
+        'ScalingRuleId')
+    name = find_record(_current_rules, 'ScalingRuleId', scaling_rule_id)
+
+    if event == "DeleteScalingRule":
+        if name is not None:
+            del _current_rules[name]
+        return -1
+
+    if event == "CreateScalingRule":
+        if not rule_in_shard(params['ScalingRuleName']):
+            return 1
+        if not response.get('ScalingRuleAri'):
+            fetch_feed_scaling_rule(scaling_rule_id)
+            return 1 if name is None else 0
+        rule = dict((a, feed_number(params.get(a))) for a in _scaling_rule_attr)
+        rule.update(
+            ScalingRuleName=params['ScalingRuleName'],
+            ScalingRuleId=scaling_rule_id,
+            ScalingRuleAri=response['ScalingRuleAri'],
+            ScalingGroupId=params['ScalingGroupId'])
+        _current_rules[params['ScalingRuleName']] = ScalingRuleRecord.from_dict(
+            rule)
+        return 1 if name is None else 0
+
+    # ModifyScalingRule, rules of other shards are only fetched if they were renamed into this one
+    if name is None:
+        if 'ScalingRuleName' in params and rule_in_shard(
+                params['ScalingRuleName']):
+            fetch_feed_scaling_rule(scaling_rule_id)
+        return 0
+    rule = _current_rules.pop(name)
+    for a in _scaling_rule_attr:
+        if a in params:
+            rule[a] = feed_number(params[a])
+    rule.ScalingRuleName = intern_name(
+        str(params.get('ScalingRuleName', name)))
+    rule.Fingerprint = scaling_rule_fingerprint(rule)
+    if rule_in_shard(rule.ScalingRuleName):
+        _current_rules[rule.ScalingRuleName] = rule
+    return 0
+
+
+def apply_feed_scaling_group(event, params, response):
+    """ CreateScalingGroup, ModifyScalingGroup and DeleteScalingGroup events """
+    scaling_group_id = params.get('ScalingGroupId') or response.get(
+        'ScalingGroupId')
+
+    if event == "DeleteScalingGroup":
+        # Its scaling rules and event-trigger tasks are deleted with it
+        forget_feed_scaling_group(scaling_group_id)
+        deleted_rules = [
+            a for a in _current_rules
+            if _current_rules[a].ScalingGroupId == scaling_group_id
+        ]
+        for a in deleted_rules:
+            del _current_rules[a]
+        for a in [
+                a for a in _event_trigger_tasks
+                if _event_trigger_tasks[a].ScalingGroupId == scaling_group_id
+        ]:
+            del _event_trigger_tasks[a]
+        # The rules of other shards' scaling groups aren't cached, their count is unknown
+        return -len(deleted_rules) if not _shard else None
+
+    if event == "CreateScalingGroup":
+        if in_shard(params['ScalingGroupName']):
+            add_scaling_group(
+                _scaling_groups, {
+                    'ScalingGroupId': scaling_group_id,
+                    'ScalingGroupName': params['ScalingGroupName'],
+                    'MinSize': feed_number(params.get('MinSize')),
+                    'MaxSize': feed_number(params.get('MaxSize')),
+                })
+        return 0
+
+    # ModifyScalingGroup
+    group = _scaling_groups.get(scaling_group_id)
+    if group is None or 'ScalingGroupName' in params:
+        if group is not None or ('ScalingGroupName' in params
+                                 and in_shard(params['ScalingGroupName'])):
+            fetch_feed_scaling_group(scaling_group_id)
+        return 0
+    if 'MinSize' in params:
+        group.MinInstance = feed_number(params['MinSize'])
+    if 'MaxSize' in params:
+        group.MaxInstance = feed_number(params['MaxSize'])
+    return 0
+
+
+def apply_feed_event_trigger_task(event, params, response):
+    """ CreateAlarm, ModifyAlarm, DeleteAlarm, EnableAlarm and DisableAlarm events """
+    alarm_task_id = params.get('AlarmTaskId') or response.get('AlarmTaskId')
+    name = find_record(_event_trigger_tasks, 'AlarmTaskId', alarm_task_id)
+
+    if event == "DeleteAlarm":
+        if name is not None:
+            del _event_trigger_tasks[name]
+        return 0
+
+    if event in ("EnableAlarm", "DisableAlarm"):
+        if name is not None:
+            _event_trigger_tasks[name].Enable = event == "EnableAlarm"
+        return 0
+
+    if event == "CreateAlarm":
+        if not rule_in_shard(params['Name']):
+            return 0
+        fields = {
+            'Name': params['Name'],
+            'AlarmTaskId': alarm_task_id,
+            'ScalingGroupId': params.get('ScalingGroupId'),
+            'Enable': True,
+            'AlarmActions': params.get('AlarmActions', []),
+        }
+        for a, b in _feed_alarm_params.items():
+            fields[b] = feed_number(params.get(a))
+        _event_trigger_tasks[params['Name']] = EventTriggerTaskRecord.from_dict(
+            fields)
+        return 0
+
+    # ModifyAlarm
+    if name is None:
+        if 'Name' in params and rule_in_shard(params['Name']):
+            fetch_feed_event_trigger_task(alarm_task_id)
+        return 0
+    task = _event_trigger_tasks.pop(name)
+    for a, b in _feed_alarm_params.items():
+        if a in params and a != 'Name':
+            task[b] = feed_number(params[a])
+    if 'AlarmActions' in params:
+        task.AlarmActions = tuple(
+            intern_name(str(a)) for a in params['AlarmActions'])
+    task.Name = intern_name(str(params.get('Name', name)))
+    task.Fingerprint = event_trigger_task_fingerprint(task)
+    if rule_in_shard(task.Name):
+        _event_trigger_tasks[task.Name] = task
+    return 0
+
+
+# Change feed events that change the cached inventory, anything else in the feed is skipped
+_feed_event_handlers = {
+    'CreateScalingRule': apply_feed_scaling_rule,
+    'ModifyScalingRule': apply_feed_scaling_rule,
+    'DeleteScalingRule': apply_feed_scaling_rule,
+    'CreateScalingGroup': apply_feed_scaling_group,
+    'ModifyScalingGroup': apply_feed_scaling_group,
+    'DeleteScalingGroup': apply_feed_scaling_group,
+    'CreateAlarm': apply_feed_event_trigger_task,
+    'ModifyAlarm': apply_feed_event_trigger_task,
+    'DeleteAlarm': apply_feed_event_trigger_task,
+    'EnableAlarm': apply_feed_event_trigger_task,
+    'DisableAlarm': apply_feed_event_trigger_task,
+}
+
+# CreateAlarm/ModifyAlarm request parameters => our config attribute names
+_feed_alarm_params = {
+    'Name': 'Name',
+    'MetricName': 'MetricItem',
+    'Statistics': 'Condition',
+    'ComparisonOperator': 'ComparisonOperator',
+    'Threshold': 'Threshold',
+    'EvaluationCount': 'TriggerAfter',
+    'Period': 'RefreshCycleSeconds',
+}
+
+
+def load_feed_inventory():
+    """
+        Load the cached inventory the change feed is applied to, with the last applied sequence number,
+        the sequence number is None if anything is missing (a full resync is needed first)
+    """
+    global _current_rules, _scaling_groups, _event_trigger_tasks
+    try:
+        _current_rules = load_cache('rules')
+        _scaling_groups = load_cache('scaling_groups')
+        _event_trigger_tasks = load_cache('event_trigger_tasks')
+        with open(cache_file('feed', 'json')) as file:
+            seq = int(json.load(file)['seq'])
+        with open(cache_file('rules', 'meta.json')) as file:
+            total_count = json.load(file).get('TotalCount')
+    except (IOError, ValueError, KeyError, TypeError):
+        return None, None
+    return seq, total_count
+
+
+def resync_feed_inventory():
+    """ Sync everything from aliyun again, returns the scaling rules count of aliyun """
+    global _current_rules
+    load_scaling_groups()
+    _current_rules = reconstruct_current_rules_cache()
+    load_event_trigger_tasks()
+    with open(cache_file('rules', 'meta.json')) as file:
+        return json.load(file)['TotalCount']
+
+
+def dump_feed_inventory(seq, total_count):
+    """ Save the inventory after applying change feed events, it's as fresh as a sync from aliyun """
+    dump_cache(_current_rules, 'rules')
+    dump_cache(_scaling_groups, 'scaling_groups')
+    dump_cache(_event_trigger_tasks, 'event_trigger_tasks')
+    if total_count is None:
+        # --probe-sync and --cache-max-age won't trust cached_rules.yaml until the next full sync
+        if os.path.exists(cache_file('rules', 'meta.json')):
+            os.remove(cache_file('rules', 'meta.json'))
+    else:
+        dump_rules_total_count(total_count)
+    with open(cache_file('feed', 'json'), "w") as file:
+        json.dump({'seq': seq, 'AppliedAt': time.time()}, file)
+
+
+def apply_feed_events(lines, seq, total_count):
+    """
+        Apply change feed events (JSON lines) in order of their sequence number,
+        events up to seq were applied already, a gap in the sequence means events were missed
+        and everything is synced from aliyun again. Returns the new seq and scaling rules count,
+        and the lines left from an event that failed (they're passed in again on the next poll)
+    """
+    applied = skipped = resynced = 0
+    first_seq = None
+    pending = []
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            event = json.loads(line)
+            event_seq = int(event['seq'])
+        except (ValueError, KeyError, TypeError):
+            print "WARNING: Skipping invalid change feed event:", line.strip()
+            continue
+        if seq is not None and event_seq <= seq:
+            continue
+
+        if seq is None or event_seq != seq + 1:
+            if seq is None:
+                print "No change feed position cached, syncing everything from aliyun"
+            else:
+                print "Change feed gap (event {} after {}), syncing everything from aliyun".format(
+                    event_seq, seq)
+            # The synced inventory already includes this event
+            total_count = resync_feed_inventory()
+            resynced += 1
+        elif event.get('serviceName', 'Ess') != 'Ess' or event.get(
+                'eventName') not in _feed_event_handlers:
+            skipped += 1
+        else:
+            handler = _feed_event_handlers[event['eventName']]
+            try:
+                counted = handler(event['eventName'],
+                                  feed_params(event.get('requestParameters')),
+                                  feed_params(event.get('responseElements')))
+            except (ClientException, ServerException):
+                print "ERROR fetching {} of change feed event {} from aliyun: API connection issue, trying again on the next poll".format(
+                    event['eventName'], event_seq)
+                print sys.exc_value
+                pending = lines[i:]
+                break
+            except KeyError:
+                print "WARNING: Change feed event {} ({}) is missing {}, syncing everything from aliyun".format(
+                    event_seq, event['eventName'], sys.exc_value)
+                total_count = resync_feed_inventory()
+                resynced += 1
+                counted = 0
+            if counted is None:
+                total_count = None
+            elif total_count is not None:
+                total_count += counted
+            applied += 1
+            logging.debug("Applied change feed event {}: {}".format(
+                event_seq, event))
+        if first_seq is None:
+            first_seq = event_seq
+        seq = event_seq
+
+    if first_seq is not None:
+        dump_feed_inventory(seq, total_count)
+        print "Applied {} change feed events ({} to {}), {} skipped, {} full resyncs".format(
+            applied, first_seq, seq, skipped, resynced)
+    return seq, total_count, pending
+
+
+def sync_feed(args):
+    """ Keep the cache files fresh from a change feed of ESS configuration events instead of polling aliyun """
+    global _shard
+    init_logging(args.log_file)
+    init_client(args)
+    _shard = parse_shard(args.shard)
+    if args.cache_url:
+        init_remote_cache(args.cache_url)
+
+    seq, total_count = load_feed_inventory()
+    if seq is not None:
+        print "Applying change feed events after {} to the cache files".format(
+            seq)
+
+    try:
+        feed = sys.stdin if args.feed == '-' else open(args.feed)
+    except IOError:
+        print "ERROR: Can't read the change feed", sys.exc_value
+        sys.exit(1)
+
+    pending = []
+    try:
+        while True:
+            feed, lines = read_feed_lines(feed, args.feed, args.follow)
+            lines = pending + lines
+            if lines:
+                seq, total_count, pending = apply_feed_events(
+                    lines, seq, total_count)
+            if not args.follow or feed is sys.stdin:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def read_feed_lines(feed, path, follow=True):
+    """
+        Lines appended to a change feed file since the last read, it's read from the start again if it was truncated or rotated.
+        When following, a last line without its newline is still being written: it's left for the next read
+    """
+    if feed is not sys.stdin and os.stat(path).st_size < feed.tell():
+        feed.close()
+        feed = open(path)
+    lines = feed.readlines()
+    if follow and feed is not sys.stdin and lines and not lines[-1].endswith("\n"):
+        feed.seek(-len(lines.pop()), os.SEEK_CUR)
+    return feed, lines
+
+
+def add_sync_feed_arguments(parser):
+    """ Arguments of the 'sync-feed' command """
+    parser.description = "Apply a change feed of ESS configuration events (JSON lines) to the cache files, " \
+        "everything is only synced from aliyun again when events were missed"
+    parser.add_argument(
+        "access_key_id", help="Accesskey ID for aliyun account")
+    parser.add_argument(
+        "access_key_secret", help="AccessKey secret for aliyun account")
+    parser.add_argument(
+        "region_id", help="ID of the region where the service is called")
+    parser.add_argument(
+        "feed", help="Change feed file (JSON lines), '-' to read stdin")
+    parser.add_argument(
+        "-f",
+        "--follow",
+        dest="follow",
+        action="store_true",
+        help="Keep applying events appended to the change feed file")
+    parser.add_argument(
+        "--interval",
+        action="store",
+        dest="interval",
+        type=float,
+        default=1,
+        help="Seconds between checks of the change feed with --follow, default: 1")
+    parser.add_argument(
+        "--shard",
+        action="store",
+        dest="shard",
+        default="",
+        help="Only keep the cache files of shard i of N (e.g. 1/4) fresh")
+    parser.add_argument(
+        "--cache-url",
+        action="store",
+        dest="cache_url",
+        default="",
+        help=
+        "Share cache files with other runs through a remote cache (file:///path/to/dir, or http://host:port of the cache-server command)"
+    )
+    parser.add_argument(
+        "-o",
+        "--log-file",
+        action="store",
+        dest="log_file",
+        default="log/autoscale_rules_mode.log",
+        help=
+        "Absolute path for log file, default: 'log/autoscale_rules_mode.log'")
+
+
+def compute_drift():
+    """
+        What a run of the mode config would change in aliyun, counted by (app, kind) (see _drift_kinds),
+        with the same comparisons main() makes, without changing anything
+    """
+    drift = {}
+    changes = []
+    for a in _current_rules:
+        if rule_type(a) == -1:
+            continue
+        changes.extend((a, b) for b in scaling_rule_drift(a))
+        if a not in _event_trigger_tasks:
+            changes.append((a, 'missing_event_trigger_task'))
+
+    for a in _config:
+        if a.find("default-") != -1 or rule_type(a) == -1:
+            continue
+        if a not in _current_rules:
+            changes.append((a, 'missing_scaling_rule'))
+        if 'MinInstance' in _config[a] and 'MaxInstance' in _config[
+                a] and scaling_group_drift(a):
+            changes.append((a, 'scaling_group'))
+
+    # Event-trigger tasks that no scaling rule flags as valid
+    for a in _event_trigger_tasks:
+        if a not in _current_rules or rule_type(a) == -1:
+            changes.append((a, 'invalid_event_trigger_task'))
+
+    for a, b in changes:
+        app = determine_scaling_group(a) or a
+        drift[app, b] = drift.get((app, b), 0) + 1
+    return drift
+
+
+def prometheus_line(name, labels, value):
+    """ One sample in the Prometheus text format, e.g. autoscale_drift{app="go-x",kind="scaling_rule"} 1 """
+    if labels:
+        name += "{" + ",".join('{}="{}"'.format(
+            a,
+            str(b).replace("\\", "\\\\").replace('"', '\\"').replace(
+                "\n", "\\n")) for a, b in sorted(labels.items())) + "}"
+    return "{} {}".format(name, repr(float(value)) if isinstance(
+        value, float) else value)
+
+
+class DriftExporter(object):
+    """
+        State of the 'exporter' command, run() refreshes the inventory and the drift every --interval seconds
+        and renders the metrics, which the /metrics endpoint serves as they are
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.feed = None
+        self.pending = []  # Change feed lines left from an event that failed
+        self.seq = self.total_count = None
+        self.syncs = {}  # Source => number of refreshes
+        self.sync_seconds = {}  # Source => duration of its last refresh
+        self.errors = 0
+        self.last_sync = None
+        self.drift = None
+        self.drift_seconds = None
+        self.text = self.render()
+
+    def refresh(self):
+        """
+            Bring the inventory up to date the cheapest way available, returns where it came from:
+                'feed': events appended to the --feed change feed since the last refresh
+                'cache': cache files synced less than --cache-max-age seconds ago (e.g. by sync-feed sharing --cache-url)
+                'aliyun': scaling groups and event-trigger tasks, and the scaling rules with --probe-sync
+        """
+        global _current_rules, _scaling_groups, _event_trigger_tasks
+        if self.feed is not None:
+            self.feed, lines = read_feed_lines(self.feed, self.args.feed)
+            lines = self.pending + lines
+            if lines:
+                self.seq, self.total_count, self.pending = apply_feed_events(
+                    lines, self.seq, self.total_count)
+            return 'feed'
+
+        if _remote_cache is not None:
+            pull_remote_caches(self.args.cache_url)
+        synced_ago = rules_cache_age()
+        if synced_ago is not None and synced_ago < self.args.cache_max_age:
+            try:
+                rules = load_cache('rules')
+                scaling_groups = load_cache('scaling_groups')
+                event_trigger_tasks = load_cache('event_trigger_tasks')
+            except IOError:
+                pass
+            else:
+                _current_rules, _scaling_groups = rules, scaling_groups
+                _event_trigger_tasks = event_trigger_tasks
+                return 'cache'
+
+        load_scaling_groups()
+        _current_rules = probe_current_rules()
+        load_event_trigger_tasks()
+        return 'aliyun'
+
+    def start_feed(self):
+        """ Follow the --feed change feed, everything is synced from aliyun first if there's no position cached """
+        try:
+            self.feed = open(self.args.feed)
+        except IOError:
+            print "ERROR: Can't read the change feed", sys.exc_value
+            sys.exit(1)
+        self.seq, self.total_count = load_feed_inventory()
+        if self.seq is None:
+            # Events already in the feed happened before that sync, the ones appended meanwhile are applied after it
+            self.seq = 0
+            self.feed, lines = read_feed_lines(self.feed, self.args.feed)
+            for a in lines:
+                try:
+                    self.seq = max(self.seq, int(json.loads(a)['seq']))
+                except (ValueError, KeyError, TypeError):
+                    pass
+            print "No change feed position cached, syncing everything from aliyun"
+            self.total_count = resync_feed_inventory()
+            dump_feed_inventory(self.seq, self.total_count)
+
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                if self.args.feed and self.feed is None:
+                    self.start_feed()
+                # The mode config may have been changed too
+                _config.clear()
+                load_mode_config(quiet=True)
+                source = self.refresh()
+                synced = time.time()
+                self.drift = compute_drift()
+                self.drift_seconds = time.time() - synced
+                self.sync_seconds[source] = synced - started
+                self.syncs[source] = self.syncs.get(source, 0) + 1
+                self.last_sync = synced
+            except (Exception, SystemExit):
+                # Keep serving the last drift, and try again next time
+                self.errors += 1
+                logging.debug("Drift exporter refresh failed: {}".format(
+                    sys.exc_info()))
+                print "ERROR refreshing the drift metrics:", sys.exc_value
+            self.text = self.render()
+            time.sleep(max(0, started + self.args.interval - time.time()))
+
+    def render(self):
+        """ Metrics in the Prometheus text format """
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.extend(prometheus_line(name, a, b) for a, b in samples)
+
+        def by(label, values):
+            return [({label: a}, b) for a, b in sorted(values.items())]
+
+        metric("autoscale_exporter_info", "gauge",
+               "Mode config and shard the drift is computed for", [({
+                   'mode': self.args.mode,
+                   'shard': self.args.shard,
+                   'version': __version__
+               }, 1)])
+        metric("autoscale_syncs_total", "counter",
+               "Refreshes of the inventory by source (feed, cache or aliyun)",
+               by('source', self.syncs))
+        metric("autoscale_sync_errors_total", "counter",
+               "Refreshes of the inventory or drift that failed",
+               [({}, self.errors)])
+        metric("autoscale_sync_duration_seconds", "gauge",
+               "Duration of the last refresh of the inventory by source",
+               by('source', dict((a, round(b, 3))
+                                 for a, b in self.sync_seconds.items())))
+        metric("autoscale_api_calls_total", "counter",
+               "Requests sent to aliyun by action",
+               by('action', _report['api_calls']))
+        if self.last_sync is None:
+            return "\n".join(lines) + "\n"
+
+        metric("autoscale_last_sync_timestamp_seconds", "gauge",
+               "When the inventory was last refreshed",
+               [({}, round(self.last_sync, 3))])
+        metric("autoscale_drift_duration_seconds", "gauge",
+               "Duration of the last drift computation",
+               [({}, round(self.drift_seconds, 3))])
+        if self.seq is not None:
+            metric("autoscale_feed_position", "gauge",
+                   "Sequence number of the last applied change feed event",
+                   [({}, self.seq)])
+        metric("autoscale_inventory", "gauge",
+               "Scaling rules, scaling groups and event-trigger tasks in aliyun (this shard)",
+               by('kind', {
+                   'rules': len(_current_rules),
+                   'scaling_groups': sum(1 for a in _scaling_groups.values()
+                                         if isinstance(a, ScalingGroupRecord)),
+                   'event_trigger_tasks': len(_event_trigger_tasks),
+               }))
+
+        totals = dict((a, 0) for a in _drift_kinds)
+        apps = dict((a, 0) for a in _scaling_groups
+                    if not isinstance(_scaling_groups[a], Record))
+        for (app, kind), count in self.drift.items():
+            totals[kind] += count
+            apps[app] = apps.get(app, 0) + count
+        metric("autoscale_drift_total", "gauge",
+               "Changes a run of the mode config would make, by kind",
+               by('kind', totals))
+        metric("autoscale_app_drift", "gauge",
+               "Changes a run of the mode config would make, by app",
+               by('app', apps))
+        metric("autoscale_drift", "gauge",
+               "Changes a run of the mode config would make, by app and kind (only the ones that differ)",
+               [({
+                   'app': a,
+                   'kind': b
+               }, c) for (a, b), c in sorted(self.drift.items())])
+
+        disabled = {}
+        for a in _event_trigger_tasks.values():
+            if a.Enable is False:
+                app = determine_scaling_group(a.Name) or a.Name
+                disabled[app] = disabled.get(app, 0) + 1
+        metric("autoscale_disabled_event_trigger_tasks", "gauge",
+               "Disabled event-trigger tasks by app, runs keep them disabled",
+               by('app', disabled))
+
+        return "\n".join(lines) + "\n"
+
+
+# Kinds of changes compute_drift() counts
+_drift_kinds = [
+    'scaling_rule', 'event_trigger_task', 'scaling_group',
+    'missing_scaling_rule', 'missing_event_trigger_task',
+    'invalid_event_trigger_task'
+]
+
+
+def exporter(args):
+    """ Serve the drift between aliyun and a mode config as Prometheus metrics, refreshed every --interval seconds """
+    import BaseHTTPServer
+    global _mode, _shard
+
+    _mode = args.mode
+    _shard = parse_shard(args.shard)
+    init_logging(args.log_file)
+    init_client(args)
+    if args.cache_url:
+        init_remote_cache(args.cache_url)
+
+    drift_exporter = DriftExporter(args)
+    refresher = threading.Thread(target=drift_exporter.run)
+    refresher.daemon = True
+    refresher.start()
+
+    class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """ GET /metrics """
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404, "Metrics are on /metrics")
+                return
+            text = drift_exporter.text
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(text)))
+            self.end_headers()
+            self.wfile.write(text)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics request: " + format % args)
+
+    server = BaseHTTPServer.HTTPServer((args.host, args.port),
+                                       MetricsRequestHandler)
+    print "Serving the drift of mode '{}' on http://{}:{}/metrics".format(
+        _mode, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def add_exporter_arguments(parser):
+    """ Arguments of the 'exporter' command """
+    parser.description = "Serve the drift between aliyun and a mode config as Prometheus metrics on /metrics, " \
+        "what a run would change by app, and how long refreshing the inventory took"
+    parser.add_argument(
+        "access_key_id", help="Accesskey ID for aliyun account")
+    parser.add_argument(
+        "access_key_secret", help="AccessKey secret for aliyun account")
+    parser.add_argument(
+        "region_id", help="ID of the region where the service is called")
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="store",
+        dest="mode",
+        default="normal",
+        help="Mode config to compare aliyun with, default: normal")
+    parser.add_argument(
+        "--interval",
+        action="store",
+        dest="interval",
+        type=float,
+        default=60,
+        help="Seconds between refreshes of the drift, default: 60")
+    parser.add_argument(
+        "--feed",
+        action="store",
+        dest="feed",
+        default="",
+        help=
+        "Keep the inventory fresh from this change feed file (JSON lines, see the sync-feed command)"
+    )
+    parser.add_argument(
+        "--cache-url",
+        action="store",
+        dest="cache_url",
+        default="",
+        help=
+        "Share cache files with other runs through a remote cache (file:///path/to/dir, or http://host:port of the cache-server command)"
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        action="store",
+        dest="cache_max_age",
+        type=int,
+        default=0,
+        help=
+        "Use the cache files without syncing if they were synced less than this many seconds ago, e.g. by sync-feed"
+    )
+    parser.add_argument(
+        "--shard",
+        action="store",
+        dest="shard",
+        default="",
+        help="Only compare shard i of N (e.g. 1/4)")
+    parser.add_argument(
+        "--host",
+        action="store",
+        dest="host",
+        default="127.0.0.1",
+        help="Address to listen on, default: 127.0.0.1")
+    parser.add_argument(
+        "--port",
+        action="store",
+        dest="port",
+        type=int,
+        default=9464,
+        help="Port to listen on, default: 9464")
+    parser.add_argument(
+        "-o",
+        "--log-file",
+        action="store",
+        dest="log_file",
+        default="log/autoscale_rules_mode.log",
+        help=
+        "Absolute path for log file, default: 'log/autoscale_rules_mode.log'")
+
+
+def config_entry_name(scaling_rule_name):
+    """ Name of the mode config entry used by a scaling rule (its own or the default one) """
+    if scaling_rule_name in _config:
+        return scaling_rule_name
+    if rule_type(scaling_rule_name) == 1:
+        return 'default-upscale'
+    elif rule_type(scaling_rule_name) == 0:
+        return 'default-downscale'
+    return None
+
+
+def build_query_tables(rules, scaling_groups, event_trigger_tasks):
+    """ Flatten cached state and the compiled mode config into rows of the 'query' command tables """
+    rule_by_ari = dict(
+        (rules[a]['ScalingRuleAri'], a) for a in rules
+        if 'ScalingRuleAri' in rules[a])
+
+    groups = []
+    for a in scaling_groups:
+        # _scaling_groups maps name => id and id => sizes
+        if not isinstance(scaling_groups[a], basestring):
+            continue
+        size = scaling_groups.get(scaling_groups[a], {})
+        config_size = {}
+        for b in (a + '-upscale', a + '-downscale'):
+            if 'MinInstance' in _config.get(b, {}) and 'MaxInstance' in _config[b]:
+                config_size = _config[b]
+        groups.append({
+            'ScalingGroupName': a,
+            'ScalingGroupId': scaling_groups[a],
+            'MinInstance': size.get('MinInstance'),
+            'MaxInstance': size.get('MaxInstance'),
+            'ConfigMinInstance': config_size.get('MinInstance'),
+            'ConfigMaxInstance': config_size.get('MaxInstance'),
+            'SizeInSync': not config_size or
+            (config_size['MinInstance'] == size.get('MinInstance') and
+             config_size['MaxInstance'] == size.get('MaxInstance')),
+        })
+
+    rule_rows = []
+    for a in rules:
+        entry = config_entry_name(a)
+        rule_rows.append({
+            'ScalingRuleName': a,
+            'App': determine_scaling_group(a),
+            'ScalingRuleId': rules[a].get('ScalingRuleId'),
+            'ScalingGroupId': rules[a].get('ScalingGroupId'),
+            'AdjustmentType': rules[a].get('AdjustmentType'),
+            'AdjustmentValue': rules[a].get('AdjustmentValue'),
+            'Cooldown': rules[a].get('Cooldown'),
+            'Config': entry,
+            'InSync': entry is not None and same_fingerprint(
+                scaling_rule_fingerprint(_config[entry]),
+                scaling_rule_fingerprint(rules[a])),
+            'HasEventTriggerTask': a in event_trigger_tasks,
+        })
+
+    alarm_rows = []
+    for a in event_trigger_tasks:
+        task = event_trigger_tasks[a]
+        target_rule = None
+        for b in task['AlarmActions'] or ():
+            target_rule = rule_by_ari.get(b, target_rule)
+        entry = config_entry_name(a)
+        alarm_rows.append({
+            'Name': a,
+            'App': determine_scaling_group(a),
+            'AlarmTaskId': task.get('AlarmTaskId'),
+            'ScalingGroupId': task.get('ScalingGroupId'),
+            'Enable': task.get('Enable'),
+            'State': task.get('State'),
+            'MetricItem': task.get('MetricItem'),
+            'Condition': task.get('Condition'),
+            'ComparisonOperator': task.get('ComparisonOperator'),
+            'Threshold': task.get('Threshold'),
+            'TriggerAfter': task.get('TriggerAfter'),
+            'RefreshCycleSeconds': task.get('RefreshCycleSeconds'),
+            'TargetRule': target_rule,
+            'RuleMissing': target_rule is None,
+            'InSync': entry is not None and same_fingerprint(
+                event_trigger_task_fingerprint(_config[entry]),
+                event_trigger_task_fingerprint(task)),
+        })
+
+    apps = set(a['ScalingGroupName'] for a in groups)
+    apps.update(a['App'] for a in rule_rows if a['App'])
+    apps.update(
+        determine_scaling_group(a) for a in _config
+        if a.find("default-") == -1 and determine_scaling_group(a))
+    groups_by_name = dict((a['ScalingGroupName'], a) for a in groups)
+    app_rows = []
+    for a in apps:
+        group = groups_by_name.get(a, {})
+        app_rows.append({
+            'App': a,
+            'ScalingGroupId': group.get('ScalingGroupId'),
+            'GroupExists': bool(group),
+            'MinInstance': group.get('MinInstance'),
+            'MaxInstance': group.get('MaxInstance'),
+            'InConfig': a + '-upscale' in _config or a + '-downscale' in _config,
+            'UpscaleConfig': config_entry_name(a + '-upscale'),
+            'DownscaleConfig': config_entry_name(a + '-downscale'),
+            'UpscaleRule': a + '-upscale' in rules,
+            'DownscaleRule': a + '-downscale' in rules,
+            'UpscaleEventTriggerTask': a + '-upscale' in event_trigger_tasks,
+            'DownscaleEventTriggerTask':
+            a + '-downscale' in event_trigger_tasks,
+        })
+
+    return {
+        'groups': sorted(groups, key=lambda a: a['ScalingGroupName']),
+        'rules': sorted(rule_rows, key=lambda a: a['ScalingRuleName']),
+        'alarms': sorted(alarm_rows, key=lambda a: a['Name']),
+        'apps': sorted(app_rows, key=lambda a: a['App']),
+    }
+
+
+def query_index_key(value):
+    """ Key of a value in the query indexes, numbers are keyed the same regardless of their type """
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        value = float(value)
+    return json.dumps(value)
+
+
+def load_query_index():
+    """
+        Load the prebuilt indexes of the 'query' command, rebuilding them only when
+        the cache files or the mode config files have changed since they were built
+    """
+    sources = {}
+    for a in [cache_file(b) for b in _query_cache_kinds] + mode_config_files():
+        try:
+            sources[a] = os.path.getmtime(a)
+        except OSError:
+            pass
+
+    index_file = cache_file('index.' + _mode, 'json')
+    try:
+        with open(index_file) as file:
+            index = json.load(file)
+        if index['sources'] == sources:
+            return index
+    except (IOError, ValueError, KeyError):
+        pass
+
+    try:
+        rules = load_cache('rules')
+        scaling_groups = load_cache('scaling_groups')
+        event_trigger_tasks = load_cache('event_trigger_tasks')
+    except IOError:
+        print "ERROR: Cached state not found, please run a sync against aliyun first"
+        print sys.exc_value
+        sys.exit(1)
+    load_mode_config(quiet=True)
+
+    tables = build_query_tables(rules, scaling_groups, event_trigger_tasks)
+    indexes = {}
+    for table in tables:
+        indexes[table] = {}
+        for i, row in enumerate(tables[table]):
+            for field in row:
+                indexes[table].setdefault(field, {}).setdefault(
+                    query_index_key(row[field]), []).append(i)
+
+    index = {'sources': sources, 'tables': tables, 'indexes': indexes}
+    try:
+        with open(index_file, "w") as file:
+            json.dump(index, file)
+    except IOError:
+        print "WARNING: Can't save query index into {}".format(index_file)
+    return index
+
+
+def parse_query_condition(condition):
+    """ Parse a '--where' condition (e.g. 'MinInstance<4') into (field, operator, value) """
+    match = re.match(r'^\s*(\w+)\s*(<=|>=|!=|=|<|>|~)\s*(.*?)\s*$', condition)
+    if not match:
+        print "ERROR: Invalid condition '{}', expected FIELD<op>VALUE with op one of = != < <= > >= ~".format(
+            condition)
+        sys.exit(1)
+    field, operator, value = match.groups()
+    return field, operator, yaml.safe_load(value) if value else None
+
+
+def query(args):
+    """ Answer questions about the inventory from cached state and mode config, without calling aliyun """
+    global _mode, _shard
+    _mode = args.mode
+    _shard = parse_shard(args.shard)
+
+    index = load_query_index()
+    rows = index['tables'][args.table]
+    fields = _query_fields[args.table]
+
+    conditions = [parse_query_condition(a) for a in args.where]
+    for field, operator, value in conditions:
+        if field not in fields:
+            print "ERROR: Unknown field '{}', {} has: {}".format(
+                field, args.table, ", ".join(fields))
+            sys.exit(1)
+
+    # Equality conditions are answered by the indexes, the rest by scanning what's left
+    matched = None
+    for field, operator, value in conditions:
+        if operator == '=':
+            found = set(index['indexes'][args.table].get(field, {}).get(
+                query_index_key(value), []))
+            matched = found if matched is None else matched & found
+    if matched is None:
+        matched = range(len(rows))
+
+    results = []
+    for i in sorted(matched):
+        row = rows[i]
+        keep = True
+        for field, operator, value in conditions:
+            current = row[field]
+            if operator == '!=':
+                keep = query_index_key(current) != query_index_key(value)
+            elif operator == '~':
+                keep = str(value).lower() in str(current).lower()
+            elif operator != '=':
+                keep = current is not None and {
+                    '<': current < value,
+                    '<=': current <= value,
+                    '>': current > value,
+                    '>=': current >= value,
+                }[operator]
+            if not keep:
+                break
+        if keep:
+            results.append(row)
+
+    if args.fields:
+        fields = args.fields.split(',')
+    results = [dict((a, b.get(a)) for a in fields) for b in results]
+
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return
+
+    widths = [
+        max([len(a)] + [len(str(b[a])) for b in results]) for a in fields
+    ]
+    print "  ".join(a.ljust(b) for a, b in zip(fields, widths))
+    for a in results:
+        print "  ".join(str(a[b]).ljust(c) for b, c in zip(fields, widths))
+    print "({} rows)".format(len(results))
+
+
+def add_query_arguments(parser):
+    """ Arguments of the 'query' command """
+    parser.description = "Query cached scaling groups, rules, event-trigger tasks and apps, " \
+        "together with the mode config, without calling aliyun"
+    parser.add_argument(
+        "table",
+        choices=sorted(_query_fields),
+        help="What to query: apps, groups, rules or alarms")
+    parser.add_argument(
+        "-w",
+        "--where",
+        action="append",
+        dest="where",
+        default=[],
+        help=
+        "Condition like 'MinInstance<4' or 'RuleMissing=true', operators: = != < <= > >= ~ (contains), repeat to combine"
+    )
+    parser.add_argument(
+        "-f",
+        "--fields",
+        action="store",
+        dest="fields",
+        default="",
+        help="Comma separated fields to show")
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="store",
+        dest="mode",
+        default="normal",
+        help="Autoscale event-trigger task mode config")
+    parser.add_argument(
+        "--shard",
+        action="store",
+        dest="shard",
+        default="",
+        help="Query the cache of shard i of N (e.g. 1/4)")
+    parser.add_argument(
+        "--json",
+        dest="json",
+        action="store_true",
+        help="Print results as JSON")
+
+
+def load_backtest_series(numpy, data_path):
+    """
+        Load CPU utilization series of every scaling group from local files
+        Supported inputs:
+            - An .npz file, one array per scaling group (array name is the scaling group name)
+            - A .csv file named after the scaling group, the last column is the CPU utilization
+            - A directory containing any of the above
+        Returns a list of scaling group names and a (groups x samples) float32 matrix
+    """
+    if os.path.isdir(data_path):
+        paths = sorted(
+            glob.glob(os.path.join(data_path, '*.npz')) +
+            glob.glob(os.path.join(data_path, '*.csv')))
+    else:
+        paths = [data_path]
+
+    series = {}
+    for path in paths:
+        if path.endswith('.npz'):
+            with numpy.load(path) as npz:
+                for name in npz.files:
+                    series[name] = numpy.asarray(npz[name], dtype=numpy.float32)
+        else:
+            name = os.path.splitext(os.path.basename(path))[0]
+            with open(path) as file:
+                first_line = file.readline()
+                file.seek(0)
+                try:
+                    float(first_line.strip().split(',')[-1])
+                    header = 0
+                except ValueError:
+                    header = 1
+                values = numpy.loadtxt(
+                    file, delimiter=',', skiprows=header, ndmin=2)
+            series[name] = values[:, -1].astype(numpy.float32)
+
+    if not series:
+        print "ERROR: No CPU utilization series found in '{}'".format(
+            data_path)
+        sys.exit(1)
+
+    groups = sorted(series)
+    samples = min(len(series[a]) for a in groups)
+    if any(len(series[a]) != samples for a in groups):
+        print "WARNING: Series have different lengths, using the first {} samples of each".format(
+            samples)
+
+    cpu = numpy.empty((len(groups), samples), dtype=numpy.float32)
+    for i, a in enumerate(groups):
+        cpu[i] = series[a][:samples]
+
+    return groups, cpu
+
+
+def backtest_compare(numpy, values, operators, thresholds):
+    """ Apply each group's ComparisonOperator row by row, values is a (groups x N) matrix """
+    functions = {
+        ">=": numpy.greater_equal,
+        ">": numpy.greater,
+        "<=": numpy.less_equal,
+        "<": numpy.less,
+    }
+    result = numpy.zeros(values.shape, dtype=bool)
+    for operator in set(operators):
+        rows = numpy.array([a == operator for a in operators])
+        result[rows] = functions[operator](values[rows],
+                                           thresholds[rows][:, None])
+    return result
+
+
+def backtest_alarm_fires(numpy, cpu, interval, rules):
+    """
+        Evaluate the event-trigger tasks of all groups at once
+        Returns a (groups x samples) matrix, True at the end of every refresh cycle where
+        the alarm fires (the condition held for TriggerAfter consecutive cycles)
+    """
+    group_count, samples = cpu.shape
+    fires = numpy.zeros((group_count, samples), dtype=bool)
+
+    cycles = numpy.array([
+        max(1, int(float(a['RefreshCycleSeconds']) // interval)) for a in rules
+    ])
+    conditions = [
+        canonical_value('Condition', a['Condition']).lower() for a in rules
+    ]
+    operators = [
+        canonical_value('ComparisonOperator', a['ComparisonOperator'])
+        for a in rules
+    ]
+    thresholds = numpy.array([float(a['Threshold']) for a in rules])
+    trigger_after = numpy.array([int(a['TriggerAfter']) for a in rules])
+    statistics = {
+        'average': numpy.mean,
+        'maximum': numpy.max,
+        'minimum': numpy.min,
+    }
+
+    # Groups sharing the same refresh cycle and condition are aggregated together
+    for cycle, condition in set(zip(cycles, conditions)):
+        rows = numpy.nonzero((cycles == cycle) & numpy.array(
+            [a == condition for a in conditions]))[0]
+        periods = samples // cycle
+        if periods == 0:
+            continue
+        if cycle == 1:
+            aggregated = cpu[rows]
+        else:
+            windows = cpu[rows, :periods * cycle].reshape(
+                len(rows), periods, cycle)
+            aggregated = statistics[condition](windows, axis=2)
+        breach = backtest_compare(numpy, aggregated,
+                                  [operators[a] for a in rows],
+                                  thresholds[rows])
+
+        # Length of the current run of consecutive breaching cycles
+        count = numpy.cumsum(breach, axis=1, dtype=numpy.int32)
+        run = count - numpy.maximum.accumulate(
+            numpy.where(breach, 0, count), axis=1)
+
+        period_ends = numpy.arange(1, periods + 1) * cycle - 1
+        fires[rows[:, None], period_ends] = run >= trigger_after[rows][:, None]
+
+    return fires
+
+
+def backtest_rule_arrays(numpy, rules, interval):
+    """ Returns (is_percent, adjustment_value, cooldown_samples) arrays of the given rules """
+    is_percent = numpy.array([
+        canonical_value('AdjustmentType', a['AdjustmentType']).lower() ==
+        'percentchangeincapacity' for a in rules
+    ])
+    adjustment_value = numpy.array(
+        [float(a['AdjustmentValue']) for a in rules])
+    cooldown = numpy.array(
+        [float(a.get('Cooldown', 0)) / interval for a in rules])
+    return is_percent, adjustment_value, cooldown
+
+
+def backtest(args):
+    """ Replay CPU utilization series against the selected mode config and predict scaling events """
+    global _mode, _verbose
+    _mode = args.mode
+    _verbose = args.verbose
+
+    try:
+        import numpy
+    except ImportError:
+        print "ERROR: backtest requires numpy, please install it first (pip2 install numpy)"
+        sys.exit(1)
+
+    load_mode_config()
+
+    started = time.time()
+    groups, cpu = load_backtest_series(numpy, args.data)
+    group_count, samples = cpu.shape
+    interval = args.interval
+    print "Loaded {} samples for {} scaling groups in {:.2f}s".format(
+        samples, group_count, time.time() - started)
+
+    started = time.time()
+    upscale_rules = []
+    downscale_rules = []
+    min_instance = numpy.empty(group_count)
+    max_instance = numpy.empty(group_count)
+    for i, a in enumerate(groups):
+        upscale_rules.append(get_rule(a + "-upscale"))
+        downscale_rules.append(get_rule(a + "-downscale"))
+
+        # MinInstance/MaxInstance can be specified in either the upscale or the downscale rule
+        min_instance[i] = args.min_instance
+        max_instance[i] = args.max_instance
+        for b in (upscale_rules[i], downscale_rules[i]):
+            if 'MinInstance' in b and 'MaxInstance' in b:
+                min_instance[i] = b['MinInstance']
+                max_instance[i] = b['MaxInstance']
+
+    upscale_fires = backtest_alarm_fires(numpy, cpu, interval, upscale_rules)
+    downscale_fires = backtest_alarm_fires(numpy, cpu, interval,
+                                           downscale_rules)
+    up_percent, up_value, up_cooldown = backtest_rule_arrays(
+        numpy, upscale_rules, interval)
+    down_percent, down_value, down_cooldown = backtest_rule_arrays(
+        numpy, downscale_rules, interval)
+
+    # Time spent above the upscale threshold, using raw samples
+    above_threshold = backtest_compare(
+        numpy, cpu, [
+            canonical_value('ComparisonOperator', a['ComparisonOperator'])
+            for a in upscale_rules
+        ], numpy.array([float(a['Threshold']) for a in upscale_rules]))
+    seconds_above_threshold = above_threshold.sum(axis=1) * interval
+
+    if args.initial_instances is not None:
+        capacity = numpy.clip(
+            numpy.full(group_count, float(args.initial_instances)),
+            min_instance, max_instance)
+    else:
+        capacity = min_instance.copy()
+    initial_capacity = capacity.copy()
+    peak_capacity = capacity.copy()
+    lowest_capacity = capacity.copy()
+    last_activity = numpy.full(group_count, -numpy.inf)
+    upscale_events = numpy.zeros(group_count, dtype=int)
+    downscale_events = numpy.zeros(group_count, dtype=int)
+    events = []
+    snapshot_times = []
+    snapshots = []
+
+    # Capacity depends on the previous activity, so we walk through time,
+    # but only through samples where at least one alarm fires, and all groups at once
+    upscale_fires = numpy.ascontiguousarray(upscale_fires.T)
+    downscale_fires = numpy.ascontiguousarray(downscale_fires.T)
+    active_samples = numpy.nonzero(
+        upscale_fires.any(axis=1) | downscale_fires.any(axis=1))[0]
+    for t in active_samples:
+        elapsed = t - last_activity
+        up = upscale_fires[t] & (elapsed >= up_cooldown)
+        down = downscale_fires[t] & ~up & (elapsed >= down_cooldown)
+        acting = up | down
+        if not acting.any():
+            continue
+
+        percent = numpy.where(up, up_percent, down_percent)
+        value = numpy.where(up, up_value, down_value)
+        delta = numpy.where(percent, capacity * value / 100.0, value)
+        delta = numpy.sign(delta) * numpy.ceil(numpy.abs(delta))
+        new_capacity = numpy.where(
+            acting, numpy.clip(capacity + delta, min_instance, max_instance),
+            capacity)
+        changed = new_capacity != capacity
+        if not changed.any():
+            continue
+
+        upscale_events += up & changed
+        downscale_events += down & changed
+        last_activity[changed] = t
+        if args.verbose:
+            for i in numpy.nonzero(changed)[0]:
+                events.append((int(t), groups[i], int(capacity[i]),
+                               int(new_capacity[i])))
+        capacity = new_capacity
+        numpy.maximum(peak_capacity, capacity, out=peak_capacity)
+        numpy.minimum(lowest_capacity, capacity, out=lowest_capacity)
+        if args.curves:
+            snapshot_times.append(t)
+            snapshots.append(capacity.astype(numpy.int32))
+
+    print "Evaluated {} scaling groups in {:.2f}s\n".format(
+        group_count, time.time() - started)
+
+    if args.curves:
+        # Instance count of every group at every sample, rebuilt from the capacity snapshots
+        snapshots.insert(0, initial_capacity.astype(numpy.int32))
+        positions = numpy.searchsorted(
+            numpy.array(snapshot_times, dtype=int),
+            numpy.arange(samples),
+            side='right')
+        curves = numpy.vstack(snapshots)[positions].T
+        numpy.savez_compressed(
+            args.curves,
+            groups=numpy.array(groups),
+            instances=curves,
+            interval=interval)
+        print "Saved instance count curves into {}\n".format(args.curves)
+
+    results = []
+    for i, a in enumerate(groups):
+        results.append({
+            'ScalingGroup': a,
+            'UpscaleEvents': int(upscale_events[i]),
+            'DownscaleEvents': int(downscale_events[i]),
+            'InitialInstance': int(initial_capacity[i]),
+            'LowestInstance': int(lowest_capacity[i]),
+            'PeakInstance': int(peak_capacity[i]),
+            'FinalInstance': int(capacity[i]),
+            'MinutesAboveUpscaleThreshold':
+            round(seconds_above_threshold[i] / 60.0, 1),
+        })
+
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return
+
+    row_format = "{:<40} {:>6} {:>6} {:>7} {:>7} {:>7} {:>7} {:>10}"
+    print row_format.format("SCALING GROUP", "UP", "DOWN", "START", "LOWEST",
+                            "PEAK", "FINAL", "MIN ABOVE")
+    for a in results:
+        print row_format.format(
+            a['ScalingGroup'], a['UpscaleEvents'], a['DownscaleEvents'],
+            a['InitialInstance'], a['LowestInstance'], a['PeakInstance'],
+            a['FinalInstance'], a['MinutesAboveUpscaleThreshold'])
+
+    if events:
+        print "\nPredicted scaling events (sample, scaling group, instances):"
+        for t, group, old, new in sorted(events):
+            print "{:>8} {}: {} => {}".format(t, group, old, new)
+
+
+def add_backtest_arguments(parser):
+    """ Arguments of the 'backtest' command """
+    parser.description = "Replay CPU utilization series from local CSV/NPZ files against a mode config " \
+        "and predict scaling events. Observed CPU is replayed as is, load shifting after a scaling " \
+        "activity is not modelled."
+    parser.add_argument(
+        "data",
+        help=
+        "CSV/NPZ file or directory of files with CPU utilization per scaling group"
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="store",
+        dest="mode",
+        default="normal",
+        help="Autoscale event-trigger task mode config")
+    parser.add_argument(
+        "-i",
+        "--interval",
+        action="store",
+        dest="interval",
+        type=int,
+        default=60,
+        help="Seconds between two samples, default: 60")
+    parser.add_argument(
+        "--min-instance",
+        action="store",
+        dest="min_instance",
+        type=int,
+        default=2,
+        help="MinInstance for rules that don't specify one, default: 2")
+    parser.add_argument(
+        "--max-instance",
+        action="store",
+        dest="max_instance",
+        type=int,
+        default=20,
+        help="MaxInstance for rules that don't specify one, default: 20")
+    parser.add_argument(
+        "--initial-instances",
+        action="store",
+        dest="initial_instances",
+        type=int,
+        default=None,
+        help="Instance count at the first sample, default: MinInstance")
+    parser.add_argument(
+        "--curves",
+        action="store",
+        dest="curves",
+        default=None,
+        help="Save instance count curves of every group into this .npz file")
+    parser.add_argument(
+        "--json",
+        dest="json",
+        action="store_true",
+        help="Print results as JSON")
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity, also lists every predicted scaling event")
+
+
+def merge_reports(args):
+    """ Combine the reports of every shard of a run into one """
+    reports = []
+    for a in args.reports:
+        try:
+            with open(a) as file:
+                reports.append(json.load(file))
+        except (IOError, ValueError):
+            print "ERROR: Can't read report {}".format(a), sys.exc_value
+            sys.exit(1)
+
+    # Make sure every shard of the run is there, exactly once
+    shards = [parse_shard(a.get('shard')) for a in reports]
+    if any(shards):
+        if not all(shards) or len(set(a[1] for a in shards)) != 1:
+            print "WARNING: Reports come from runs with different --shard N"
+        else:
+            count = shards[0][1]
+            indexes = [a[0] for a in shards]
+            missing = sorted(set(range(1, count + 1)) - set(indexes))
+            duplicated = sorted(
+                set(a for a in indexes if indexes.count(a) > 1))
+            if missing:
+                print "WARNING: Missing report of shard {}".format(
+                    ", ".join("{}/{}".format(a, count) for a in missing))
+            if duplicated:
+                print "WARNING: Duplicated report of shard {}".format(
+                    ", ".join("{}/{}".format(a, count) for a in duplicated))
+
+    merged = {
+        'mode': sorted(set(a.get('mode') for a in reports)),
+        'region': sorted(set(a.get('region') for a in reports)),
+        'shards': [a.get('shard') for a in reports],
+        'started_at': min(a.get('started_at') for a in reports),
+        'finished_at': max(a.get('finished_at') for a in reports),
+        'results': [b for a in reports for b in a['results']],
+        'api_calls': {},
+    }
+    for a in reports:
+        for b, c in a.get('api_calls', {}).items():
+            merged['api_calls'][b] = merged['api_calls'].get(b, 0) + c
+    merged['summary'] = summarize_results(merged['results'])
+
+    for a in merged['results']:
+        if a['status'] != 'SKIPPED' or args.verbose:
+            print "{} '{}': {}".format(a['status'], a['name'], a['message'])
+
+    print "\nMerged {} reports in {:.0f}s total:".format(
+        len(reports), merged['finished_at'] - merged['started_at'])
+    for a in sorted(merged['summary']):
+        print "{}: {}".format(a, merged['summary'][a])
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(merged, file, indent=2, sort_keys=True)
+
+
+def add_merge_reports_arguments(parser):
+    """ Arguments of the 'merge-reports' command """
+    parser.description = "Combine the --report files written by every shard of a run"
+    parser.add_argument(
+        "reports", nargs="+", help="Report files written using --report")
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        dest="output",
+        default=None,
+        help="Write the merged report into this file")
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Verbosity, also lists SKIPPED results")
+
+
+def replay(args):
+    """ Re-run a reconciliation recorded with --record-trace offline, against its recorded responses """
+    global _client, _cache_dir, _config_dir
+
+    entries = read_trace(args.trace)
+    header = entries[0]
+
+    # Start from the mode config and the caches the recorded run had, away from the real caches
+    _cache_dir = os.path.realpath(
+        args.cache_dir or tempfile.mkdtemp(prefix="autoscale-replay-"))
+    _config_dir = os.path.join(_cache_dir, 'config')
+    mode_dir = os.path.join(_config_dir, header['args']['mode'])
+    if not os.path.isdir(mode_dir):
+        os.makedirs(mode_dir)
+    for a in glob.glob(os.path.join(mode_dir, '*.yaml')) + glob.glob(
+            os.path.join(_cache_dir, 'cached_*')):
+        os.remove(a)
+    for a in header['config']:
+        with open(os.path.join(mode_dir, a), "w") as file:
+            file.write(header['config'][a])
+    for a in header['caches']:
+        with open(os.path.join(_cache_dir, a), "w") as file:
+            file.write(header['caches'][a])
+
+    _client = ReplayClient(entries[1:])
+    _random.seed(header['seed'])
+    print "Replaying {} recorded requests from {} in {}".format(
+        len([a for a in entries if a['type'] == 'call']), args.trace,
+        _cache_dir)
+
+    run_args = argparse.Namespace(
+        deadline=0, output="text", cache_url="", cache_max_age=0)
+    run_args.__dict__.update(header['args'])
+    run_args.__dict__.update(
+        access_key_id="",
+        access_key_secret="",
+        log_file=args.log_file,
+        report="",
+        record_trace="")
+    started = time.time()
+    try:
+        main(run_args)
+    finally:
+        import resource
+
+        _report['replay'] = {
+            'trace': args.trace,
+            'seconds': round(time.time() - started, 3),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'misses': _client.misses,
+            'unused': _client.unused(),
+        }
+        print "\nReplayed in {:.2f}s: {} API calls, {} requests or prompts not in the trace, {} recorded responses unused".format(
+            _report['replay']['seconds'], sum(_report['api_calls'].values()),
+            _client.misses, _client.unused())
+        if args.report:
+            write_report(args.report)
+
+    if _client.misses:
+        print "WARNING: The replay didn't follow the trace, its results aren't comparable"
+        sys.exit(1)
+
+
+def add_replay_arguments(parser):
+    """ Arguments of the 'replay' command """
+    parser.description = "Re-run a reconciliation recorded with --record-trace offline, " \
+        "serving the recorded responses instead of calling aliyun"
+    parser.add_argument("trace", help="Trace file written by --record-trace")
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        dest="cache_dir",
+        default="",
+        help=
+        "Directory for the recorded mode config and cache files, default: a new temporary directory"
+    )
+    parser.add_argument(
+        "--report",
+        action="store",
+        dest="report",
+        default="",
+        help="Write results of the replay into a JSON report file")
+    parser.add_argument(
+        "-o",
+        "--log-file",
+        action="store",
+        dest="log_file",
+        default="log/autoscale_rules_mode.log",
+        help=
+        "Absolute path for log file, default: 'log/autoscale_rules_mode.log'")
+
+
+def cache_server(args):
+    """ Reference server for --cache-url, keeps the cache files and their versions in a directory """
+    import BaseHTTPServer
+
+    backend = FileCacheBackend("file://" + os.path.realpath(args.directory))
+
+    class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """ GET and PUT cache files, with their version as ETag """
+
+        def cache_name(self):
+            name = self.path.lstrip('/')
+            if not re.match(r'^cached_[\w.-]+$', name) or '..' in name:
+                self.send_error(404, "Not a cache file")
+                return None
+            return name
+
+        def send_version(self, code, version, content=""):
+            self.send_response(code)
+            if version is not None:
+                self.send_header('ETag', '"{}"'.format(version))
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            name = self.cache_name()
+            if name is None:
+                return
+            version, content = backend.fetch(
+                name, parse_etag(self.headers.getheader('If-None-Match')))
+            if version is None:
+                self.send_error(404, "Cache file not found")
+            elif content is None:
+                self.send_version(304, version)
+            else:
+                self.send_version(200, version, content)
+
+        def do_PUT(self):
+            name = self.cache_name()
+            if name is None:
+                return
+            content = self.rfile.read(
+                int(self.headers.getheader('Content-Length', 0)))
+            if_match = self.headers.getheader('If-Match')
+            if if_match is None and self.headers.getheader(
+                    'If-None-Match') != '*':
+                self.send_error(428, "Use If-Match, or If-None-Match: *")
+                return
+            version = backend.store(name, content, parse_etag(if_match))
+            if version is None:
+                self.send_version(412, backend.version(name))
+            else:
+                self.send_version(200, version)
+
+    server = BaseHTTPServer.HTTPServer((args.host, args.port),
+                                       CacheRequestHandler)
+    print "Serving cache files of {} on http://{}:{}".format(
+        backend.path, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def add_cache_server_arguments(parser):
+    """ Arguments of the 'cache-server' command """
+    parser.description = "Serve cache files to every run using --cache-url http://host:port, " \
+        "with versions and compare-and-swap updates"
+    parser.add_argument(
+        "directory", help="Directory to keep the cache files in")
+    parser.add_argument(
+        "--host",
+        action="store",
+        dest="host",
+        default="127.0.0.1",
+        help="Address to listen on, default: 127.0.0.1")
+    parser.add_argument(
+        "--port",
+        action="store",
+        dest="port",
+        type=int,
+        default=8080,
+        help="Port to listen on, default: 8080")
+
+
+def deep_sizeof(obj, seen=None):
+    """ Memory used by an object and everything it references, shared objects are counted once """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for a, b in obj.iteritems():
+            size += deep_sizeof(a, seen) + deep_sizeof(b, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for a in obj:
+            size += deep_sizeof(a, seen)
+    elif isinstance(obj, Record):
+        for a in obj.__slots__:
+            size += deep_sizeof(getattr(obj, a), seen)
+    return size
+
+
+def synthetic_inventory(count):
+    """
+        DescribeScalingRules and DescribeAlarms items of 'count' scaling rules,
+        parsed from JSON like the real responses so every value is its own object
+    """
+    rules = []
+    alarms = []
+    for i in range(count):
+        app = "app-{}".format(i // 2)
+        name = "{}-{}".format(app, "upscale" if i % 2 == 0 else "downscale")
+        group_id = "asg-{:020d}".format(i // 2)
+        rule_id = "asr-{:020d}".format(i)
+        ari = "ari:acs:ess:ap-southeast-1:1208559439424161:scalingrule/" + rule_id
+        rules.append({
+            'ScalingRuleId': rule_id,
+            'ScalingGroupId': group_id,
+            'ScalingRuleName': name,
+            'ScalingRuleAri': ari,
+            'AdjustmentType': 'PercentChangeInCapacity',
+            'AdjustmentValue': 50 if i % 2 == 0 else -20,
+            'Cooldown': 60,
+            'MinSize': 2,
+            'MaxSize': 20,
+        })
+        alarms.append({
+            'AlarmTaskId': "{}_{:036d}".format(group_id, i),
+            'Name': name,
+            'ScalingGroupId': group_id,
+            'MetricType': 'system',
+            'MetricName': 'CpuUtilization',
+            'Statistics': 'Average',
+            'ComparisonOperator': '>=' if i % 2 == 0 else '<=',
+            'Threshold': 60.0 if i % 2 == 0 else 20.0,
+            'EvaluationCount': 3,
+            'Period': 60,
+            'State': 'OK',
+            'Enable': True,
+            'alarmActions': {
+                'alarmAction': [ari]
+            },
+            'Dimensions': {
+                'Dimension': [{
+                    'DimensionKey': 'scaling_group',
+                    'DimensionValue': group_id
+                }, {
+                    'DimensionKey': 'userId',
+                    'DimensionValue': '1208559439424161'
+                }]
+            },
+        })
+
+    # Round trip through JSON so values aren't shared like the literals above
+    def to_str(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, list):
+            return [to_str(a) for a in value]
+        if isinstance(value, dict):
+            return dict((to_str(a), to_str(b)) for a, b in value.iteritems())
+        return value
+
+    return to_str(json.loads(json.dumps(rules))), to_str(
+        json.loads(json.dumps(alarms)))
+
+
+def benchmark_memory(args):
+    """ Memory used by loaded inventory, full API dicts vs compact records """
+    sizes = [int(a) for a in args.sizes.split(',')]
+    row_format = "{:>8} {:>14} {:>14} {:>8} {:>10}"
+    print row_format.format("RULES", "DICTS (MB)", "RECORDS (MB)", "RATIO",
+                            "LOAD (s)")
+    results = []
+    for count in sizes:
+        rules, alarms = synthetic_inventory(count)
+
+        # What the loaders used to keep: every API object, plus copied and synthetic keys
+        dict_rules = {}
+        for a in copy.deepcopy(rules):
+            a['Fingerprint'] = scaling_rule_fingerprint(a)
+            dict_rules[a['ScalingRuleName']] = a
+        dict_tasks = {}
+        for a in copy.deepcopy(alarms):
+            a['TriggerAfter'] = a['EvaluationCount']
+            a['Condition'] = a['Statistics']
+            a['MetricItem'] = a['MetricName']
+            a['RefreshCycleSeconds'] = a['Period']
+            a['Fingerprint'] = event_trigger_task_fingerprint(a)
+            a['valid_name'] = False
+            dict_tasks[a['Name']] = a
+        dict_size = deep_sizeof((dict_rules, dict_tasks))
+        del dict_rules, dict_tasks
+
+        started = time.time()
+        record_rules = {}
+        for a in rules:
+            rule = ScalingRuleRecord.from_dict(a)
+            record_rules[rule.ScalingRuleName] = rule
+        record_tasks = {}
+        for a in alarms:
+            task = EventTriggerTaskRecord.from_api(a)
+            record_tasks[task.Name] = task
+        load_time = time.time() - started
+        del rules, alarms
+        record_size = deep_sizeof((record_rules, record_tasks))
+
+        results.append({
+            'rules': count,
+            'dicts_bytes': dict_size,
+            'records_bytes': record_size,
+            'load_seconds': round(load_time, 3),
+        })
+        print row_format.format(count, "{:.1f}".format(dict_size / 1048576.0),
+                                "{:.1f}".format(record_size / 1048576.0),
+                                "{:.2f}x".format(
+                                    float(dict_size) / record_size),
+                                "{:.2f}".format(load_time))
+    return results
+
+
+def benchmark_startup(args):
+    """ Startup time of commands that don't call aliyun, vs importing everything up front """
+    script = os.path.realpath(__file__)
+    if script.endswith('.pyc'):
+        script = script[:-1]
+    eager_imports = ["yaml", "aliyunsdkcore.client"] + [
+        "aliyunsdkess.request.v20140828.{}Request".format(a)
+        for a in _ess_actions
+    ]
+    commands = [
+        ("interpreter only", [sys.executable, "-c", "pass"]),
+        ("eager imports (previous startup)",
+         [sys.executable, "-c", "import " + ", ".join(eager_imports)]),
+        ("--help", [sys.executable, script, "--help"]),
+        ("--version", [sys.executable, script, "--version"]),
+        ("query --help", [sys.executable, script, "query", "--help"]),
+    ]
+
+    row_format = "{:<36} {:>12}"
+    print row_format.format("COMMAND", "MEDIAN (ms)")
+    results = []
+    with open(os.devnull, "w") as devnull:
+        for name, command in commands:
+            timings = []
+            for _ in range(args.runs):
+                started = time.time()
+                if subprocess.call(command, stdout=devnull, stderr=devnull):
+                    timings = None
+                    break
+                timings.append(time.time() - started)
+            median = None
+            if timings:
+                median = sorted(timings)[len(timings) // 2] * 1000
+            results.append({'command': name, 'median_ms': median})
+            print row_format.format(name, "n/a" if median is None else
+                                    "{:.1f}".format(median))
+    return results
+
+
+def benchmark_replay(args):
+    """
+        Replay traces recorded with --record-trace, fails when API calls grow,
+        or wall time or memory grow past --tolerance, compared with a --baseline
+    """
+    script = os.path.realpath(__file__)
+    if script.endswith('.pyc'):
+        script = script[:-1]
+    traces = [a for a in args.traces.split(',') if a]
+    if not traces:
+        print "ERROR: Use --traces to give the traces to replay"
+        sys.exit(1)
+
+    baseline = {}
+    if args.baseline:
+        try:
+            with open(args.baseline) as file:
+                baseline = dict((a['trace'], a) for a in json.load(file))
+        except (IOError, ValueError, KeyError, TypeError):
+            print "ERROR: Can't read baseline {}".format(
+                args.baseline), sys.exc_value
+            sys.exit(1)
+
+    row_format = "{:<28} {:>9} {:>11} {:>12} {:>7}  {}"
+    print row_format.format("TRACE", "API CALLS", "MEDIAN (s)", "MEMORY (MB)",
+                            "MISSES", "REGRESSIONS")
+    results = []
+    with open(os.devnull, "w") as devnull:
+        for trace in traces:
+            timings = []
+            runs = []
+            for _ in range(args.runs):
+                cache_dir = tempfile.mkdtemp(prefix="autoscale-replay-")
+                report_file = os.path.join(cache_dir, "report.json")
+                command = [
+                    sys.executable, script, "replay", trace, "--cache-dir",
+                    cache_dir, "--report", report_file, "-o", os.devnull
+                ]
+                started = time.time()
+                subprocess.call(command, stdout=devnull, stderr=devnull)
+                timings.append(time.time() - started)
+                try:
+                    with open(report_file) as file:
+                        runs.append(json.load(file))
+                except (IOError, ValueError):
+                    pass
+                shutil.rmtree(cache_dir)
+
+            result = {
+                'trace': os.path.basename(trace),
+                'runs': len(runs),
+                'api_calls': max([sum(a['api_calls'].values())
+                                  for a in runs] or [None]),
+                'median_seconds':
+                round(sorted(timings)[len(timings) // 2], 3),
+                'max_rss_mb': max([a['replay']['max_rss_kb'] / 1024.0
+                                   for a in runs] or [None]),
+                'misses': max([a['replay']['misses'] for a in runs] or [None]),
+                'regressions': [],
+            }
+            if len(runs) != args.runs:
+                result['regressions'].append("replay failed")
+            elif result['misses']:
+                result['regressions'].append("requests not in the trace")
+
+            previous = baseline.get(result['trace'])
+            if previous and runs:
+                if result['api_calls'] > previous['api_calls']:
+                    result['regressions'].append("API calls {} > {}".format(
+                        result['api_calls'], previous['api_calls']))
+                for a, b in [('median_seconds', "wall time"),
+                             ('max_rss_mb', "memory")]:
+                    if result[a] > previous[a] * (1 + args.tolerance):
+                        result['regressions'].append("{} {:.2f} > {:.2f}".format(
+                            b, result[a], previous[a]))
+
+            results.append(result)
+            print row_format.format(
+                result['trace'], result['api_calls'],
+                "{:.2f}".format(result['median_seconds']), "n/a"
+                if result['max_rss_mb'] is None else "{:.1f}".format(
+                    result['max_rss_mb']), result['misses'],
+                ", ".join(result['regressions']) or "-")
+    return results
+
+
+def benchmark(args):
+    """ Run one of the benchmark suites, exits with 1 if the suite found a regression """
+    results = _benchmarks[args.suite](args)
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if any(a.get('regressions') for a in results):
+        sys.exit(1)
+
+
+def add_benchmark_arguments(parser):
+    """ Arguments of the 'benchmark' command """
+    parser.description = "Measure memory and runtime of the script"
+    parser.add_argument(
+        "suite",
+        choices=sorted(_benchmarks),
+        help=
+        "memory: loaded inventory size with full API dicts vs records, startup: startup time of offline commands, replay: API calls, wall time and memory of replayed traces"
+    )
+    parser.add_argument(
+        "--sizes",
+        action="store",
+        dest="sizes",
+        default="10000,50000",
+        help="Comma separated number of scaling rules, default: 10000,50000")
+    parser.add_argument(
+        "--runs",
+        action="store",
+        dest="runs",
+        type=int,
+        default=5,
+        help="Runs of every command or trace in the startup and replay suites, default: 5")
+    parser.add_argument(
+        "--traces",
+        action="store",
+        dest="traces",
+        default="",
+        help="Comma separated traces written by --record-trace, for the replay suite")
+    parser.add_argument(
+        "--baseline",
+        action="store",
+        dest="baseline",
+        default="",
+        help="Results of an earlier replay suite run (see --output) to compare with")
+    parser.add_argument(
+        "--tolerance",
+        action="store",
+        dest="tolerance",
+        type=float,
+        default=0.25,
+        help=
+        "How much wall time and memory may grow over the baseline before it counts as a regression, default: 0.25"
+    )
+    parser.add_argument(
+        "--json",
+        dest="json",
+        action="store_true",
+        help="Also print results as JSON")
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        dest="output",
+        default="",
+        help="Write results as JSON into a file, e.g. as a --baseline")
+
+
+# Benchmark suites of the 'benchmark' command
+_benchmarks = {
+    'memory': benchmark_memory,
+    'startup': benchmark_startup,
+    'replay': benchmark_replay,
+}
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    # Commands with their own arguments, anything else is a normal sync run
+    commands = {
+        "backtest": (add_backtest_arguments, backtest),
+        "benchmark": (add_benchmark_arguments, benchmark),
+        "cache-server": (add_cache_server_arguments, cache_server),
+        "emergency": (add_emergency_arguments, emergency),
+        "exporter": (add_exporter_arguments, exporter),
+        "merge-reports": (add_merge_reports_arguments, merge_reports),
+        "query": (add_query_arguments, query),
+        "replay": (add_replay_arguments, replay),
+        "rollback": (add_rollback_arguments, rollback),
+        "sync-feed": (add_sync_feed_arguments, sync_feed),
+    }
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        add_arguments, run = commands[sys.argv[1]]
+        parser = argparse.ArgumentParser(
+            prog="{} {}".format(os.path.basename(sys.argv[0]), sys.argv[1]))
+        add_arguments(parser)
+        run(parser.parse_args(sys.argv[2:]))
+        sys.exit()
+
+    parser = argparse.ArgumentParser()
+
+    # Access Key
+    parser.add_argument(
+        "access_key_id", help="Accesskey ID for aliyun account")
+    parser.add_argument(
+        "access_key_secret", help="AccessKey secret for aliyun account")
+    parser.add_argument(
+        "region_id", help="ID of the region where the service is called")
+
+    # Optional argument which requires a parameter (eg. -m grammy)
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="store",
+        dest="mode",
+        default="normal",
+        help="Autoscale event-trigger task mode config")
+
+    # Optional argument which requires a parameter (eg. -l go-testapp-upscale,go-testapp-downscale)
+    parser.add_argument(
+        "-l",
+        "--limit",
+        action="store",
+        dest="limit",
+        default="",
+        help="Limit target rules")
+
+    # Optional argument which requires a parameter (eg. -o /var/log/file.log)
+    parser.add_argument(
+        "-o",
+        "--log-file",
         action="store",
         dest="log_file",
         default="log/autoscale_rules_mode.log",
@@ -1029,6 +5470,97 @@ if __name__ == "__main__":
         "Skip synching cached_rules.yaml for faster runtime if you're sure that no rules has been changed in aliyun"
     )
 
+    # Optional flag, a cheaper check of cached_rules.yaml than a full sync
+    parser.add_argument(
+        "--probe-sync",
+        dest="probe_sync",
+        action="store_true",
+        help=
+        "Use cached_rules.yaml after checking its count and a sample of its rules against aliyun, only the scaling groups found stale are synced again"
+    )
+
+    # Optional argument which requires a parameter (eg. --probe-samples 20)
+    parser.add_argument(
+        "--probe-samples",
+        action="store",
+        dest="probe_samples",
+        type=int,
+        default=10,
+        help=
+        "Number of cached scaling rules --probe-sync compares with aliyun, default: 10"
+    )
+
+    # Optional argument which requires a parameter (eg. --cache-url http://cache.local:8080)
+    parser.add_argument(
+        "--cache-url",
+        action="store",
+        dest="cache_url",
+        default="",
+        help=
+        "Share cache files with other runs through a remote cache (file:///path/to/dir, or http://host:port of the cache-server command)"
+    )
+
+    # Optional argument which requires a parameter (eg. --cache-max-age 600)
+    parser.add_argument(
+        "--cache-max-age",
+        action="store",
+        dest="cache_max_age",
+        type=int,
+        default=0,
+        help=
+        "Use cached_rules.yaml without syncing if it was synced from aliyun less than this many seconds ago, e.g. by another run sharing --cache-url"
+    )
+
+    # Optional argument which requires a parameter (eg. --shard 1/4)
+    parser.add_argument(
+        "--shard",
+        action="store",
+        dest="shard",
+        default="",
+        help=
+        "Only process shard i of N (e.g. 1/4), apps are split by a hash of their scaling group name"
+    )
+
+    # Optional argument which requires a parameter (eg. --deadline 300)
+    parser.add_argument(
+        "--deadline",
+        action="store",
+        dest="deadline",
+        type=int,
+        default=0,
+        help=
+        "Stop making changes in aliyun this many seconds after the start, what remains is reported as DEFERRED"
+    )
+
+    # Optional argument which requires a parameter (eg. --output ndjson)
+    parser.add_argument(
+        "--output",
+        action="store",
+        dest="output",
+        choices=["text", "ndjson"],
+        default="text",
+        help=
+        "ndjson: stream every result and API call to stdout as JSON lines (other output goes to stderr), with a summary at the end"
+    )
+
+    # Optional argument which requires a parameter (eg. --record-trace log/trace.jsonl)
+    parser.add_argument(
+        "--record-trace",
+        action="store",
+        dest="record_trace",
+        default="",
+        help=
+        "Record every request to aliyun and its response into a trace file (without the access key), see the replay command"
+    )
+
+    # Optional argument which requires a parameter (eg. --report log/report.json)
+    parser.add_argument(
+        "--report",
+        action="store",
+        dest="report",
+        default="",
+        help="Write results of this run into a JSON report file")
+
     # Optional verbosity counter (eg. -v, -vv, -vvv, etc.)
     parser.add_argument(
         "-v",
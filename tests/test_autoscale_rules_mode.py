@@ -0,0 +1,239 @@
+"""
+    Behaviour checks of autoscale-rules-mode.py without aliyun: the remote cache runs on a temporary
+    directory, and aliyun's answers come from the replay client of --record-trace
+"""
+import imp
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+arm = imp.load_source(
+    'autoscale_rules_mode',
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'autoscale-rules-mode.py'))
+
+# Module state every test starts from
+_state = [
+    '_client', '_cache_dir', '_shard', '_remote_cache', '_remote_cache_synced',
+    '_current_rules', '_scaling_groups', '_event_trigger_tasks', 'ess_request'
+]
+
+
+class FakeRequest(object):
+    """ Request of an ESS action, with only what do_action and the trace use from the SDK's """
+
+    def __init__(self, action):
+        self.action = action
+        self.params = {}
+
+    def get_action_name(self):
+        return self.action
+
+    def get_query_params(self):
+        return self.params
+
+    def __getattr__(self, name):
+        if not name.startswith('set_'):
+            raise AttributeError(name)
+        return lambda value: self.params.__setitem__(name[4:], value)
+
+
+def trace_call(action, params, response=None, error=None):
+    """ A 'call' entry of a trace, error is (exception class name, code) """
+    entry = {'type': 'call', 'action': action, 'params': params}
+    if error is None:
+        entry['response'] = json.dumps(response)
+    else:
+        entry['error'] = {
+            'class': error[0],
+            'code': error[1],
+            'message': error[1]
+        }
+    return entry
+
+
+def scaling_rule(name, scaling_rule_id, scaling_group_id, value):
+    return {
+        'ScalingRuleName': name,
+        'ScalingRuleId': scaling_rule_id,
+        'ScalingRuleAri': 'ari:acs:ess:r:1:scalingrule/' + scaling_rule_id,
+        'ScalingGroupId': scaling_group_id,
+        'AdjustmentType': 'PercentChangeInCapacity',
+        'AdjustmentValue': value,
+        'Cooldown': 60,
+    }
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict((a, getattr(arm, a)) for a in _state)
+        self.tmp = tempfile.mkdtemp()
+        arm._cache_dir = os.path.join(self.tmp, 'local')
+        os.makedirs(arm._cache_dir)
+        arm._shard = None
+        arm._remote_cache = None
+        arm._remote_cache_synced = {}
+        arm.ess_request = FakeRequest
+
+    def tearDown(self):
+        for a, b in self.saved.items():
+            setattr(arm, a, b)
+        shutil.rmtree(self.tmp)
+
+    def read_cache(self, path):
+        with open(path) as file:
+            return yaml.safe_load(file)
+
+
+class RemoteCacheTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.url = 'file://' + os.path.join(self.tmp, 'remote')
+        self.backend = arm.FileCacheBackend(self.url)
+        self.name = 'cached_scaling_groups.yaml'
+        arm.init_remote_cache(self.url)
+        arm.dump_cache({'app-1': 'asg-1', 'app-2': 'asg-2'}, 'scaling_groups')
+
+    def remote(self):
+        return yaml.safe_load(self.backend.fetch(self.name)[1])
+
+    def other_run(self, **changes):
+        """ Another run pushes its own changes after we pulled """
+        version, content = self.backend.fetch(self.name)
+        data = yaml.safe_load(content)
+        data.update(changes)
+        self.assertIsNotNone(
+            self.backend.store(self.name,
+                               yaml.dump(data, default_flow_style=False),
+                               version))
+
+    def test_conflict_merges_both_runs(self):
+        self.other_run(**{'app-2': 'asg-2b', 'app-3': 'asg-3'})
+        arm.dump_cache({'app-1': 'asg-1b', 'app-2': 'asg-2'}, 'scaling_groups')
+
+        merged = {'app-1': 'asg-1b', 'app-2': 'asg-2b', 'app-3': 'asg-3'}
+        self.assertEqual(self.remote(), merged)
+        # The next pull wouldn't fetch the other run's records, they're kept locally
+        self.assertEqual(
+            self.read_cache(arm.cache_file('scaling_groups')), merged)
+
+        # Records this run removes are removed from the merged content, the other run's stay
+        arm.dump_cache({'app-2': 'asg-2'}, 'scaling_groups')
+        self.assertEqual(self.remote(), {'app-2': 'asg-2b', 'app-3': 'asg-3'})
+
+    def test_conflict_retries_are_bounded(self):
+        stores = []
+
+        def store(name, content, version=None):
+            stores.append(version)
+            return None
+
+        arm._remote_cache.store = store
+        arm.dump_cache({'app-1': 'asg-1b', 'app-2': 'asg-2'}, 'scaling_groups')
+        self.assertEqual(len(stores), arm._remote_cache_retries + 1)
+        self.assertEqual(self.remote(), {'app-1': 'asg-1', 'app-2': 'asg-2'})
+
+    def test_rules_meta_keeps_latest_sync(self):
+        older = json.dumps({'TotalCount': 2, 'SyncedAt': 100.0})
+        newer = json.dumps({'TotalCount': 3, 'SyncedAt': 200.0})
+        name = 'cached_rules.meta.json'
+        self.assertEqual(
+            arm.merge_cache_content(name, '', older, newer), newer)
+        self.assertEqual(
+            arm.merge_cache_content(name, '', newer, older), newer)
+
+
+class ChangeFeedTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        arm._current_rules = {
+            'app-1-upscale':
+            arm.ScalingRuleRecord.from_dict(
+                scaling_rule('app-1-upscale', 'asr-1', 'asg-1', 50)),
+            'app-1-downscale':
+            arm.ScalingRuleRecord.from_dict(
+                scaling_rule('app-1-downscale', 'asr-2', 'asg-1', -20)),
+        }
+        arm._scaling_groups = {
+            'app-1': 'asg-1',
+            'asg-1': arm.ScalingGroupRecord(MinInstance=2, MaxInstance=10)
+        }
+        arm._event_trigger_tasks = {}
+        arm.dump_feed_inventory(0, 2)
+
+        # A rule created without its ARI in the event is fetched from aliyun, which throttles us once
+        created = scaling_rule('app-1-extra', 'asr-3', 'asg-1', 10)
+        describe = ('DescribeScalingRules', {'ScalingRuleId1': 'asr-3'})
+        arm._client = arm.ReplayClient([
+            trace_call(*describe, error=('ServerException', 'Throttling')),
+            trace_call(*describe, response={
+                'TotalCount': 1,
+                'ScalingRules': {'ScalingRule': [created]}
+            }),
+        ])
+        self.lines = [
+            json.dumps({
+                'seq': 1,
+                'eventName': 'CreateScalingRule',
+                'requestParameters': {
+                    'ScalingRuleName': 'app-1-extra',
+                    'ScalingGroupId': 'asg-1'
+                },
+                'responseElements': {'ScalingRuleId': 'asr-3'},
+            }) + "\n",
+            json.dumps({
+                'seq': 2,
+                'eventName': 'DeleteScalingRule',
+                'requestParameters': {'ScalingRuleId': 'asr-2'},
+            }) + "\n",
+        ]
+
+    def test_failed_event_is_retried_on_next_poll(self):
+        seq, total_count, pending = arm.apply_feed_events(self.lines, 0, 2)
+        self.assertEqual((seq, total_count), (0, 2))
+        self.assertEqual(pending, self.lines)
+        self.assertNotIn('app-1-extra', arm._current_rules)
+
+        seq, total_count, pending = arm.apply_feed_events(
+            pending, seq, total_count)
+        self.assertEqual((seq, total_count, pending), (2, 2, []))
+        self.assertEqual(
+            sorted(arm._current_rules), ['app-1-extra', 'app-1-upscale'])
+        self.assertEqual(arm._client.unused(), 0)
+
+    def test_resume_from_cached_position(self):
+        arm.apply_feed_events(arm.apply_feed_events(self.lines, 0, 2)[2], 0,
+                              2)
+
+        # A new sync-feed reads the whole feed again, only events after the cached position are applied
+        arm._current_rules = {}
+        seq, total_count = arm.load_feed_inventory()
+        self.assertEqual((seq, total_count), (2, 2))
+        self.assertEqual(
+            arm.apply_feed_events(self.lines, seq, total_count), (2, 2, []))
+        self.assertEqual(
+            sorted(arm._current_rules), ['app-1-extra', 'app-1-upscale'])
+
+    def test_partial_line_is_left_for_next_read(self):
+        path = os.path.join(self.tmp, 'feed.jsonl')
+        with open(path, 'w') as file:
+            file.write(self.lines[0] + self.lines[1][:10])
+        feed = open(path)
+        try:
+            feed, lines = arm.read_feed_lines(feed, path)
+            self.assertEqual(lines, self.lines[:1])
+            with open(path, 'a') as file:
+                file.write(self.lines[1][10:])
+            feed, lines = arm.read_feed_lines(feed, path)
+            self.assertEqual(lines, self.lines[1:])
+        finally:
+            feed.close()
+
+
+if __name__ == '__main__':
+    unittest.main()